@@ -2,31 +2,491 @@
 Flask API Server - Provides REST endpoints for future comprehensive dashboard
 """
 
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, make_response, g, stream_with_context
 from flask_cors import CORS  # For handling cross-origin requests
 
+from collections import Counter, OrderedDict
+from datetime import date, datetime, timezone
+import bisect
+import functools
+import hashlib
+import heapq
+import json
+import math
+import random
 import sqlite3
+import threading
 import os
+import urllib.request
 
 app = Flask(__name__)
 
-CORS(app)
+CORS(app, expose_headers=['X-Query-Plan'])  # Let the dashboard read the planner's choice
 DATABASE = 'database/nyc_taxi.db'
 
-def get_db():
-    """Create database connection"""
-    conn = sqlite3.connect(DATABASE)
+# Averages over trip_rollups rows, matching AVG() over the trips they count
+ROLLUP_AVERAGES = """
+            ROUND(SUM(sum_duration) / 60.0 / SUM(trip_count), 2) as avg_duration_min,
+            ROUND(SUM(sum_distance) / SUM(distance_count), 2) as avg_distance_km,
+            ROUND(SUM(sum_speed) / SUM(speed_count), 2) as avg_speed_kmh"""
+
+# Read-only connection tuning: 64 MB page cache, up to 256 MB memory-mapped,
+# sorts and temporary tables in memory
+DB_CACHE_SIZE_KB = 65536
+DB_MMAP_SIZE = 256 * 1024 * 1024
+
+# Idle connections kept for reuse; more can be open while requests run
+DB_POOL_SIZE = 8
+
+def open_read_only(path):
+    """Open a tuned read-only connection (the API never writes)"""
+    uri = 'file:' + urllib.request.pathname2url(os.path.abspath(path)) + '?mode=ro'
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
     return conn
 
+class ConnectionPool:
+    """
+    Read-only connections reused across requests, so the schema is parsed
+    once and the page cache stays warm. Each connection serves one request
+    at a time; the most recently returned one is handed out first.
+    """
+    
+    def __init__(self, max_idle=DB_POOL_SIZE):
+        self.max_idle = max_idle
+        self.idle = []  # (path, connection)
+        self.lock = threading.Lock()
+        
+    def acquire(self, path):
+        """An idle connection to path, or a new one"""
+        with self.lock:
+            while self.idle:
+                idle_path, conn = self.idle.pop()
+                if idle_path == path:
+                    return conn
+                conn.close()  # DATABASE was changed
+        return open_read_only(path)
+        
+    def release(self, path, conn):
+        """Return a connection, closing it if enough are idle already"""
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append((path, conn))
+                return
+        conn.close()
+
+connection_pool = ConnectionPool()
+
+def get_db():
+    """Database connection for the current request (returned to the pool at teardown)"""
+    if 'db' not in g:
+        g.db_path = DATABASE
+        g.db = connection_pool.acquire(DATABASE)
+    return g.db
+
+# Requests that may scan trips, run at once per process; the rest wait.
+# Cache hits and rollup, sketch and sample reads never take a slot, so a
+# burst of slow filtered queries can't tie up every server thread.
+SCAN_SLOTS = int(os.environ.get('API_SCAN_SLOTS', 4))
+
+# Seconds a request waits for a scan slot before getting a 503
+SCAN_WAIT_SECONDS = float(os.environ.get('API_SCAN_WAIT', 10))
+
+scan_slots = threading.BoundedSemaphore(SCAN_SLOTS)
+
+class ServerBusy(Exception):
+    """No scan slot came free within SCAN_WAIT_SECONDS"""
+
+def hold_scan_slot():
+    """Take a scan slot for the rest of the request, waiting for one if all are taken"""
+    if g.get('scan_slot'):
+        return
+    if not scan_slots.acquire(timeout=SCAN_WAIT_SECONDS):
+        raise ServerBusy()
+    g.scan_slot = True
+
+@app.errorhandler(ServerBusy)
+def server_busy(error):
+    """503 telling clients to retry, rather than queueing them indefinitely"""
+    response = jsonify({'error': 'Too many slow queries running, try again shortly'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+@app.teardown_appcontext
+def release_db(exception):
+    """Hand the request's connection and scan slot back"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        connection_pool.release(g.pop('db_path'), conn)
+    if g.pop('scan_slot', False):
+        scan_slots.release()
+
+# ==================== RESPONSE CACHE ====================
+
+# Most responses kept; the dashboard uses a few dozen distinct URLs
+RESPONSE_CACHE_SIZE = 256
+
+class ResponseCache:
+    """
+    Bounded LRU cache of response bodies, keyed by path and query args
+    (also used for other values derived from the data, under other keys)
+    Entries belong to one data version; the first lookup after the loader
+    bumps the version empties the cache.
+    """
+    
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.version = None
+        self.lock = threading.Lock()  # The dev server handles requests in threads
+        
+    def get(self, key, version):
+        """Cached entry for key under this data version, or None"""
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+                return None
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+        
+    def put(self, key, version, entry):
+        """Store an entry, evicting the least recently used beyond max_entries"""
+        with self.lock:
+            if version != self.version:
+                return  # The data changed while the response was being built
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+response_cache = ResponseCache()
+
+def data_version():
+    """
+    (data_version, last modified datetime) as recorded by the loader
+    Databases the loader hasn't written to since versions existed get ('0', None)
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT key, value FROM settings
+        WHERE key IN ('data_version', 'data_updated_at')
+    """)
+    settings = {row['key']: row['value'] for row in cursor.fetchall()}
+    
+    updated_at = settings.get('data_updated_at')
+    if updated_at is not None:
+        updated_at = datetime.fromtimestamp(int(updated_at), timezone.utc)
+    return settings.get('data_version', '0'), updated_at
+
+def cached(view):
+    """
+    Serve a GET endpoint from response_cache until the data changes
+    Responses carry an ETag (hash of the body) and Last-Modified (time of
+    the last load), so browsers revalidating get a 304 without a body.
+    Error responses are not cached.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        version, updated_at = data_version()
+        key = (request.path, tuple(sorted(request.args.items(multi=True))))
+        
+        entry = response_cache.get(key, version)
+        if entry is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            body = response.get_data()
+            entry = {
+                'body': body,
+                'mimetype': response.mimetype,
+                'headers': [(name, value) for name, value in response.headers if name.startswith('X-')],
+                'etag': hashlib.sha1(body).hexdigest()
+            }
+            response_cache.put(key, version, entry)
+        
+        response = app.response_class(entry['body'], mimetype=entry['mimetype'], headers=entry['headers'])
+        response.set_etag(entry['etag'])
+        if updated_at is not None:
+            response.last_modified = updated_at
+        response.cache_control.no_cache = True  # Browsers revalidate before reusing it
+        return response.make_conditional(request)
+    return wrapper
+
+# ==================== FILTERS & QUERY PLANNER ====================
+
+class TripFilter:
+    """
+    Trip filters shared by the stats and trip listing endpoints
+    Query args (all optional):
+        start_date, end_date: YYYY-MM-DD, both inclusive
+        vendor_id: Taxi vendor
+        borough: Pickup borough (as in /api/boroughs, or Unknown)
+        start_hour, end_hour: Pickup hours 0-23, both inclusive; a start
+            after the end wraps past midnight (start_hour=22&end_hour=2)
+        min_passengers, max_passengers: Passenger count range
+    """
+    
+    def __init__(self, args):
+        """Parse the filters, raising ValueError with a message for bad values"""
+        self.start_date = self._date(args, 'start_date')
+        self.end_date = self._date(args, 'end_date')
+        self.vendor_id = self._integer(args, 'vendor_id')
+        self.borough = args.get('borough') or None
+        self.start_hour = self._integer(args, 'start_hour', 0, 23)
+        self.end_hour = self._integer(args, 'end_hour', 0, 23)
+        self.min_passengers = self._integer(args, 'min_passengers')
+        self.max_passengers = self._integer(args, 'max_passengers')
+        
+    @staticmethod
+    def _date(args, name):
+        value = args.get(name)
+        if not value:
+            return None
+        try:
+            return date.fromisoformat(value).isoformat()
+        except ValueError:
+            raise ValueError(f"{name} must be a date like 2016-03-01")
+        
+    @staticmethod
+    def _integer(args, name, low=None, high=None):
+        value = args.get(name)
+        if value is None or value == '':
+            return None
+        try:
+            number = int(value)
+        except ValueError:
+            raise ValueError(f"{name} must be a whole number")
+        if (low is not None and number < low) or (high is not None and number > high):
+            raise ValueError(f"{name} must be between {low} and {high}")
+        return number
+        
+    def is_empty(self):
+        return not any(value is not None for value in vars(self).values())
+        
+    def cache_key(self):
+        """Hashable form of the filters, equal for equal filters"""
+        return tuple(sorted(vars(self).items()))
+        
+    def rollup_compatible(self):
+        """Whether trip_rollups can answer: every filter is one of its key columns"""
+        return self.min_passengers is None and self.max_passengers is None
+        
+    def sketch_compatible(self):
+        """Whether quantile_sketches can answer: no date or passenger filters"""
+        return self.rollup_compatible() and self.start_date is None and self.end_date is None
+        
+    def sample_where(self):
+        """(where, params) over trip_samples: the trip_rollups keys and passenger_count"""
+        where, params = self.rollup_where()
+        if self.min_passengers is not None:
+            where += " AND passenger_count >= ?"
+            params.append(self.min_passengers)
+        if self.max_passengers is not None:
+            where += " AND passenger_count <= ?"
+            params.append(self.max_passengers)
+        return where, params
+        
+    def _hour_condition(self, column):
+        """Hour range condition, or None without an hour filter"""
+        if self.start_hour is None and self.end_hour is None:
+            return None
+        start = 0 if self.start_hour is None else self.start_hour
+        end = 23 if self.end_hour is None else self.end_hour
+        if start <= end:
+            return f"{column} BETWEEN {start} AND {end}"
+        return f"({column} >= {start} OR {column} <= {end})"
+        
+    def rollup_where(self):
+        """(where, params) over trip_rollups columns"""
+        where, params = ["1=1"], []
+        if self.start_date:
+            where.append("pickup_date >= ?")
+            params.append(self.start_date)
+        if self.end_date:
+            where.append("pickup_date <= ?")
+            params.append(self.end_date)
+        if self.vendor_id is not None:
+            where.append("vendor_id = ?")
+            params.append(self.vendor_id)
+        if self.borough:
+            where.append("pickup_borough = ?")
+            params.append(self.borough)
+        hours = self._hour_condition("pickup_hour")
+        if hours:
+            where.append(hours)
+        return " AND ".join(where), params
+        
+    def trip_where(self, alias='t'):
+        """
+        (where, params) over trips, written so each filter can use an index:
+        dates compare integer epochs and boroughs become location ids
+        """
+        where, params = ["1=1"], []
+        if self.start_date:
+            where.append(f"{alias}.pickup_epoch >= CAST(strftime('%s', ?) AS INTEGER)")
+            params.append(self.start_date)
+        if self.end_date:
+            where.append(f"{alias}.pickup_epoch < CAST(strftime('%s', ?, '+1 day') AS INTEGER)")
+            params.append(self.end_date)
+        if self.vendor_id is not None:
+            where.append(f"{alias}.vendor_id = ?")
+            params.append(self.vendor_id)
+        if self.borough:
+            where.append(f"""{alias}.pickup_location_id IN (
+                SELECT location_id FROM locations WHERE COALESCE(borough, 'Unknown') = ?)""")
+            params.append(self.borough)
+        hours = self._hour_condition(f"{alias}.pickup_hour")
+        if hours:
+            where.append(hours)
+        if self.min_passengers is not None:
+            where.append(f"{alias}.passenger_count >= ?")
+            params.append(self.min_passengers)
+        if self.max_passengers is not None:
+            where.append(f"{alias}.passenger_count <= ?")
+            params.append(self.max_passengers)
+        return " AND ".join(where), params
+
+# One row per trip with the columns of trip_rollups, so a stats query
+# gives the same answer over either source
+TRIP_FACTS = """(
+        SELECT
+            substr(t.pickup_datetime, 1, 10) as pickup_date,
+            t.pickup_hour as pickup_hour,
+            t.vendor_id as vendor_id,
+            COALESCE(l.borough, 'Unknown') as pickup_borough,
+            1 as trip_count,
+            COALESCE(m.is_suspicious, 0) as suspicious_count,
+            t.trip_duration as sum_duration,
+            t.trip_duration as max_duration,
+            m.distance_km IS NOT NULL as distance_count,
+            COALESCE(m.distance_km, 0) as sum_distance,
+            m.distance_km as max_distance,
+            m.trip_speed_kmh IS NOT NULL as speed_count,
+            COALESCE(m.trip_speed_kmh, 0) as sum_speed
+        FROM trips t
+        LEFT JOIN trip_metrics m ON m.trip_rowid = t.trip_rowid
+        LEFT JOIN locations l ON l.location_id = t.pickup_location_id
+        WHERE {where}
+    )"""
+
+def use_plan(path):
+    """Record an access path ('rollup' or 'scan') for the X-Query-Plan header"""
+    plans = g.setdefault('query_plans', [])
+    if path not in plans:
+        plans.append(path)
+
+def trip_facts(filters):
+    """
+    The query planner: pick where a filtered stats query reads from
+    trip_rollups answers whenever every filter is a rollup key column;
+    otherwise (a passenger filter) the trips are scanned through the most
+    selective index the filters allow.
+    Returns:
+        (source, params): a subquery with the trip_rollups columns
+    """
+    if filters.rollup_compatible():
+        use_plan('rollup')
+        where, params = filters.rollup_where()
+        return f"(SELECT * FROM trip_rollups WHERE {where})", params
+    use_plan('scan')
+    if g.get('batch_facts'):
+        return "temp.batch_facts", []  # Scanned once for the whole batch
+    hold_scan_slot()
+    where, params = filters.trip_where()
+    return TRIP_FACTS.format(where=where), params
+
+def trip_scan(filters):
+    """(where, params) over trips aliased t, for stats that have no rollup"""
+    use_plan('scan')
+    hold_scan_slot()
+    return filters.trip_where()
+
+def filtered(view):
+    """
+    Parse TripFilter from the query args and pass it to the view as filters
+    Bad filter values get a 400; responses report the planner's choices in
+    an X-Query-Plan header (e.g. 'rollup' or 'rollup,scan').
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            filters = TripFilter(request.args)
+        except ValueError as error:
+            return jsonify({'error': str(error)}), 400
+        response = make_response(view(*args, filters=filters, **kwargs))
+        if g.get('query_plans'):
+            response.headers['X-Query-Plan'] = ','.join(g.query_plans)
+        return response
+    return wrapper
+
+# Stats /api/batch can return: name -> (view, whether it takes filters)
+BATCH_STATS = {}
+
+def batch_stat(name, uses_filters=True):
+    """Register an undecorated stats view under a name for /api/batch"""
+    def register(view):
+        BATCH_STATS[name] = (view, uses_filters)
+        return view
+    return register
+
+def suspicious_breakdown(cursor, filters=None):
+    """Count suspicious trips per rule by testing suspicious_flags bits"""
+    if filters is None or filters.is_empty():
+        source, params = "suspicious_flag_rollups", []
+        if filters is not None:
+            use_plan('rollup')
+    elif filters.rollup_compatible():
+        use_plan('rollup')
+        where, params = filters.rollup_where()
+        source = f"(SELECT suspicious_flags, trip_count FROM suspicious_rollups WHERE {where})"
+    else:
+        where, params = trip_scan(filters)
+        source = f"""(
+            SELECT m.suspicious_flags, COUNT(*) as trip_count
+            FROM trips t
+            JOIN trip_metrics m ON m.trip_rowid = t.trip_rowid
+            WHERE m.is_suspicious = 1 AND {where}
+            GROUP BY m.suspicious_flags
+        )"""
+    cursor.execute(f"""
+        SELECT 
+            r.rule,
+            r.label,
+            COALESCE(SUM(f.trip_count), 0) as trip_count
+        FROM suspicious_rules r
+        LEFT JOIN {source} f 
+            ON (f.suspicious_flags & r.bit) != 0
+        GROUP BY r.bit
+        ORDER BY r.bit
+    """, params)
+    return [dict(row) for row in cursor.fetchall()]
+
 @app.route('/')
 def home():
     """API documentation endpoint"""
     return jsonify({
         'message': 'NYC Taxi Analytics API',
+        'filters': {
+            'applies_to': '/api/trips, /api/trips/export, /api/boroughs and every /api/stats endpoint',
+            'start_date, end_date': 'Pickup dates YYYY-MM-DD, inclusive',
+            'vendor_id': 'Taxi vendor',
+            'borough': 'Pickup borough',
+            'start_hour, end_hour': 'Pickup hours 0-23, inclusive (22 to 2 wraps past midnight)',
+            'min_passengers, max_passengers': 'Passenger count range',
+            'X-Query-Plan': 'Response header: rollup (pre-aggregated), sketch (quantile sketches), sample (trip_samples) or scan (indexed trips)'
+        },
         'endpoints': {
             'Basic Queries': {
-                '/api/trips': 'Get individual trips (paginated)',
+                '/api/trips': 'Get individual trips (paginated, pass next_cursor as cursor)',
+                '/api/trips/export': 'Stream matching trips as NDJSON or JSON',
                 '/api/trips/count': 'Get total trip count'
             },
             'Statistics': {
@@ -41,7 +501,9 @@ def home():
                 '/api/stats/duration-distribution': 'Trip duration ranges',
                 '/api/stats/distance-distribution': 'Trip distance ranges',
                 '/api/stats/speed-distribution': 'Trip speed ranges',
-                '/api/stats/passenger-distribution': 'Passenger count distribution'
+                '/api/stats/passenger-distribution': 'Passenger count distribution',
+                '/api/stats/histogram': 'Histograms with custom edges or equal-width/quantile bins',
+                '/api/stats/quantiles': 'p50/p90/p99 of duration, distance and speed'
             },
             'Location Analysis': {
                 '/api/boroughs': 'Trips by borough',
@@ -49,47 +511,143 @@ def home():
             },
             'Data Quality': {
                 '/api/suspicious': 'Flagged suspicious trips',
-                '/api/stats/efficiency': 'Distance vs duration analysis'
+                '/api/stats/efficiency': 'Distance vs duration sample (n, seed)'
+            },
+            'Batch': {
+                '/api/batch': 'Several stats in one response (stats=summary,boroughs,...)'
             }
         }
     })
 
 # ==================== BASIC QUERIES ROUTES ====================
 
+# Largest page /api/trips returns; bigger extracts go through /api/trips/export
+MAX_PAGE_SIZE = 1000
+
+# Rows taken from the cursor per chunk of a streamed export
+EXPORT_FETCH_ROWS = 1000
+
+def encode_cursor(row):
+    """Page cursor pointing just after a trip row (its pickup_epoch and trip_rowid)"""
+    return f"{row['pickup_epoch']}-{row['trip_rowid']}"
+
+def decode_cursor(page_cursor):
+    """(pickup_epoch, trip_rowid) from encode_cursor(); raises ValueError if malformed"""
+    epoch, _, rowid = page_cursor.partition('-')
+    return int(epoch), int(rowid)
+
+def trip_filters(args):
+    """
+    WHERE clause over trips aliased t for the trip listing and export
+    Trips are listed in (pickup_epoch, trip_rowid) order, which the pickup
+    indexes already hold (every index ends with the rowid), so pages never sort.
+    Args:
+        args: Query args with the TripFilter filters and cursor (a previous next_cursor)
+    Returns:
+        (where, params); raises ValueError for a bad filter or cursor
+    """
+    where, params = TripFilter(args).trip_where()
+    
+    page_cursor = args.get('cursor')
+    if page_cursor:
+        # Rows after the cursor; the range on pickup_epoch lets the index
+        # seek straight to the page instead of skipping earlier rows
+        try:
+            epoch, rowid = decode_cursor(page_cursor)
+        except ValueError:
+            raise ValueError("Invalid cursor")
+        where += " AND t.pickup_epoch >= ? AND (t.pickup_epoch > ? OR t.trip_rowid > ?)"
+        params.extend([epoch, epoch, rowid])
+    
+    return where, params
+
 @app.route('/api/trips')
+@cached
 def get_trips():
-    """Get trips with optional filters"""
-    vendor_id = request.args.get('vendor_id', type=int)
-    start_date = request.args.get('start_date')
+    """Get a page of trips with optional filters; pass next_cursor as cursor for the next page"""
     limit = request.args.get('limit', default=100, type=int)
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    
+    try:
+        where, params = trip_filters(request.args)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
     
     conn = get_db()
     cursor = conn.cursor()
     
-    query = "SELECT * FROM trips WHERE 1=1"
-    params = []
-    
-    if vendor_id:
-        query += " AND vendor_id = ?"
-        params.append(vendor_id)
-    
-    if start_date:
-        query += " AND DATE(pickup_datetime) >= ?"
-        params.append(start_date)
-    
-    query += f" LIMIT {limit}"
-    
-    cursor.execute(query, params)
-    trips = [dict(row) for row in cursor.fetchall()]
-    
-    conn.close()
+    # One extra row tells whether another page follows
+    cursor.execute(f"""
+        SELECT t.* FROM trips t
+        WHERE {where}
+        ORDER BY t.pickup_epoch, t.trip_rowid
+        LIMIT ?
+    """, params + [limit + 1])
+    rows = cursor.fetchall()
+    trips = [dict(row) for row in rows[:limit]]
     
     return jsonify({
         'count': len(trips),
+        'limit': limit,
+        'next_cursor': encode_cursor(rows[limit - 1]) if len(rows) > limit else None,
         'trips': trips
     })
 
+@app.route('/api/trips/export')
+def export_trips():
+    """
+    Stream every trip matching the /api/trips filters, as NDJSON (one trip
+    per line) or with format=json as one JSON array. Rows are written as
+    they come off the cursor, so memory use doesn't grow with the export.
+    Not cached, since the cache would hold the whole body.
+    """
+    output = request.args.get('format', 'ndjson')
+    if output not in ('ndjson', 'json'):
+        return jsonify({'error': f'Unknown format: {output}'}), 400
+    
+    try:
+        where, params = trip_filters(request.args)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    
+    hold_scan_slot()  # Held until the last row is sent
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT t.* FROM trips t
+        WHERE {where}
+        ORDER BY t.pickup_epoch, t.trip_rowid
+    """, params)
+    columns = [column[0] for column in cursor.description]
+    
+    def generate():
+        first = True
+        if output == 'json':
+            yield '['
+        while True:
+            rows = cursor.fetchmany(EXPORT_FETCH_ROWS)
+            if not rows:
+                break
+            lines = [json.dumps(dict(zip(columns, row))) for row in rows]
+            if output == 'json':
+                yield ('' if first else ',') + ','.join(lines)
+            else:
+                yield '\n'.join(lines) + '\n'
+            first = False
+        if output == 'json':
+            yield ']'
+    
+    # stream_with_context keeps the request (and its pooled connection)
+    # until the last row is sent
+    response = app.response_class(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson' if output == 'ndjson' else 'application/json'
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename=trips.{output}'
+    return response
+
 @app.route('/api/trips/count')
+@cached
 def get_trip_count():
     """Get total number of trips"""
     conn = get_db()
@@ -98,8 +656,6 @@ def get_trip_count():
     cursor.execute("SELECT COUNT(*) as total FROM trips")
     result = cursor.fetchone()
     
-    conn.close()
-    
     return jsonify({
         'total_trips': result['total']
     })
@@ -107,46 +663,49 @@ def get_trip_count():
 # ==================== SUMMARY & KPIs ROUTES ====================
 
 @app.route('/api/stats/summary')
-def get_summary():
+@cached
+@filtered
+@batch_stat('summary')
+def get_summary(filters):
     """Get overall KPIs and summary statistics"""
     conn = get_db()
     cursor = conn.cursor()
     
-    # Total trips
-    cursor.execute("SELECT COUNT(*) as total FROM trips")
-    total = cursor.fetchone()['total']
-    
-    # Suspicious trips
-    cursor.execute("SELECT COUNT(*) as total FROM trip_metrics WHERE is_suspicious = 1")
-    suspicious = cursor.fetchone()['total']
-    
-    # Averages
-    cursor.execute("""
+    # Totals and averages
+    facts, params = trip_facts(filters)
+    cursor.execute(f"""
         SELECT 
-            ROUND(AVG(trip_duration / 60.0), 2) as avg_duration_min,
-            ROUND(AVG(distance_km), 2) as avg_distance_km,
-            ROUND(AVG(trip_speed_kmh), 2) as avg_speed_kmh,
-            ROUND(MAX(distance_km), 2) as max_distance_km,
-            ROUND(MAX(trip_duration / 60.0), 2) as max_duration_min
-        FROM trips t
-        JOIN trip_metrics m ON t.trip_id = m.trip_id
-    """)
+            COALESCE(SUM(trip_count), 0) as total,
+            COALESCE(SUM(suspicious_count), 0) as suspicious,
+            {ROLLUP_AVERAGES},
+            ROUND(MAX(max_distance), 2) as max_distance_km,
+            ROUND(MAX(max_duration) / 60.0, 2) as max_duration_min
+        FROM {facts}
+    """, params)
     averages = cursor.fetchone()
+    total = averages['total']
+    suspicious = averages['suspicious']
     
-    # Date range
-    cursor.execute("""
-        SELECT 
-            MIN(pickup_datetime) as first_trip,
-            MAX(pickup_datetime) as last_trip
-        FROM trips
-    """)
-    dates = cursor.fetchone()
+    # Date range: first and last matching trip along the pickup_epoch index
+    where, params = filters.trip_where()
+    dates = {}
+    for name, order in (('first_trip', 'ASC'), ('last_trip', 'DESC')):
+        cursor.execute(f"""
+            SELECT t.pickup_datetime FROM trips t
+            WHERE {where}
+            ORDER BY t.pickup_epoch {order}
+            LIMIT 1
+        """, params)
+        row = cursor.fetchone()
+        dates[name] = row['pickup_datetime'] if row else None
     
-    conn.close()
+    # Suspicious trips per reason (a trip can have several)
+    by_reason = suspicious_breakdown(cursor, filters)
     
     return jsonify({
         'total_trips': total,
         'suspicious_trips': suspicious,
+        'suspicious_by_reason': by_reason,
         'clean_trips': total - suspicious,
         'avg_duration_minutes': averages['avg_duration_min'],
         'avg_distance_km': averages['avg_distance_km'],
@@ -160,60 +719,67 @@ def get_summary():
     })
 
 @app.route('/api/stats/vendors')
-def vendor_stats():
+@cached
+@filtered
+@batch_stat('vendors')
+def vendor_stats(filters):
     """Get statistics grouped by vendor"""
     conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute("""
+    facts, params = trip_facts(filters)
+    cursor.execute(f"""
         SELECT 
             v.vendor_name,
-            COUNT(t.trip_id) as total_trips,
-            ROUND(AVG(t.trip_duration / 60.0), 2) as avg_duration_min,
-            ROUND(AVG(m.distance_km), 2) as avg_distance_km,
-            ROUND(AVG(m.trip_speed_kmh), 2) as avg_speed_kmh
-        FROM trips t
-        JOIN vendors v ON t.vendor_id = v.vendor_id
-        JOIN trip_metrics m ON t.trip_id = m.trip_id
+            SUM(r.trip_count) as total_trips,
+            {ROLLUP_AVERAGES}
+        FROM {facts} r
+        JOIN vendors v ON r.vendor_id = v.vendor_id
         GROUP BY v.vendor_name
-    """)
+    """, params)
     
     stats = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     
     return jsonify(stats)
 
 # ==================== TIME PATTERNS ROUTES ====================
 
 @app.route('/api/stats/hourly')
-def hourly_stats():
+@cached
+@filtered
+@batch_stat('hourly')
+def hourly_stats(filters):
     """Get trip counts by hour of day"""
     conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute("""
+    facts, params = trip_facts(filters)
+    cursor.execute(f"""
         SELECT 
-            CAST(strftime('%H', pickup_datetime) AS INTEGER) as hour,
-            COUNT(*) as trip_count
-        FROM trips
-        GROUP BY hour
-        ORDER BY hour
-    """)
+            pickup_hour as hour,
+            SUM(trip_count) as trip_count
+        FROM {facts}
+        GROUP BY pickup_hour
+        ORDER BY pickup_hour
+    """, params)
     
     stats = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     
     return jsonify(stats)
 
 @app.route('/api/stats/daily-patterns')
-def daily_patterns():
+@cached
+@filtered
+@batch_stat('daily-patterns')
+def daily_patterns(filters):
     """Get trips by day of week"""
     conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute("""
+    facts, params = trip_facts(filters)
+    cursor.execute(f"""
         SELECT 
-            CASE CAST(strftime('%w', pickup_datetime) AS INTEGER)
+            CASE CAST(strftime('%w', pickup_date) AS INTEGER)
                 WHEN 0 THEN 'Sunday'
                 WHEN 1 THEN 'Monday'
                 WHEN 2 THEN 'Tuesday'
@@ -222,280 +788,720 @@ def daily_patterns():
                 WHEN 5 THEN 'Friday'
                 WHEN 6 THEN 'Saturday'
             END as day_name,
-            COUNT(*) as trip_count,
-            ROUND(AVG(trip_duration / 60.0), 2) as avg_duration_min
-        FROM trips
-        GROUP BY strftime('%w', pickup_datetime)
-        ORDER BY CAST(strftime('%w', pickup_datetime) AS INTEGER)
-    """)
+            SUM(trip_count) as trip_count,
+            ROUND(SUM(sum_duration) / 60.0 / SUM(trip_count), 2) as avg_duration_min
+        FROM {facts}
+        GROUP BY strftime('%w', pickup_date)
+        ORDER BY CAST(strftime('%w', pickup_date) AS INTEGER)
+    """, params)
     
     stats = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     
     return jsonify(stats)
 
 @app.route('/api/stats/monthly-trends')
-def monthly_trends():
+@cached
+@filtered
+@batch_stat('monthly-trends')
+def monthly_trends(filters):
     """Get trips by month"""
     conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute("""
+    facts, params = trip_facts(filters)
+    cursor.execute(f"""
         SELECT 
-            strftime('%Y-%m', pickup_datetime) as month,
-            COUNT(*) as trip_count,
-            ROUND(AVG(trip_duration / 60.0), 2) as avg_duration_min,
-            ROUND(AVG(distance_km), 2) as avg_distance_km
-        FROM trips t
-        JOIN trip_metrics m ON t.trip_id = m.trip_id
+            substr(pickup_date, 1, 7) as month,
+            SUM(trip_count) as trip_count,
+            ROUND(SUM(sum_duration) / 60.0 / SUM(trip_count), 2) as avg_duration_min,
+            ROUND(SUM(sum_distance) / SUM(distance_count), 2) as avg_distance_km
+        FROM {facts}
         GROUP BY month
         ORDER BY month
-    """)
+    """, params)
     
     stats = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     
     return jsonify(stats)
 
 @app.route('/api/stats/rush-hour')
-def rush_hour_analysis():
+@cached
+@filtered
+@batch_stat('rush-hour')
+def rush_hour_analysis(filters):
     """Get average speed by hour (traffic indicator)"""
     conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute("""
+    facts, params = trip_facts(filters)
+    cursor.execute(f"""
         SELECT 
-            CAST(strftime('%H', pickup_datetime) AS INTEGER) as hour,
-            COUNT(*) as trip_count,
-            ROUND(AVG(trip_speed_kmh), 2) as avg_speed,
+            pickup_hour as hour,
+            SUM(trip_count) as trip_count,
+            ROUND(SUM(sum_speed) / SUM(speed_count), 2) as avg_speed,
             CASE 
-                WHEN CAST(strftime('%H', pickup_datetime) AS INTEGER) BETWEEN 7 AND 9 
+                WHEN pickup_hour BETWEEN 7 AND 9 
                     THEN 'Morning Rush'
-                WHEN CAST(strftime('%H', pickup_datetime) AS INTEGER) BETWEEN 17 AND 19 
+                WHEN pickup_hour BETWEEN 17 AND 19 
                     THEN 'Evening Rush'
                 ELSE 'Normal'
             END as period
-        FROM trips t
-        JOIN trip_metrics m ON t.trip_id = m.trip_id
-        GROUP BY hour
-        ORDER BY hour
-    """)
+        FROM {facts}
+        GROUP BY pickup_hour
+        ORDER BY pickup_hour
+    """, params)
     
     stats = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     
     return jsonify(stats)
 
 # ==================== DISTRIBUTIONS ROUTES ====================
 
-@app.route('/api/stats/duration-distribution')
-def duration_distribution():
-    """Get trip duration ranges"""
-    conn = get_db()
-    cursor = conn.cursor()
+# Columns the histogram engine can bin: name -> column of trips t or trip_metrics m
+HISTOGRAM_COLUMNS = {
+    'duration': 't.trip_duration',
+    'distance': 'm.distance_km',
+    'speed': 'm.trip_speed_kmh',
+    'passengers': 't.passenger_count'
+}
+
+# Most bins (or edges) one histogram may ask for
+MAX_HISTOGRAM_BINS = 100
+
+# Column value counts kept for re-binning; a few hundred KB each
+HISTOGRAM_CACHE_SIZE = 32
+
+# name: (label column, histogram column, buckets as (label, upper bound)
+# with the last one unbounded, or None to count each distinct value)
+DISTRIBUTIONS = {
+    'duration': ('duration_range', 'duration', [
+        ('0-5 min', 300), ('5-10 min', 600), ('10-15 min', 900),
+        ('15-30 min', 1800), ('30-60 min', 3600), ('60+ min', None)
+    ]),
+    'distance': ('distance_range', 'distance', [
+        ('0-1 km', 1), ('1-3 km', 3), ('3-5 km', 5),
+        ('5-10 km', 10), ('10-20 km', 20), ('20+ km', None)
+    ]),
+    'speed': ('speed_range', 'speed', [
+        ('0-10 km/h', 10), ('10-20 km/h', 20), ('20-30 km/h', 30),
+        ('30-40 km/h', 40), ('40+ km/h', None)
+    ]),
+    'passenger': ('passenger_count', 'passengers', None),
+}
+
+histogram_cache = ResponseCache(max_entries=HISTOGRAM_CACHE_SIZE)
+
+class ValueCounts:
+    """
+    How many matching trips have each distinct value of a column: the one
+    scan behind every histogram of that column. Any bucket count is then
+    two binary searches over the cumulative counts, so new bucket edges
+    or bin counts never read the trips again.
+    """
     
-    cursor.execute("""
-        SELECT 
-            CASE 
-                WHEN trip_duration < 300 THEN '0-5 min'
-                WHEN trip_duration < 600 THEN '5-10 min'
-                WHEN trip_duration < 900 THEN '10-15 min'
-                WHEN trip_duration < 1800 THEN '15-30 min'
-                WHEN trip_duration < 3600 THEN '30-60 min'
-                ELSE '60+ min'
-            END as duration_range,
-            COUNT(*) as trip_count
-        FROM trips
-        GROUP BY duration_range
-        ORDER BY MIN(trip_duration)
-    """)
+    def __init__(self, counts, missing=0):
+        """
+        Args:
+            counts: (value, trip count) pairs sorted by value, NULLs excluded
+            missing: Trips with no value (NULL)
+        """
+        self.values = [value for value, _ in counts]
+        self.cumulative = [0]
+        for _, count in counts:
+            self.cumulative.append(self.cumulative[-1] + count)
+        self.missing = missing
+        
+    @property
+    def total(self):
+        return self.cumulative[-1]
+        
+    def below(self, edge):
+        """Trips with a value < edge"""
+        return self.cumulative[bisect.bisect_left(self.values, edge)]
+        
+    def at_most(self, edge):
+        """Trips with a value <= edge"""
+        return self.cumulative[bisect.bisect_right(self.values, edge)]
+        
+    def quantile(self, fraction):
+        """Smallest value with at least this fraction of the trips at or below it"""
+        rank = max(1, math.ceil(fraction * self.total))
+        return self.values[bisect.bisect_left(self.cumulative, rank) - 1]
+        
+    def counts(self):
+        """(value, trip count) pairs"""
+        return [(value, self.cumulative[i + 1] - self.cumulative[i]) for i, value in enumerate(self.values)]
+
+def value_counts(filters, columns):
+    """
+    ValueCounts of several HISTOGRAM_COLUMNS for the trips matching filters,
+    from histogram_cache or one scan. Unfiltered, each column is grouped on
+    its own index, which returns the values already sorted; filtered, the
+    matching trips are read once for every column that isn't cached.
+    Returns:
+        dict of column name -> ValueCounts
+    """
+    use_plan('scan')
+    version = data_version()[0]
+    found = {}
+    for name in columns:
+        counts = histogram_cache.get((name, filters.cache_key()), version)
+        if counts is not None:
+            found[name] = counts
+    missing = [name for name in columns if name not in found]
+    if not missing:
+        return found
     
-    stats = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    hold_scan_slot()
+    cursor = get_db().cursor()
+    where, params = filters.trip_where()
+    if filters.is_empty():
+        for name in missing:
+            column = HISTOGRAM_COLUMNS[name]
+            table = "trips t" if column.startswith('t.') else "trip_metrics m"
+            cursor.execute(f"""
+                SELECT {column} as value, COUNT(*) as trip_count
+                FROM {table}
+                GROUP BY {column}
+                ORDER BY {column}
+            """)
+            rows = cursor.fetchall()
+            nulls = sum(row['trip_count'] for row in rows if row['value'] is None)
+            found[name] = ValueCounts([tuple(row) for row in rows if row['value'] is not None], nulls)
+    else:
+        cursor.execute(f"""
+            SELECT {', '.join(HISTOGRAM_COLUMNS[name] for name in missing)}
+            FROM trips t
+            LEFT JOIN trip_metrics m ON m.trip_rowid = t.trip_rowid
+            WHERE {where}
+        """, params)
+        tallies = [Counter() for _ in missing]
+        while True:
+            rows = cursor.fetchmany(EXPORT_FETCH_ROWS)
+            if not rows:
+                break
+            for tally, values in zip(tallies, zip(*rows)):
+                tally.update(values)
+        for name, tally in zip(missing, tallies):
+            nulls = tally.pop(None, 0)
+            found[name] = ValueCounts(sorted(tally.items()), nulls)
     
-    return jsonify(stats)
+    for name in missing:
+        histogram_cache.put((name, filters.cache_key()), version, found[name])
+    return found
 
-@app.route('/api/stats/distance-distribution')
-def distance_distribution():
-    """Get trip distance ranges"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT 
-            CASE 
-                WHEN distance_km < 1 THEN '0-1 km'
-                WHEN distance_km < 3 THEN '1-3 km'
-                WHEN distance_km < 5 THEN '3-5 km'
-                WHEN distance_km < 10 THEN '5-10 km'
-                WHEN distance_km < 20 THEN '10-20 km'
-                ELSE '20+ km'
-            END as distance_range,
-            COUNT(*) as trip_count
-        FROM trip_metrics
-        WHERE distance_km IS NOT NULL
-        GROUP BY distance_range
-        ORDER BY MIN(distance_km)
-    """)
+def histogram_edges(counts, args, name):
+    """
+    Bucket edges for one column from the query args: {name}_edges, or bins
+    equal-width (method=width) or equal-count (method=quantile) bins
+    spanning the values. Raises ValueError for a bad spec.
+    """
+    edges = args.get(f'{name}_edges')
+    if edges:
+        try:
+            edges = [float(edge) for edge in edges.split(',')]
+        except ValueError:
+            raise ValueError(f"{name}_edges must be comma separated numbers")
+        if len(edges) < 2 or len(edges) > MAX_HISTOGRAM_BINS + 1:
+            raise ValueError(f"{name}_edges must have 2 to {MAX_HISTOGRAM_BINS + 1} edges")
+        if any(low >= high for low, high in zip(edges, edges[1:])):
+            raise ValueError(f"{name}_edges must be increasing")
+        return edges
     
-    stats = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    try:
+        bins = int(args.get('bins', 10))
+    except ValueError:
+        raise ValueError("bins must be a whole number")
+    if not 1 <= bins <= MAX_HISTOGRAM_BINS:
+        raise ValueError(f"bins must be between 1 and {MAX_HISTOGRAM_BINS}")
+    if not counts.total:
+        return []
     
-    return jsonify(stats)
+    method = args.get('method', 'width')
+    low, high = counts.values[0], counts.values[-1]
+    if method == 'width':
+        edges = [low + (high - low) * i / bins for i in range(bins)] + [high]
+    elif method == 'quantile':
+        edges = [low] + [counts.quantile(i / bins) for i in range(1, bins)] + [high]
+    else:
+        raise ValueError(f"Unknown method: {method} (use width or quantile)")
+    # Heavily repeated values can give quantile bins the same edge twice;
+    # when every value is the same, one bucket holds them all
+    edges = sorted(set(round(edge, 6) for edge in edges))
+    return edges if len(edges) > 1 else edges * 2
 
-@app.route('/api/stats/speed-distribution')
-def speed_distribution():
-    """Get trip speed ranges"""
-    conn = get_db()
-    cursor = conn.cursor()
+def histogram_buckets(counts, edges):
+    """
+    Trip counts between consecutive edges, each bucket holding its lower
+    edge and the last one its upper edge too
+    """
+    buckets = []
+    for i, (low, high) in enumerate(zip(edges, edges[1:])):
+        last = i == len(edges) - 2
+        upper = counts.at_most(high) if last else counts.below(high)
+        buckets.append({'min': low, 'max': high, 'trip_count': upper - counts.below(low)})
+    return buckets
+
+def distribution(filters, name):
+    """One of the fixed DISTRIBUTIONS, as the non-empty buckets in order"""
+    label_column, column, buckets = DISTRIBUTIONS[name]
+    counts = value_counts(filters, [column])[column]
+    if buckets is None:
+        rows = [(None, counts.missing)] if counts.missing else []
+        rows += counts.counts()
+        return [{label_column: value, 'trip_count': count} for value, count in rows]
     
-    cursor.execute("""
-        SELECT 
-            CASE 
-                WHEN trip_speed_kmh < 10 THEN '0-10 km/h'
-                WHEN trip_speed_kmh < 20 THEN '10-20 km/h'
-                WHEN trip_speed_kmh < 30 THEN '20-30 km/h'
-                WHEN trip_speed_kmh < 40 THEN '30-40 km/h'
-                ELSE '40+ km/h'
-            END as speed_range,
-            COUNT(*) as trip_count
-        FROM trip_metrics
-        WHERE trip_speed_kmh IS NOT NULL
-        GROUP BY speed_range
-        ORDER BY MIN(trip_speed_kmh)
-    """)
+    rows, previous = [], 0
+    for label, bound in buckets:
+        below = counts.below(bound) if bound is not None else counts.total
+        if below > previous:
+            rows.append({label_column: label, 'trip_count': below - previous})
+        previous = below
+    return rows
+
+@app.route('/api/stats/histogram')
+@cached
+@filtered
+@batch_stat('histogram')
+def histogram(filters):
+    """
+    Histograms of several columns with request-chosen buckets, all from one
+    scan (or none, when the columns' value counts are cached)
+    Query args:
+        columns: Comma separated names from HISTOGRAM_COLUMNS (default: all)
+        {column}_edges: Bucket edges for that column (e.g. duration_edges=0,300,900)
+        bins, method: For columns without edges, how many equal-width
+            (width, the default) or equal-count (quantile) bins
+    """
+    names = request.args.get('columns', ','.join(HISTOGRAM_COLUMNS)).split(',')
+    unknown = [name for name in names if name not in HISTOGRAM_COLUMNS]
+    if unknown:
+        return jsonify({'error': f"Unknown columns: {', '.join(unknown)}",
+                        'available': list(HISTOGRAM_COLUMNS)}), 400
     
-    stats = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    all_counts = value_counts(filters, names)
+    result = {}
+    for name in names:
+        counts = all_counts[name]
+        try:
+            edges = histogram_edges(counts, request.args, name)
+        except ValueError as error:
+            return jsonify({'error': str(error)}), 400
+        result[name] = {
+            'total': counts.total,
+            'missing': counts.missing,
+            'below': counts.below(edges[0]) if edges else 0,
+            'above': counts.total - counts.at_most(edges[-1]) if edges else 0,
+            'buckets': histogram_buckets(counts, edges)
+        }
     
-    return jsonify(stats)
+    return jsonify(result)
+
+@app.route('/api/stats/duration-distribution')
+@cached
+@filtered
+@batch_stat('duration-distribution')
+def duration_distribution(filters):
+    """Get trip duration ranges"""
+    return jsonify(distribution(filters, 'duration'))
+
+@app.route('/api/stats/distance-distribution')
+@cached
+@filtered
+@batch_stat('distance-distribution')
+def distance_distribution(filters):
+    """Get trip distance ranges"""
+    return jsonify(distribution(filters, 'distance'))
+
+@app.route('/api/stats/speed-distribution')
+@cached
+@filtered
+@batch_stat('speed-distribution')
+def speed_distribution(filters):
+    """Get trip speed ranges"""
+    return jsonify(distribution(filters, 'speed'))
 
 @app.route('/api/stats/passenger-distribution')
-def passenger_distribution():
+@cached
+@filtered
+@batch_stat('passenger-distribution')
+def passenger_distribution(filters):
     """Get trips by passenger count"""
-    conn = get_db()
-    cursor = conn.cursor()
+    return jsonify(distribution(filters, 'passenger'))
+
+# Quantiles /api/stats/quantiles reports
+QUANTILES = {'p50': 0.5, 'p90': 0.9, 'p99': 0.99}
+
+# Sketched metric -> (response key, factor from stored to reported units)
+QUANTILE_METRICS = {
+    'duration': ('duration_min', 1 / 60),
+    'distance': ('distance_km', 1),
+    'speed': ('speed_kmh', 1)
+}
+
+def rollup_setting(key):
+    """A setting the loader built the rollup tables with, or None if they predate it"""
+    cursor = get_db().cursor()
+    cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
+    row = cursor.fetchone()
+    return row['value'] if row else None
+
+def sketch_quantiles(filters, accuracy):
+    """
+    Merge the quantile sketches of the filtered hours, vendors and boroughs
+    by adding their bucket counts, then read each quantile off the merged
+    buckets: the bucket holding the trip at that rank, valued at the point
+    within accuracy of everything in it
+    Returns:
+        dict of metric -> {quantile name: value in stored units, or None}
+    """
+    use_plan('sketch')
+    gamma = (1 + accuracy) / (1 - accuracy)
+    where, params = filters.rollup_where()
+    cursor = get_db().cursor()
+    cursor.execute(f"""
+        SELECT metric, bucket, SUM(trip_count) as trip_count
+        FROM quantile_sketches
+        WHERE {where}
+        GROUP BY metric, bucket
+        ORDER BY metric, bucket
+    """, params)
+    buckets = {metric: [] for metric in QUANTILE_METRICS}
+    for row in cursor.fetchall():
+        buckets[row['metric']].append((row['bucket'], row['trip_count']))
     
-    cursor.execute("""
-        SELECT 
-            passenger_count,
-            COUNT(*) as trip_count
-        FROM trips
-        GROUP BY passenger_count
-        ORDER BY passenger_count
-    """)
+    result = {}
+    for metric, counts in buckets.items():
+        total = sum(count for _, count in counts)
+        values = {}
+        for name, fraction in QUANTILES.items():
+            rank, seen = max(1, math.ceil(fraction * total)), 0
+            values[name] = None
+            for bucket, count in counts:
+                seen += count
+                if seen >= rank:
+                    values[name] = 2 * gamma ** bucket / (gamma + 1)
+                    break
+        result[metric] = values
+    return result
+
+@app.route('/api/stats/quantiles')
+@cached
+@filtered
+@batch_stat('quantiles')
+def quantiles(filters):
+    """
+    Median, p90 and p99 of trip duration, distance and speed
+    With at most hour, vendor and borough filters the stored sketches are
+    merged, giving values within their accuracy (1% by default); date and
+    passenger filters, which the sketches aren't kept by, get exact
+    quantiles from the histogram engine's value counts instead.
+    """
+    accuracy = rollup_setting('sketch_accuracy')
+    if accuracy is not None and filters.sketch_compatible():
+        accuracy = float(accuracy)
+        values = sketch_quantiles(filters, accuracy)
+    else:
+        accuracy = 0
+        all_counts = value_counts(filters, list(QUANTILE_METRICS))
+        values = {
+            metric: {
+                name: counts.quantile(fraction) if counts.total else None
+                for name, fraction in QUANTILES.items()
+            }
+            for metric, counts in all_counts.items()
+        }
     
-    stats = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    result = {'relative_accuracy': accuracy}
+    for metric, (key, factor) in QUANTILE_METRICS.items():
+        result[key] = {
+            name: round(value * factor, 2) if value is not None else None
+            for name, value in values[metric].items()
+        }
     
-    return jsonify(stats)
+    return jsonify(result)
 
 # ==================== LOCATION ANALYSIS ROUTES ====================
 
 @app.route('/api/boroughs')
-def borough_stats():
+@cached
+@filtered
+@batch_stat('boroughs')
+def borough_stats(filters):
     """Get trip counts by NYC borough"""
     conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute("""
+    facts, params = trip_facts(filters)
+    cursor.execute(f"""
         SELECT 
-            l.borough,
-            COUNT(t.trip_id) as trip_count
-        FROM trips t
-        JOIN locations l ON t.pickup_location_id = l.location_id
-        WHERE l.borough != 'Unknown'
-        GROUP BY l.borough
+            pickup_borough as borough,
+            SUM(trip_count) as trip_count
+        FROM {facts}
+        WHERE pickup_borough != 'Unknown'
+        GROUP BY pickup_borough
         ORDER BY trip_count DESC
-    """)
+    """, params)
     
     stats = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     
     return jsonify(stats)
 
 @app.route('/api/stats/top-locations')
-def top_locations():
+@cached
+@filtered
+@batch_stat('top-locations')
+def top_locations(filters):
     """Get most popular pickup locations"""
     conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute("""
+    # Count on the pickup_location_id index alone and join only the top 20;
+    # with grid locations these are cells, located at their center
+    where, params = trip_scan(filters)
+    cursor.execute(f"""
         SELECT 
             l.latitude,
             l.longitude,
             l.borough,
-            COUNT(t.trip_id) as trip_count
-        FROM trips t
-        JOIN locations l ON t.pickup_location_id = l.location_id
-        GROUP BY l.location_id
-        ORDER BY trip_count DESC
-        LIMIT 20
-    """)
+            top.trip_count
+        FROM (
+            SELECT pickup_location_id, COUNT(*) as trip_count
+            FROM trips t
+            WHERE {where}
+            GROUP BY pickup_location_id
+            ORDER BY trip_count DESC
+            LIMIT 20
+        ) top
+        JOIN locations l ON top.pickup_location_id = l.location_id
+        ORDER BY top.trip_count DESC
+    """, params)
     
     stats = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     
     return jsonify(stats)
 
 # ==================== DATA QUALITY ROUTES====================
 
+# Largest efficiency sample; trip_samples keeps a fixed number of trips per
+# pickup hour, vendor and borough, so narrow filters can return fewer
+MAX_SAMPLE_SIZE = 5000
+
 @app.route('/api/suspicious')
+@cached
+@batch_stat('suspicious', uses_filters=False)
 def suspicious_trips():
-    """Get flagged suspicious trips"""
+    """Get flagged suspicious trips, optionally only those flagged by one rule"""
     limit = request.args.get('limit', default=50, type=int)
+    reason = request.args.get('reason')
     
     conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute("""
+    cursor.execute("SELECT bit, rule, label FROM suspicious_rules ORDER BY bit")
+    rules = cursor.fetchall()
+    
+    query = """
         SELECT 
             t.trip_id,
             t.pickup_datetime,
             m.trip_speed_kmh,
             m.distance_km,
-            m.suspicious_reason
+            m.suspicious_reason,
+            m.suspicious_flags
         FROM trips t
-        JOIN trip_metrics m ON t.trip_id = m.trip_id
+        JOIN trip_metrics m ON t.trip_rowid = m.trip_rowid
         WHERE m.is_suspicious = 1
-        ORDER BY m.trip_speed_kmh DESC
-        LIMIT ?
-    """, (limit,))
+    """
+    params = []
     
+    if reason:
+        bit = next((rule['bit'] for rule in rules if rule['rule'] == reason), None)
+        if bit is None:
+            return jsonify({'error': f'Unknown reason: {reason}'}), 400
+        query += " AND (m.suspicious_flags & ?) != 0"
+        params.append(bit)
+    
+    query += " ORDER BY m.trip_speed_kmh DESC LIMIT ?"
+    params.append(limit)
+    
+    cursor.execute(query, params)
     trips = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    
+    # Every reason that fired, decoded from the bitmask
+    for trip in trips:
+        flags = trip['suspicious_flags'] or 0
+        trip['reasons'] = [rule['rule'] for rule in rules if flags & rule['bit']]
+    
+    by_reason = suspicious_breakdown(cursor)
     
     return jsonify({
         'count': len(trips),
+        'by_reason': by_reason,
         'suspicious_trips': trips
     })
 
 @app.route('/api/stats/efficiency')
-def trip_efficiency():
-    """Get distance vs duration comparison (sample for scatter plot)"""
+@cached
+@filtered
+@batch_stat('efficiency')
+def trip_efficiency(filters):
+    """
+    Get distance vs duration comparison (sample for scatter plot)
+    Query args:
+        n: Trips in the sample (default 1000, at most MAX_SAMPLE_SIZE)
+        seed: Picks the sample; the same seed and filters give the same trips
+    """
+    n = min(max(request.args.get('n', default=1000, type=int), 1), MAX_SAMPLE_SIZE)
+    seed = request.args.get('seed', default=0, type=int)
+    
     conn = get_db()
     cursor = conn.cursor()
     
-    # Sample 1000 trips for performance
-    cursor.execute("""
+    per_stratum = rollup_setting('sample_per_stratum')
+    if per_stratum is None:
+        # Loaded before trip_samples existed: sort every matching trip by a random key
+        where, params = trip_scan(filters)
+        cursor.execute(f"""
+            SELECT 
+                distance_km,
+                t.trip_duration / 60.0 as duration_minutes,
+                trip_speed_kmh
+            FROM trips t
+            JOIN trip_metrics m ON t.trip_rowid = m.trip_rowid
+            WHERE m.distance_km > 0 
+            AND m.distance_km < 50
+            AND t.trip_duration < 7200
+            AND {where}
+            ORDER BY RANDOM()
+            LIMIT ?
+        """, params + [n])
+        return jsonify([dict(row) for row in cursor.fetchall()])
+    
+    # A stratum's rows stand for all its trips: weight them by how many
+    # trips each one was drawn from, so crowded hours and boroughs keep
+    # their share of the plot
+    use_plan('sample')
+    per_stratum = int(per_stratum)
+    cursor.execute("SELECT pickup_hour, vendor_id, pickup_borough, trip_count FROM sample_strata")
+    weights = {
+        (row['pickup_hour'], row['vendor_id'], row['pickup_borough']):
+            row['trip_count'] / min(row['trip_count'], per_stratum)
+        for row in cursor.fetchall()
+    }
+    
+    where, params = filters.sample_where()
+    cursor.execute(f"""
         SELECT 
+            pickup_hour,
+            vendor_id,
+            pickup_borough,
             distance_km,
-            t.trip_duration / 60.0 as duration_minutes,
+            trip_duration / 60.0 as duration_minutes,
             trip_speed_kmh
-        FROM trips t
-        JOIN trip_metrics m ON t.trip_id = m.trip_id
-        WHERE m.distance_km > 0 
-        AND m.distance_km < 50
-        AND t.trip_duration < 7200
-        ORDER BY RANDOM()
-        LIMIT 1000
-    """)
+        FROM trip_samples
+        WHERE {where}
+        ORDER BY trip_rowid
+    """, params)
+    rows = cursor.fetchall()
     
-    stats = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    # Weighted sampling without replacement (Efraimidis-Spirakis): the n
+    # rows with the largest random() ** (1 / weight)
+    generator = random.Random(seed)
+    keyed = [
+        (generator.random() ** (1 / weights[row['pickup_hour'], row['vendor_id'], row['pickup_borough']]), i)
+        for i, row in enumerate(rows)
+    ]
+    chosen = heapq.nlargest(n, keyed)
+    
+    stats = [
+        {key: rows[i][key] for key in ('distance_km', 'duration_minutes', 'trip_speed_kmh')}
+        for _, i in chosen
+    ]
     
     return jsonify(stats)
 
+# ==================== BATCH ROUTES ====================
+
+# Stats read from trip_facts, which share one scan of the trips in a batch
+FACT_STATS = {'summary', 'vendors', 'hourly', 'daily-patterns', 'monthly-trends', 'rush-hour', 'boroughs'}
+
+# Batch name -> DISTRIBUTIONS key, for the distributions counted together
+DISTRIBUTION_STATS = {
+    'duration-distribution': 'duration',
+    'distance-distribution': 'distance',
+    'speed-distribution': 'speed',
+    'passenger-distribution': 'passenger'
+}
+
+@app.route('/api/batch')
+@cached
+@filtered
+def batch_stats(filters):
+    """
+    Several stats in one response (e.g. ?stats=summary,boroughs,efficiency),
+    each exactly as its own endpoint would return it for the same filters.
+    The stats share one connection, and those reading the same rows share
+    one pass over them: the distributions are counted together, and when
+    the filters need the trips rather than the rollups, the matching trips
+    are aggregated once for every rollup-style stat.
+    """
+    names = list(dict.fromkeys(name for name in request.args.get('stats', '').split(',') if name))
+    unknown = [name for name in names if name not in BATCH_STATS]
+    if not names or unknown:
+        return jsonify({
+            'error': f"Unknown stats: {', '.join(unknown)}" if unknown else 'No stats requested',
+            'available': sorted(BATCH_STATS)
+        }), 400
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    # Read the distributions' columns in one pass; each stat then finds them cached
+    distributions = [DISTRIBUTIONS[DISTRIBUTION_STATS[name]][1] for name in names if name in DISTRIBUTION_STATS]
+    if len(distributions) > 1:
+        value_counts(filters, distributions)
+    
+    # A temporary table of the trips grouped like trip_rollups (the
+    # connection is read-only, but temporary tables live outside the file)
+    shared_facts = not filters.rollup_compatible() and len(FACT_STATS.intersection(names)) > 1
+    if shared_facts:
+        hold_scan_slot()
+        where, params = filters.trip_where()
+        cursor.execute(f"""
+            CREATE TEMP TABLE batch_facts AS
+            SELECT 
+                pickup_date, pickup_hour, vendor_id, pickup_borough,
+                SUM(trip_count) as trip_count,
+                SUM(suspicious_count) as suspicious_count,
+                SUM(sum_duration) as sum_duration,
+                MAX(max_duration) as max_duration,
+                SUM(distance_count) as distance_count,
+                SUM(sum_distance) as sum_distance,
+                MAX(max_distance) as max_distance,
+                SUM(speed_count) as speed_count,
+                SUM(sum_speed) as sum_speed
+            FROM {TRIP_FACTS.format(where=where)}
+            GROUP BY pickup_date, pickup_hour, vendor_id, pickup_borough
+        """, params)
+        g.batch_facts = True
+    
+    try:
+        parts = []
+        for name in names:
+            view, uses_filters = BATCH_STATS[name]
+            response = make_response(view(filters=filters) if uses_filters else view())
+            if response.status_code != 200:
+                return response  # e.g. an unknown suspicious reason
+            parts.append(f"{json.dumps(name)}: {response.get_data(as_text=True)}")
+    finally:
+        if shared_facts:
+            g.pop('batch_facts')
+            cursor.execute("DROP TABLE temp.batch_facts")
+    
+    # The stats' JSON bodies are spliced in as they are, not parsed again
+    return app.response_class('{' + ', '.join(parts) + '}', mimetype='application/json')
+
 # ==================== SERVER STARTUP ====================
 
 if __name__ == '__main__':
@@ -513,5 +1519,7 @@ if __name__ == '__main__':
         print("   - Statistics (summary, vendors, time patterns)")
         print("   - Distributions (duration, distance, speed, passengers)")
         print("   - Location Analysis (boroughs, top locations)")
-        print("   - Data Quality (suspicious trips, efficiency)")    
+        print("   - Data Quality (suspicious trips, efficiency)")
+        print("\n This is the development server; to serve users run wsgi.py")
+        print("   (or gunicorn -c gunicorn.conf.py wsgi:app)")
         app.run(debug=True)
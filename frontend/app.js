@@ -128,6 +128,13 @@ let chart = new Chart(ctx, {
 // API endpoints we currently have
 const API_BASE = "http://127.0.0.1:5000";
 
+// Several stats in one request; the API shares scans between them
+async function fetchBatch(stats) {
+  const response = await fetch(`${API_BASE}/api/batch?stats=${stats.join(",")}`);
+  if (!response.ok) throw new Error(`Batch request failed: ${response.status}`);
+  return response.json();
+}
+
 // ---------------------- STATE ----------------------
 let currentVendor = 'all';
 let currentView = 'daily';
@@ -482,12 +489,9 @@ let timeAnalysisChart = null;
 async function loadTimeAnalysisData() {
   try {
     // Hourly trips
-    const [hourlyRes, rushRes] = await Promise.all([
-      fetch(`${API_BASE}/api/stats/hourly`),
-      fetch(`${API_BASE}/api/stats/rush-hour`)
-    ]);
-    const hourlyData = await hourlyRes.json();
-    const rushData = await rushRes.json();
+    const batch = await fetchBatch(["hourly", "rush-hour"]);
+    const hourlyData = batch["hourly"];
+    const rushData = batch["rush-hour"];
 
     // Transform to existing structure expected by the chart logic
     const data = {
@@ -579,18 +583,14 @@ let tripStatsChart = null;
 async function loadTripStatsData() {
   try {
     // Using distance distribution as example - adjust endpoint as needed
-    const [distRes, summaryRes, passRes, vendorsRes, dailyRes] = await Promise.all([
-      fetch(`${API_BASE}/api/stats/distance-distribution`),
-      fetch(`${API_BASE}/api/stats/summary`),
-      fetch(`${API_BASE}/api/stats/passenger-distribution`),
-      fetch(`${API_BASE}/api/stats/vendors`),
-      fetch(`${API_BASE}/api/stats/daily-patterns`)
+    const batch = await fetchBatch([
+      "distance-distribution", "summary", "passenger-distribution", "vendors", "daily-patterns"
     ]);
-    const data = await distRes.json();
-    const summary = await summaryRes.json();
-    const passengers = await passRes.json();
-    const vendors = await vendorsRes.json();
-    const daily = await dailyRes.json();
+    const data = batch["distance-distribution"];
+    const summary = batch["summary"];
+    const passengers = batch["passenger-distribution"];
+    const vendors = batch["vendors"];
+    const daily = batch["daily-patterns"];
 
     const ctx = document.getElementById("tripStatsChart").getContext("2d");
     
@@ -693,12 +693,9 @@ let dropoffHeatmapChart = null;
 async function loadLocationInsightsData() {
   try {
     // Pickup heatmap
-    const [pickupResponse, boroughsResponse] = await Promise.all([
-      fetch(`${API_BASE}/api/stats/top-locations`),
-      fetch(`${API_BASE}/api/boroughs`)
-    ]);
-    const pickupData = await pickupResponse.json();
-    const boroughsData = await boroughsResponse.json();
+    const batch = await fetchBatch(["top-locations", "boroughs"]);
+    const pickupData = batch["top-locations"];
+    const boroughsData = batch["boroughs"];
 
     const pickupCtx = document.getElementById("pickupHeatmapChart").getContext("2d");
     
@@ -783,18 +780,12 @@ let outlierDataChart = null;
 async function loadDataQualityData() {
   try {
     // High-level summary and supporting datasets
-    const [summaryRes, suspiciousRes, effRes, distRes, boroughsRes] = await Promise.all([
-      fetch(`${API_BASE}/api/stats/summary`),
-      fetch(`${API_BASE}/api/suspicious`),
-      fetch(`${API_BASE}/api/stats/efficiency`),
-      fetch(`${API_BASE}/api/stats/distance-distribution`),
-      fetch(`${API_BASE}/api/boroughs`)
-    ]);
-    const summary = await summaryRes.json();
-    const suspiciousData = await suspiciousRes.json();
-    const effData = await effRes.json();
-    const distData = await distRes.json();
-    const boroughsData = await boroughsRes.json();
+    const batch = await fetchBatch(["summary", "suspicious", "efficiency", "distance-distribution", "boroughs"]);
+    const summary = batch["summary"];
+    const suspiciousData = batch["suspicious"];
+    const effData = batch["efficiency"];
+    const distData = batch["distance-distribution"];
+    const boroughsData = batch["boroughs"];
 
     document.getElementById("totalSuspicious").textContent = summary.suspicious_trips.toLocaleString();
     document.getElementById("cleanTrips").textContent = summary.clean_trips.toLocaleString();
@@ -896,11 +887,10 @@ async function loadDataQualityData() {
       tableBody.appendChild(tr);
     });
 
-    // Suspicious analysis chart: count by reason
+    // Suspicious analysis chart: count by reason (all suspicious trips, every reason that fired)
     const reasonCounts = {};
-    rows.forEach(r => {
-      const key = r.suspicious_reason || 'Unknown';
-      reasonCounts[key] = (reasonCounts[key] || 0) + 1;
+    (suspiciousData.by_reason || []).forEach(r => {
+      reasonCounts[r.label] = r.trip_count;
     });
     const suspAnaCtx = document.getElementById("suspiciousAnalysisChart").getContext("2d");
     if (window._suspiciousAnalysisChart) { window._suspiciousAnalysisChart.destroy(); }
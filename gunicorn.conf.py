@@ -0,0 +1,21 @@
+"""
+Gunicorn settings for serving wsgi:app (see wsgi.py for the environment variables)
+Each worker process keeps its own connection pool and response cache.
+Threads (the gthread worker) suit the API: SQLite releases the GIL while
+it reads, so one process serves several queries at once.
+"""
+
+import os
+
+bind = f"{os.environ.get('API_HOST', '127.0.0.1')}:{os.environ.get('API_PORT', 5000)}"
+workers = int(os.environ.get('API_WORKERS', 2))
+threads = int(os.environ.get('API_THREADS', 8))
+worker_class = 'gthread'
+
+# A slow query waits at most API_SCAN_WAIT for a slot, then runs for a few
+# seconds at worst; streamed exports of every trip take longer
+timeout = 120
+graceful_timeout = 30
+
+# Load the app once in the master so workers share its memory
+preload_app = True
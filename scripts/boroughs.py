@@ -0,0 +1,277 @@
+"""
+Borough Lookup
+Classifies coordinates into NYC boroughs (or any named areas, such as taxi
+zones) by point-in-polygon tests against boundaries from a GeoJSON file,
+shared by the processor and the loader
+"""
+
+import json
+import math
+import os
+from bisect import bisect_right
+
+UNKNOWN_BOROUGH = 'Unknown'
+
+# NYC Department of City Planning borough boundaries (clipped to the
+# shoreline), simplified to within 10 m, shipped with the project
+DEFAULT_BOUNDARIES = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'nyc_boroughs.geojson'
+)
+
+
+def _segment_hits_box(x1, y1, x2, y2, left, bottom, right, top):
+    """Whether a line segment passes through a rectangle (Liang-Barsky clipping)"""
+    start, end = 0.0, 1.0
+    dx, dy = x2 - x1, y2 - y1
+    for p, q in ((-dx, x1 - left), (dx, right - x1), (-dy, y1 - bottom), (dy, top - y1)):
+        if p == 0:
+            if q < 0:
+                return False  # Parallel to this side and outside it
+        else:
+            t = q / p
+            if p < 0:
+                start = max(start, t)
+            else:
+                end = min(end, t)
+            if start > end:
+                return False
+    return True
+
+
+def _crossings(edges, x, y):
+    """Even-odd ray cast: whether (x, y) is inside the rings the edges belong to"""
+    inside = False
+    for x1, y1, x2, y2 in edges:
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+
+def _distance_squared(x1, y1, x2, y2, x, y, x_scale):
+    """Squared distance from (x, y) to a line segment, x differences multiplied by x_scale"""
+    dx, dy = (x2 - x1) * x_scale, y2 - y1
+    px, py = (x - x1) * x_scale, y - y1
+    length = dx * dx + dy * dy
+    t = max(0.0, min(1.0, (px * dx + py * dy) / length)) if length else 0.0
+    ex, ey = px - t * dx, py - t * dy
+    return ex * ex + ey * ey
+
+
+class BoundaryIndex:
+    """
+    Named polygons with a uniform grid index over their bounding box
+    Each grid cell that no polygon edge passes through is answered by one
+    point-in-polygon test when the index is built, so most points cost two
+    multiplications and a list lookup. Only points in cells an edge crosses
+    are ray cast, against the edges of that cell's row. Points outside every
+    area but within snap_degrees of a border, such as piers or GPS noise at
+    the shoreline, go to the nearest area.
+    """
+
+    def __init__(self, path=DEFAULT_BOUNDARIES, name_property='borough', cell_degrees=0.0025,
+                 snap_degrees=0.001):
+        """
+        Args:
+            path: GeoJSON FeatureCollection of Polygon/MultiPolygon features
+                (e.g. the NYC TLC taxi zones file with name_property='zone')
+            name_property: Feature property holding the area's name
+            cell_degrees: Grid cell size; smaller cells mean fewer ray casts
+                but a bigger index
+            snap_degrees: How far off a border (in degrees of latitude,
+                0.001 is about 110 m) a point still goes to the nearest
+                area; 0 leaves every point outside the polygons unknown
+        """
+        self.path = path
+        self.name_property = name_property
+        self.cell_degrees = cell_degrees
+        self.snap_degrees = snap_degrees
+        self.areas = self._read_areas(path, name_property)
+        if not self.areas:
+            raise ValueError(f"No polygons found in {path}")
+        self.names = [name for name, _ in self.areas]
+        self._build_grid()
+
+    @staticmethod
+    def _read_areas(path, name_property):
+        """
+        Read features as (name, edges), edges being (x1, y1, x2, y2) tuples
+        of every ring, holes included (the even-odd rule handles them)
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            collection = json.load(f)
+
+        areas = []
+        for feature in collection['features']:
+            geometry = feature['geometry']
+            if geometry['type'] == 'Polygon':
+                polygons = [geometry['coordinates']]
+            elif geometry['type'] == 'MultiPolygon':
+                polygons = geometry['coordinates']
+            else:
+                continue
+
+            edges = []
+            for polygon in polygons:
+                for ring in polygon:
+                    points = [(float(x), float(y)) for x, y, *_ in ring]
+                    if points[0] != points[-1]:
+                        points.append(points[0])
+                    edges.extend(
+                        (x1, y1, x2, y2)
+                        for (x1, y1), (x2, y2) in zip(points, points[1:])
+                        if y1 != y2 or x1 != x2
+                    )
+            areas.append((str(feature['properties'][name_property]), edges))
+        return areas
+
+    def _build_grid(self):
+        """Resolve every cell to a name, or to the edges needed to classify points inside it"""
+        step = self.cell_degrees
+        snap = self.snap_degrees
+        all_edges = [edge for _, edges in self.areas for edge in edges]
+        self.x_scale = math.cos(math.radians(sum(y1 for _, y1, _, _ in all_edges) / len(all_edges)))
+        snap_x = snap / self.x_scale  # The same distance in degrees of longitude
+
+        # Cover the points just outside the outermost borders too
+        self.left = min(min(x1, x2) for x1, _, x2, _ in all_edges) - snap_x
+        self.bottom = min(min(y1, y2) for _, y1, _, y2 in all_edges) - snap
+        self.right = max(max(x1, x2) for x1, _, x2, _ in all_edges) + snap_x
+        self.top = max(max(y1, y2) for _, y1, _, y2 in all_edges) + snap
+        self.columns = int((self.right - self.left) / step) + 1
+        self.rows = int((self.top - self.bottom) / step) + 1
+        self.inverse_step = 1 / step
+
+        # Visit each edge's cells once: which areas have a border inside each
+        # cell, and which edges are within snap distance of it
+        crossed = [set() for _ in range(self.rows * self.columns)]
+        nearby = [[] for _ in range(self.rows * self.columns)]
+        for index, (name, edges) in enumerate(self.areas):
+            for edge in edges:
+                x1, y1, x2, y2 = edge
+                first_row = int((min(y1, y2) - snap - self.bottom) * self.inverse_step)
+                last_row = int((max(y1, y2) + snap - self.bottom) * self.inverse_step)
+                first_column = int((min(x1, x2) - snap_x - self.left) * self.inverse_step)
+                last_column = int((max(x1, x2) + snap_x - self.left) * self.inverse_step)
+                for row in range(max(first_row, 0), min(last_row, self.rows - 1) + 1):
+                    bottom = self.bottom + row * step
+                    for column in range(max(first_column, 0), min(last_column, self.columns - 1) + 1):
+                        left = self.left + column * step
+                        cell = row * self.columns + column
+                        if _segment_hits_box(*edge, left, bottom, left + step, bottom + step):
+                            crossed[cell].add(index)
+                        if snap and _segment_hits_box(*edge, left - snap_x, bottom - snap,
+                                                      left + step + snap_x, bottom + step + snap):
+                            nearby[cell].append((name, edge))
+
+        self.cells = []
+        for row in range(self.rows):
+            bottom = self.bottom + row * step
+            top = bottom + step
+            center_y = bottom + step / 2
+
+            # Edges a horizontal ray from this row can cross, per area
+            row_edges = [
+                [edge for edge in edges if min(edge[1], edge[3]) <= top and max(edge[1], edge[3]) >= bottom]
+                for _, edges in self.areas
+            ]
+            # Where each area's border crosses the line through the cell centers
+            center_crossings = [
+                sorted(x1 + (center_y - y1) * (x2 - x1) / (y2 - y1)
+                       for x1, y1, x2, y2 in edges if (y1 > center_y) != (y2 > center_y))
+                for edges in row_edges
+            ]
+
+            for column in range(self.columns):
+                left = self.left + column * step
+                cell = row * self.columns + column
+
+                # (name, edges) of areas with a border inside this cell; a ray
+                # only needs edges that reach the right of the cell's left side
+                crossing = [
+                    (self.names[index], [edge for edge in row_edges[index] if max(edge[0], edge[2]) >= left])
+                    for index in sorted(crossed[cell])
+                ]
+
+                # Whole-cell answer: the area containing the cell center, if any
+                # (for an uncrossed cell this is the answer for every point in it)
+                center_x = left + step / 2
+                fallback = next(
+                    (self.names[index] for index, crossings in enumerate(center_crossings)
+                     if index not in crossed[cell] and (len(crossings) - bisect_right(crossings, center_x)) % 2),
+                    UNKNOWN_BOROUGH
+                )
+
+                # Edges to snap to, only needed where a point can miss every area
+                near = nearby[cell] if fallback == UNKNOWN_BOROUGH else []
+                self.cells.append((crossing, fallback, near) if crossing or near else fallback)
+
+    def classify(self, lat, lon):
+        """Name of the area containing a point (UNKNOWN_BOROUGH if none)"""
+        if not (self.bottom <= lat < self.top and self.left <= lon < self.right):
+            return UNKNOWN_BOROUGH  # Also catches NaN
+        cell = self.cells[int((lat - self.bottom) * self.inverse_step) * self.columns +
+                          int((lon - self.left) * self.inverse_step)]
+        if cell.__class__ is str:
+            return cell
+        return self._classify_in_cell(cell, lat, lon)
+
+    def classify_many(self, lats, lons):
+        """
+        Classify whole coordinate columns
+        Args:
+            lats: Sequence of latitudes
+            lons: Sequence of longitudes (same length)
+        Returns:
+            list of area names, UNKNOWN_BOROUGH where no area contains the point
+        """
+        bottom, top, left, right = self.bottom, self.top, self.left, self.right
+        inverse_step, columns, cells = self.inverse_step, self.columns, self.cells
+        classify_in_cell = self._classify_in_cell
+
+        names = []
+        append = names.append
+        for lat, lon in zip(lats, lons):
+            if bottom <= lat < top and left <= lon < right:
+                cell = cells[int((lat - bottom) * inverse_step) * columns + int((lon - left) * inverse_step)]
+                append(cell if cell.__class__ is str else classify_in_cell(cell, lat, lon))
+            else:
+                append(UNKNOWN_BOROUGH)
+        return names
+
+    def _classify_in_cell(self, cell, lat, lon):
+        """Ray cast a point against the areas whose border crosses its cell"""
+        crossing, fallback, near = cell
+        for name, edges in crossing:
+            if _crossings(edges, lon, lat):
+                return name
+        if near:
+            # Outside every area: take the closest border if it is within snap distance
+            distance, name = min((_distance_squared(*edge, lon, lat, self.x_scale), name) for name, edge in near)
+            if distance <= self.snap_degrees ** 2:
+                return name
+        return fallback
+
+
+# Built on first use so importing this module stays cheap
+_default_index = None
+
+
+def default_index():
+    """BoundaryIndex over the shipped borough boundaries"""
+    global _default_index
+    if _default_index is None:
+        _default_index = BoundaryIndex()
+    return _default_index
+
+
+def identify_borough(lat, lon):
+    """
+    Classify coordinates into NYC boroughs
+    Uses the borough polygons in data/nyc_boroughs.geojson
+    """
+    return default_index().classify(lat, lon)
+
+
+def classify_boroughs(lats, lons):
+    """Borough of every point in two coordinate columns (see BoundaryIndex.classify_many)"""
+    return default_index().classify_many(lats, lons)
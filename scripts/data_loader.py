@@ -7,19 +7,221 @@ import sqlite3
 import csv
 import sys
 import os
+import time
+import argparse
+import hashlib
+import itertools
+import math
+from timestamps import MISSING_EPOCH, parse_timestamp, hour_of, weekday_of, month_of  # Fast fixed-format timestamp parser
+from boroughs import classify_boroughs
+from location_keys import DEFAULT_SCHEME, make_scheme
+from suspicious_rules import SUSPICIOUS_RULES, load_rules
+from trip_batch import parse_int, valid_ints
+
+# Raw coordinate columns of a trip when they aren't kept
+NO_COORDINATES = (None, None, None, None)
+
+# Bumped when the rollup tables change shape; databases holding an older
+# version get their rollups rebuilt when the loader opens them
+ROLLUP_VERSION = 4
+
+# Relative error of the quantile sketches' values (1%); stored in the
+# settings table so the API reads the buckets with the same gamma
+SKETCH_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+
+# Smaller values (zero distances) are counted as this, which is off by
+# at most 10 m, 0.01 s or 0.01 km/h
+SKETCH_MIN_VALUE = 0.01
+
+# Sketched metric -> its column in the rollup queries
+SKETCH_METRICS = {
+    'duration': 't.trip_duration',
+    'distance': 'm.distance_km',
+    'speed': 'm.trip_speed_kmh'
+}
+
+# Trips kept in trip_samples per pickup hour, vendor and borough
+SAMPLE_PER_STRATUM = 100
+
+# Trips the efficiency scatter plots (and so the only ones sampled)
+SAMPLE_CONDITION = "m.distance_km > 0 AND m.distance_km < 50 AND t.trip_duration < 7200"
+
+# Settings the rollup tables are built with; changing one rebuilds them
+ROLLUP_SETTINGS = {
+    'sketch_accuracy': str(SKETCH_ACCURACY),
+    'sample_per_stratum': str(SAMPLE_PER_STRATUM)
+}
+
+
+def pickup_time_columns(epoch):
+    """(pickup_epoch, pickup_hour, pickup_weekday, pickup_month) of a trip"""
+    return (epoch, hour_of(epoch), weekday_of(epoch), month_of(epoch))
+
+def sketch_bucket(value):
+    """Quantile sketch bucket of a value: the smallest i with value <= SKETCH_GAMMA ** i"""
+    return math.ceil(math.log(max(value, SKETCH_MIN_VALUE), SKETCH_GAMMA))
+
+def sample_key(trip_rowid):
+    """Pseudo-random but fixed 63-bit key of a trip, so rebuilds pick the same sample"""
+    digest = hashlib.blake2b(trip_rowid.to_bytes(8, 'little'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') >> 1
 
 class DataLoader:
     """Loads cleaned CSV data into normalized database"""
     
-    def __init__(self, db_path='database/nyc_taxi.db'):
+    # Tables whose secondary indexes are dropped during a bulk load
+    BULK_TABLES = ('trips', 'trip_metrics')
+    
+    # Pragmas for a bulk load: no fsync, WAL journal, ~256 MB page cache
+    BULK_PRAGMAS = [
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = OFF",
+        "PRAGMA cache_size = -262144",
+        "PRAGMA temp_store = MEMORY"
+    ]
+    
+    def __init__(self, db_path='database/nyc_taxi.db', location_scheme=None, keep_raw_coordinates=False):
         """
         Initialize database connection
         Args:
             db_path: Path to SQLite database
+            location_scheme: How coordinates become locations: 'grid:<meters>',
+                'geohash:<chars>' or 'raw' (default: what the database already
+                uses, DEFAULT_SCHEME for a new one)
+            keep_raw_coordinates: Also store the exact coordinates on each trip
         """
         self.connection = sqlite3.connect(db_path)
+        self.connection.create_function('sketch_bucket', 1, sketch_bucket, deterministic=True)
+        self.connection.create_function('sample_key', 1, sample_key, deterministic=True)
         self.cursor = self.connection.cursor()
-        self.location_cache = {}  # Cache location IDs to avoid duplicates
+        self.location_cache = {}  # Location key -> location ID, to avoid duplicates
+        
+        self.location_scheme = self._resolve_location_scheme(location_scheme)
+        self.location_index = make_scheme(self.location_scheme)  # None for 'raw'
+        self.keep_raw_coordinates = keep_raw_coordinates
+        
+        # Filled in by load_trips()/load_trip_batch() for reports and the ingest log
+        self.reset_load_stats()
+        
+        # Set between start_bulk_load() and finish_bulk_load()
+        self.bulk = None
+        
+        # Rollups are only added to as trips arrive, so trips loaded before
+        # the tables existed (or changed) have to be counted once first
+        self.cursor.execute("SELECT key, value FROM settings")
+        settings = dict(self.cursor.fetchall())
+        stored_version = int(settings.get('rollup_version', 0))
+        if any(settings.get(key, value) != value for key, value in ROLLUP_SETTINGS.items()):
+            stored_version = 0  # Built with other sketch or sample settings
+        self.cursor.execute("""
+            SELECT EXISTS (SELECT 1 FROM trips), EXISTS (SELECT 1 FROM trip_rollups)
+        """)
+        has_trips, has_rollups = self.cursor.fetchone()
+        if has_trips and (stored_version < ROLLUP_VERSION or not has_rollups):
+            self.rebuild_rollups()
+        elif stored_version < ROLLUP_VERSION:
+            self._set_rollup_version()
+            self.connection.commit()
+    
+    def _resolve_location_scheme(self, requested):
+        """
+        Pick the location scheme and record it in the settings table
+        Location IDs only mean something under one scheme, so a database
+        keeps the scheme it was first loaded with
+        Returns:
+            The scheme in its text form (e.g. 'grid:100')
+        """
+        self.cursor.execute("SELECT value FROM settings WHERE key = 'location_scheme'")
+        row = self.cursor.fetchone()
+        stored = row[0] if row else None
+        
+        if stored is None:
+            # Databases loaded before location schemes existed hold raw coordinates
+            self.cursor.execute("SELECT EXISTS (SELECT 1 FROM locations)")
+            if self.cursor.fetchone()[0]:
+                stored = 'raw'
+        
+        if requested is not None:
+            scheme = make_scheme(requested)
+            requested = 'raw' if scheme is None else scheme.spec()
+            if stored is not None and requested != stored:
+                raise ValueError(
+                    f"Database locations use '{stored}', not '{requested}'; "
+                    "load into a new database to change the location scheme"
+                )
+        
+        scheme = stored or requested or DEFAULT_SCHEME
+        self.cursor.execute("""
+            INSERT OR REPLACE INTO settings (key, value) VALUES ('location_scheme', ?)
+        """, (scheme,))
+        self.connection.commit()
+        return scheme
+    
+    def start_bulk_load(self, commit_rows=200000):
+        """
+        Switch to the bulk-load fast path
+        Secondary indexes on trips and trip_metrics are dropped (their SQL
+        is kept to rebuild them), durability pragmas are relaxed and inserts
+        are committed every commit_rows rows instead of every batch.
+        UNIQUE constraints stay, so INSERT OR IGNORE still skips duplicates.
+        Only use on a database nobody else is writing to; a crash mid-load
+        can corrupt it with synchronous = OFF.
+        Args:
+            commit_rows: Rows per transaction
+        """
+        
+        print("Starting bulk load...")
+        self.connection.commit()
+        
+        # Remember current settings so finish_bulk_load() can restore them
+        journal_mode = self.cursor.execute("PRAGMA journal_mode").fetchone()[0]
+        synchronous = self.cursor.execute("PRAGMA synchronous").fetchone()[0]
+        
+        # Indexes created by CREATE INDEX (sql is NULL for UNIQUE/PK autoindexes)
+        placeholders = ', '.join('?' for _ in self.BULK_TABLES)
+        self.cursor.execute(f"""
+            SELECT name, sql FROM sqlite_master
+            WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({placeholders})
+        """, self.BULK_TABLES)
+        indexes = self.cursor.fetchall()
+        
+        for name, _ in indexes:
+            self.cursor.execute(f'DROP INDEX IF EXISTS "{name}"')
+        for pragma in self.BULK_PRAGMAS:
+            self.cursor.execute(pragma)
+        
+        self.bulk = {
+            'indexes': indexes,
+            'journal_mode': journal_mode,
+            'synchronous': synchronous,
+            'commit_rows': commit_rows,
+            'uncommitted_rows': 0
+        }
+        print(f"   Deferred {len(indexes)} indexes")
+    
+    def finish_bulk_load(self):
+        """Commit, rebuild the deferred indexes, trim trip_samples, ANALYZE and restore the pragmas"""
+        
+        if self.bulk is None:
+            return
+        
+        print("Finishing bulk load...")
+        self.connection.commit()
+        
+        started = time.perf_counter()
+        for _, sql in self.bulk['indexes']:
+            self.cursor.execute(sql)
+        if self.bulk.get('untrimmed_samples'):
+            self._trim_samples()
+        self.cursor.execute("ANALYZE")
+        self.connection.commit()
+        print(f"   Rebuilt {len(self.bulk['indexes'])} indexes and ran ANALYZE "
+              f"in {time.perf_counter() - started:.1f}s")
+        
+        self.cursor.execute(f"PRAGMA journal_mode = {self.bulk['journal_mode']}")
+        self.cursor.execute(f"PRAGMA synchronous = {self.bulk['synchronous']}")
+        self.bulk = None
         
     def load_vendors(self):
         """Insert vendor (taxi company) master data"""
@@ -42,6 +244,51 @@ class DataLoader:
         self.connection.commit()
         print(f"   Loaded {len(vendors)} vendors")
     
+    def reset_load_stats(self):
+        """Start counting rows, inserts and time for a new load"""
+        self.load_started = time.perf_counter()
+        self.load_stats = {
+            'rows_read': 0,
+            'rows_inserted': 0,
+            'max_pickup_datetime': None,
+            'seconds': 0.0,
+            'rows_per_sec': None
+        }
+    
+    def _update_load_stats(self, rows_read, rows_inserted, max_pickup_datetime):
+        """Add a batch to the running load statistics"""
+        stats = self.load_stats
+        stats['rows_read'] += rows_read
+        stats['rows_inserted'] += rows_inserted
+        if max_pickup_datetime is not None and (
+                stats['max_pickup_datetime'] is None or max_pickup_datetime > stats['max_pickup_datetime']):
+            stats['max_pickup_datetime'] = max_pickup_datetime
+        
+        elapsed = time.perf_counter() - self.load_started
+        stats['seconds'] = round(elapsed, 3)
+        stats['rows_per_sec'] = round(stats['rows_read'] / elapsed) if elapsed > 0 else None
+    
+    def load_suspicious_rules(self, rules=None):
+        """
+        Store what each bit of trip_metrics.suspicious_flags means
+        Args:
+            rules: Rule definitions used by data_processor.py
+                (defaults to suspicious_rules.SUSPICIOUS_RULES)
+        """
+        
+        print("Loading suspicious rules...")
+        
+        rules = SUSPICIOUS_RULES if rules is None else rules
+        self.cursor.execute("DELETE FROM suspicious_rules")
+        self.cursor.executemany("""
+            INSERT INTO suspicious_rules (bit, rule, label)
+            VALUES (?, ?, ?)
+        """, [(1 << i, rule['name'], rule['label']) for i, rule in enumerate(rules)])
+        self._bump_data_version()
+        
+        self.connection.commit()
+        print(f"   Loaded {len(rules)} suspicious rules")
+    
     def load_locations(self, csv_path):
         """
         Extract and load unique locations from trips
@@ -49,81 +296,121 @@ class DataLoader:
             csv_path: Path to cleaned CSV file
         """
         
-        print("Loading locations...")
-        
-        # Read CSV and extract unique coordinates
-        unique_locations = {}  # Use dict to track unique coords
-        
-        with open(csv_path, 'r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            
-            for row in reader:
-                # Get pickup coordinates
-                pickup_key = (
-                    float(row['pickup_latitude']), 
-                    float(row['pickup_longitude'])
-                )
-                unique_locations[pickup_key] = True
-                
-                # Get dropoff coordinates
-                dropoff_key = (
-                    float(row['dropoff_latitude']), 
-                    float(row['dropoff_longitude'])
-                )
-                unique_locations[dropoff_key] = True
+        print(f"Loading locations ({self.location_scheme})...")
         
-        # Prepare location data with borough
-        location_data = []
-        for (lat, lon) in unique_locations.keys():
-            borough = self._identify_borough(lat, lon)
-            location_data.append((lat, lon, borough))
+        def points():
+            """(key, lat, lon) for the pickup and dropoff of every row"""
+            with open(csv_path, 'r', encoding='utf-8') as file:
+                for row in csv.DictReader(file):
+                    for prefix in ('pickup', 'dropoff'):
+                        lat = float(row[f'{prefix}_latitude'])
+                        lon = float(row[f'{prefix}_longitude'])
+                        yield self._location_key(lat, lon), lat, lon
         
-        # Insert into database
-        self.cursor.executemany("""
-            INSERT OR IGNORE INTO locations (latitude, longitude, borough)
-            VALUES (?, ?, ?)
-        """, location_data)
+        added = self._register_locations(points())
         
         self.connection.commit()
-        print(f"   Loaded {len(location_data)} unique locations")
-        
-        # Build cache for fast lookup
-        self._build_location_cache()
+        print(f"   Loaded {added} new locations")
     
-    def _identify_borough(self, lat, lon):
+    def _location_key(self, lat, lon):
+        """Key of the location a point belongs to (cell ID, or rounded coordinates for 'raw')"""
+        if self.location_index is None:
+            return (round(lat, 8), round(lon, 8))  # Round coordinates to match CSV precision
+        return self.location_index.key(lat, lon)
+    
+    def _location_keys(self, lats, lons):
+        """_location_key for whole columns of coordinates"""
+        if self.location_index is None:
+            return [(round(lat, 8), round(lon, 8)) for lat, lon in zip(lats, lons)]
+        return list(map(self.location_index.key, lats, lons))
+    
+    def _register_locations(self, points):
         """
-        Classify coordinates into NYC boroughs
-        Uses approximate geographic boundaries
+        Insert the locations of points not yet in location_cache and cache their IDs
+        Only locations this load touches are looked up, so an incremental
+        load doesn't read back the whole table
+        Args:
+            points: Iterable of (key, lat, lon) with key from _location_key
+        Returns:
+            Number of locations that were not cached yet
         """
-        # Manhattan: roughly 40.70-40.88°N, -74.02 to -73.91°W
-        if 40.70 <= lat <= 40.88 and -74.02 <= lon <= -73.91:
-            return 'Manhattan'
+        cache = self.location_cache
+        new_locations = {}
+        for key, lat, lon in points:
+            if key not in cache and key not in new_locations:
+                new_locations[key] = (lat, lon)
         
-        # Brooklyn: roughly 40.57-40.74°N, -74.05 to -73.85°W
-        elif 40.57 <= lat <= 40.74 and -74.05 <= lon <= -73.85:
-            return 'Brooklyn'
+        if not new_locations:
+            return 0
         
-        # Queens: roughly 40.54-40.80°N, -73.96 to -73.70°W
-        elif 40.54 <= lat <= 40.80 and -73.96 <= lon <= -73.70:
-            return 'Queens'
+        if self.location_index is None:
+            self._insert_locations(new_locations.values())
+            self._build_location_cache(new_locations.values())
+        else:
+            self._insert_cells(new_locations)
+        return len(new_locations)
+    
+    def _insert_cells(self, keys):
+        """
+        Insert grid/geohash cells, using the cell ID as location_id
+        Cells are stored at their center, which is also what the borough
+        is looked up from, so a cell's row doesn't depend on which trip
+        happened to be loaded first
+        """
+        keys = list(keys)
+        lats, lons = zip(*map(self.location_index.center, keys))
+        location_data = list(zip(keys, lats, lons, classify_boroughs(lats, lons)))
         
-        # Bronx: roughly 40.79-40.92°N, -73.93 to -73.75°W
-        elif 40.79 <= lat <= 40.92 and -73.93 <= lon <= -73.75:
-            return 'Bronx'
+        self.cursor.executemany("""
+            INSERT OR IGNORE INTO locations (location_id, latitude, longitude, borough)
+            VALUES (?, ?, ?, ?)
+        """, location_data)
         
-        # Staten Island: roughly 40.50-40.65°N, -74.26 to -74.05°W
-        elif 40.50 <= lat <= 40.65 and -74.26 <= lon <= -74.05:
-            return 'Staten Island'
+        # The ID is the key itself, so there is nothing to read back
+        for key in keys:
+            self.location_cache[key] = key
+    
+    def _insert_locations(self, coordinates):
+        """Insert (lat, lon) pairs with their borough, ignoring known ones"""
         
-        else:
-            return 'Unknown'
+        # Prepare location data with borough (classified as one batch)
+        lats, lons = zip(*coordinates)
+        location_data = list(zip(lats, lons, classify_boroughs(lats, lons)))
+        
+        # Insert into database
+        self.cursor.executemany("""
+            INSERT OR IGNORE INTO locations (latitude, longitude, borough)
+            VALUES (?, ?, ?)
+        """, location_data)
     
-    def _build_location_cache(self):
-        """Create dictionary mapping coordinates to location IDs"""
+    def _build_location_cache(self, coordinates=None):
+        """
+        Create dictionary mapping coordinates to location IDs
+        Args:
+            coordinates: Only look up these (lat, lon) pairs (default: every location)
+        """
         
-        self.cursor.execute("""
-            SELECT location_id, latitude, longitude FROM locations
-        """)
+        if coordinates is None:
+            self.cursor.execute("""
+                SELECT location_id, latitude, longitude FROM locations
+            """)
+        else:
+            # Join through a temp table so the UNIQUE(latitude, longitude) index is used
+            self.cursor.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS wanted_locations (
+                    latitude REAL NOT NULL,
+                    longitude REAL NOT NULL
+                )
+            """)
+            self.cursor.execute("DELETE FROM wanted_locations")
+            self.cursor.executemany("""
+                INSERT INTO wanted_locations (latitude, longitude) VALUES (?, ?)
+            """, coordinates)
+            self.cursor.execute("""
+                SELECT l.location_id, l.latitude, l.longitude
+                FROM wanted_locations w
+                JOIN locations l ON l.latitude = w.latitude AND l.longitude = w.longitude
+            """)
         
         for loc_id, lat, lon in self.cursor.fetchall():
             # Round coordinates to match CSV precision
@@ -139,10 +426,13 @@ class DataLoader:
         """
         
         print("Loading trips (this may take a while)...")
+        self.reset_load_stats()
         
         trips_batch = []
         metrics_batch = []
         row_count = 0
+        inserted_count = 0
+        max_pickup_datetime = None
         
         with open(csv_path, 'r', encoding='utf-8') as file:
             reader = csv.DictReader(file)
@@ -156,49 +446,62 @@ class DataLoader:
                 
                 try:
                     # Get location IDs from cache
-                    pickup_key = (
-                        round(float(row['pickup_latitude']), 8),
-                        round(float(row['pickup_longitude']), 8)
-                    )
-                    dropoff_key = (
-                        round(float(row['dropoff_latitude']), 8),
-                        round(float(row['dropoff_longitude']), 8)
+                    coordinates = (
+                        float(row['pickup_latitude']),
+                        float(row['pickup_longitude']),
+                        float(row['dropoff_latitude']),
+                        float(row['dropoff_longitude'])
                     )
                     
-                    pickup_loc_id = self.location_cache.get(pickup_key)
-                    dropoff_loc_id = self.location_cache.get(dropoff_key)
+                    pickup_loc_id = self.location_cache.get(self._location_key(*coordinates[:2]))
+                    dropoff_loc_id = self.location_cache.get(self._location_key(*coordinates[2:]))
                     
-                    if not pickup_loc_id or not dropoff_loc_id:
+                    if pickup_loc_id is None or dropoff_loc_id is None:
                         continue  # Skip if location not found
                     
+                    pickup_epoch = self._pickup_epoch(row)
+                    if pickup_epoch is None:
+                        continue  # Skip if the pickup time is unreadable
+                    
+                    vendor_id = parse_int(row['vendor_id'])
+                    passenger_count = parse_int(row.get('passenger_count', '1'))
+                    trip_duration = parse_int(row['trip_duration'])
+                    if not valid_ints(vendor_id, passenger_count, trip_duration):
+                        continue  # Skip if a number is empty or unreadable
+                    
                     # Prepare trip data
                     trip = (
                         row['id'],
-                        int(float(row['vendor_id'])),
+                        vendor_id,
                         row['pickup_datetime'],
                         row['dropoff_datetime'],
-                        int(float(row.get('passenger_count', 1))),
+                        passenger_count,
                         pickup_loc_id,
                         dropoff_loc_id,
                         row.get('store_and_fwd_flag', 'N'),
-                        int(float(row['trip_duration']))
-                    )
+                        trip_duration
+                    ) + pickup_time_columns(pickup_epoch) + (
+                        coordinates if self.keep_raw_coordinates else NO_COORDINATES)
                     trips_batch.append(trip)
                     
-                    # Prepare metrics data
+                    if max_pickup_datetime is None or row['pickup_datetime'] > max_pickup_datetime:
+                        max_pickup_datetime = row['pickup_datetime']
+                    
+                    # Prepare metrics data (trip_id last, see _insert_batch)
                     metric = (
-                        row['id'],
                         float(row['distance_km']) if row['distance_km'] else None,
                         float(row['trip_speed_kmh']) if row['trip_speed_kmh'] else None,
                         float(row['fare_per_km']) if row.get('fare_per_km', '').strip() else None,
                         int(row.get('is_suspicious', 0)),
-                        row.get('suspicious_reason', '')
+                        row.get('suspicious_reason', ''),
+                        int(row.get('suspicious_flags') or 0),
+                        row['id']
                     )
                     metrics_batch.append(metric)
                     
                     # Insert batch when it reaches batch_size
                     if len(trips_batch) >= batch_size:
-                        self._insert_batch(trips_batch, metrics_batch)
+                        inserted_count += self._insert_batch(trips_batch, metrics_batch)
                         trips_batch = []
                         metrics_batch = []
                         
@@ -208,31 +511,353 @@ class DataLoader:
         
         # Insert remaining records
         if trips_batch:
-            self._insert_batch(trips_batch, metrics_batch)
+            inserted_count += self._insert_batch(trips_batch, metrics_batch)
+        
+        if self.bulk is not None:
+            self.connection.commit()
+        
+        self._update_load_stats(row_count, inserted_count, max_pickup_datetime)
         
         print(f"   Loaded {row_count} trips with metrics")
+        print(f"   {self.load_stats['seconds']:.1f}s, {self.load_stats['rows_per_sec'] or 0:,} rows/sec")
+    
+    def load_trip_batch(self, batch):
+        """
+        Load one cleaned TripBatch straight from DataProcessor
+        New locations and the trips are written in the same pass, and the
+        values are already typed, so there is no CSV to write or re-parse.
+        Call reset_load_stats() before the first batch of a load.
+        Args:
+            batch: TripBatch as passed to the sinks of DataProcessor.process_stream
+        """
+        
+        pickup_lats, pickup_lons = batch['pickup_latitude'], batch['pickup_longitude']
+        dropoff_lats, dropoff_lons = batch['dropoff_latitude'], batch['dropoff_longitude']
+        cache = self.location_cache
+        pickup_keys = self._location_keys(pickup_lats, pickup_lons)
+        dropoff_keys = self._location_keys(dropoff_lats, dropoff_lons)
+        
+        # Only locations not seen in earlier batches need the database
+        self._register_locations(itertools.chain(
+            zip(pickup_keys, pickup_lats, pickup_lons),
+            zip(dropoff_keys, dropoff_lats, dropoff_lons)
+        ))
+        
+        store_flags = batch['store_and_fwd_flag'] if 'store_and_fwd_flag' in batch else itertools.repeat('N')
+        
+        trips_batch = []
+        metrics_batch = []
+        max_pickup_datetime = None
+        
+        for (trip_id, vendor_id, pickup_datetime, dropoff_datetime, passenger_count,
+             pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, pickup_key, dropoff_key,
+             store_and_fwd_flag, trip_duration,
+             pickup_epoch, distance_km, trip_speed_kmh, fare_per_km,
+             is_suspicious, suspicious_reason, suspicious_flags) in zip(
+                batch['id'], batch['vendor_id'], batch['pickup_datetime'], batch['dropoff_datetime'],
+                batch['passenger_count'], pickup_lats, pickup_lons, dropoff_lats, dropoff_lons,
+                pickup_keys, dropoff_keys, store_flags, batch['trip_duration'], batch['pickup_epoch'],
+                batch['distance_km'], batch['trip_speed_kmh'], batch['fare_per_km'],
+                batch['is_suspicious'], batch['suspicious_reason'], batch['suspicious_flags']):
+            
+            pickup_loc_id = cache.get(pickup_key)
+            dropoff_loc_id = cache.get(dropoff_key)
+            
+            if pickup_loc_id is None or dropoff_loc_id is None:
+                continue  # Skip if location not found
+            if pickup_epoch == MISSING_EPOCH:
+                continue  # Skip if the pickup time is unreadable, like load_trips
+            if not valid_ints(vendor_id, passenger_count, trip_duration):
+                continue  # Skip if a number was empty or unreadable, like load_trips
+            
+            trips_batch.append((
+                trip_id, vendor_id, pickup_datetime, dropoff_datetime, passenger_count,
+                pickup_loc_id, dropoff_loc_id, store_and_fwd_flag, trip_duration
+            ) + pickup_time_columns(pickup_epoch) + ((pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
+                 if self.keep_raw_coordinates else NO_COORDINATES))
+            metrics_batch.append((
+                distance_km, trip_speed_kmh,
+                fare_per_km if fare_per_km == fare_per_km else None,  # NaN -> NULL
+                is_suspicious, suspicious_reason, suspicious_flags, trip_id
+            ))
+            
+            if max_pickup_datetime is None or pickup_datetime > max_pickup_datetime:
+                max_pickup_datetime = pickup_datetime
+        
+        inserted_count = self._insert_batch(trips_batch, metrics_batch) if trips_batch else 0
+        self._update_load_stats(len(batch), inserted_count, max_pickup_datetime)
+    
+    def _pickup_epoch(self, row):
+        """
+        Pickup time as epoch seconds (None if unreadable)
+        Uses the column precomputed by data_processor.py when present and
+        only parses the timestamp string for older CSV files. The dropoff
+        time is stored as text only, so an unreadable one doesn't matter.
+        """
+        if row.get('pickup_epoch'):
+            return int(row['pickup_epoch'])
+        return parse_timestamp(row['pickup_datetime'])
     
     def _insert_batch(self, trips_data, metrics_data):
-        """Insert a batch of trips and their metrics"""
+        """
+        Insert a batch of trips and their metrics, returning how many trips were new
+        Args:
+            trips_data: Tuples in the column order of the trips INSERT
+            metrics_data: (distance_km, trip_speed_kmh, fare_per_km, is_suspicious,
+                suspicious_reason, suspicious_flags, trip_id) tuples
+        """
+        
+        self.cursor.execute("SELECT COALESCE(MAX(rowid), 0) FROM trips")
+        rowid_before = self.cursor.fetchone()[0]
         
         # Insert trips
         self.cursor.executemany("""
             INSERT OR IGNORE INTO trips 
             (trip_id, vendor_id, pickup_datetime, dropoff_datetime,
              passenger_count, pickup_location_id, dropoff_location_id,
-             store_and_fwd_flag, trip_duration)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+             store_and_fwd_flag, trip_duration,
+             pickup_epoch, pickup_hour, pickup_weekday, pickup_month,
+             pickup_latitude, pickup_longitude, dropoff_latitude, dropoff_longitude)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """, trips_data)
+        inserted = self.cursor.rowcount  # Rows already present are ignored
         
-        # Insert metrics
+        # Insert metrics under their trip's integer key; trips that were
+        # rejected (e.g. by a CHECK constraint) get no metrics row
         self.cursor.executemany("""
             INSERT OR IGNORE INTO trip_metrics 
-            (trip_id, distance_km, trip_speed_kmh, fare_per_km,
-             is_suspicious, suspicious_reason)
-            VALUES (?, ?, ?, ?, ?, ?)
+            (trip_rowid, distance_km, trip_speed_kmh, fare_per_km,
+             is_suspicious, suspicious_reason, suspicious_flags)
+            SELECT trip_rowid, ?, ?, ?, ?, ?, ?
+            FROM trips WHERE trip_id = ?
         """, metrics_data)
         
+        if inserted:
+            self._update_rollups(rowid_before)
+            self._bump_data_version()
+        
+        if self.bulk is None:
+            self.connection.commit()
+        else:
+            # Bulk loads commit in large transactions
+            self.bulk['uncommitted_rows'] += len(trips_data)
+            if self.bulk['uncommitted_rows'] >= self.bulk['commit_rows']:
+                self.connection.commit()
+                self.bulk['uncommitted_rows'] = 0
+        return inserted
+    
+    def _update_rollups(self, after_rowid=0):
+        """
+        Add trips with a rowid above after_rowid to trip_rollups
+        New trips always get rowids above the previous maximum, so trips
+        skipped as already loaded are never counted twice
+        """
+        self.cursor.execute("""
+            INSERT INTO trip_rollups
+            (pickup_date, pickup_hour, vendor_id, pickup_borough,
+             trip_count, suspicious_count, sum_duration, max_duration,
+             distance_count, sum_distance, max_distance, speed_count, sum_speed)
+            SELECT
+                substr(t.pickup_datetime, 1, 10),
+                t.pickup_hour,
+                t.vendor_id,
+                COALESCE(l.borough, 'Unknown'),
+                COUNT(*),
+                COALESCE(SUM(m.is_suspicious), 0),
+                SUM(t.trip_duration),
+                MAX(t.trip_duration),
+                COUNT(m.distance_km),
+                COALESCE(SUM(m.distance_km), 0),
+                MAX(m.distance_km),
+                COUNT(m.trip_speed_kmh),
+                COALESCE(SUM(m.trip_speed_kmh), 0)
+            FROM trips t
+            LEFT JOIN trip_metrics m ON m.trip_rowid = t.trip_rowid
+            LEFT JOIN locations l ON l.location_id = t.pickup_location_id
+            WHERE t.rowid > ?
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT (pickup_date, pickup_hour, vendor_id, pickup_borough) DO UPDATE SET
+                trip_count = trip_count + excluded.trip_count,
+                suspicious_count = suspicious_count + excluded.suspicious_count,
+                sum_duration = sum_duration + excluded.sum_duration,
+                max_duration = MAX(COALESCE(max_duration, excluded.max_duration), excluded.max_duration),
+                distance_count = distance_count + excluded.distance_count,
+                sum_distance = sum_distance + excluded.sum_distance,
+                max_distance = MAX(COALESCE(max_distance, excluded.max_distance), excluded.max_distance),
+                speed_count = speed_count + excluded.speed_count,
+                sum_speed = sum_speed + excluded.sum_speed
+        """, (after_rowid,))
+        
+        self.cursor.execute("""
+            INSERT INTO suspicious_flag_rollups (suspicious_flags, trip_count)
+            SELECT m.suspicious_flags, COUNT(*)
+            FROM trips t
+            JOIN trip_metrics m ON m.trip_rowid = t.trip_rowid
+            WHERE t.rowid > ? AND m.is_suspicious = 1
+            GROUP BY m.suspicious_flags
+            ON CONFLICT (suspicious_flags) DO UPDATE SET
+                trip_count = trip_count + excluded.trip_count
+        """, (after_rowid,))
+        
+        self.cursor.execute("""
+            INSERT INTO suspicious_rollups
+            (pickup_date, pickup_hour, vendor_id, pickup_borough, suspicious_flags, trip_count)
+            SELECT
+                substr(t.pickup_datetime, 1, 10),
+                t.pickup_hour,
+                t.vendor_id,
+                COALESCE(l.borough, 'Unknown'),
+                m.suspicious_flags,
+                COUNT(*)
+            FROM trips t
+            JOIN trip_metrics m ON m.trip_rowid = t.trip_rowid
+            LEFT JOIN locations l ON l.location_id = t.pickup_location_id
+            WHERE t.rowid > ? AND m.is_suspicious = 1
+            GROUP BY 1, 2, 3, 4, 5
+            ON CONFLICT (pickup_date, pickup_hour, vendor_id, pickup_borough, suspicious_flags) DO UPDATE SET
+                trip_count = trip_count + excluded.trip_count
+        """, (after_rowid,))
+        
+        for metric, column in SKETCH_METRICS.items():
+            self.cursor.execute(f"""
+                INSERT INTO quantile_sketches
+                (pickup_hour, vendor_id, pickup_borough, metric, bucket, trip_count)
+                SELECT
+                    t.pickup_hour,
+                    t.vendor_id,
+                    COALESCE(l.borough, 'Unknown'),
+                    ?,
+                    sketch_bucket({column}),
+                    COUNT(*)
+                FROM trips t
+                LEFT JOIN trip_metrics m ON m.trip_rowid = t.trip_rowid
+                LEFT JOIN locations l ON l.location_id = t.pickup_location_id
+                WHERE t.rowid > ? AND {column} IS NOT NULL
+                GROUP BY 1, 2, 3, 5
+                ON CONFLICT (pickup_hour, vendor_id, pickup_borough, metric, bucket) DO UPDATE SET
+                    trip_count = trip_count + excluded.trip_count
+            """, (metric, after_rowid))
+        
+        self._update_samples(after_rowid)
+    
+    def _update_samples(self, after_rowid=0):
+        """
+        Merge trips with a rowid above after_rowid into trip_samples
+        Each stratum keeps its SAMPLE_PER_STRATUM smallest sample keys, so the
+        new trips' best candidates are added and anything pushed past that
+        many is dropped, giving the same sample as building it from scratch.
+        During a bulk load the dropping waits for finish_bulk_load().
+        """
+        # CROSS JOIN keeps trips as the outer loop so only the new rowids are
+        # read; otherwise SQLite drives from idx_distance on SAMPLE_CONDITION
+        # and every load reads every earlier trip again
+        self.cursor.execute(f"""
+            INSERT INTO sample_strata (pickup_hour, vendor_id, pickup_borough, trip_count)
+            SELECT t.pickup_hour, t.vendor_id, COALESCE(l.borough, 'Unknown'), COUNT(*)
+            FROM trips t
+            CROSS JOIN trip_metrics m ON m.trip_rowid = t.trip_rowid
+            LEFT JOIN locations l ON l.location_id = t.pickup_location_id
+            WHERE t.rowid > ? AND {SAMPLE_CONDITION}
+            GROUP BY 1, 2, 3
+            ON CONFLICT (pickup_hour, vendor_id, pickup_borough) DO UPDATE SET
+                trip_count = trip_count + excluded.trip_count
+        """, (after_rowid,))
+        
+        self.cursor.execute(f"""
+            INSERT INTO trip_samples
+            (trip_rowid, sample_key, pickup_date, pickup_hour, vendor_id, pickup_borough,
+             passenger_count, trip_duration, distance_km, trip_speed_kmh)
+            SELECT trip_rowid, sample_key, pickup_date, pickup_hour, vendor_id, pickup_borough,
+                   passenger_count, trip_duration, distance_km, trip_speed_kmh
+            FROM (
+                SELECT
+                    t.trip_rowid,
+                    sample_key(t.trip_rowid) as sample_key,
+                    substr(t.pickup_datetime, 1, 10) as pickup_date,
+                    t.pickup_hour,
+                    t.vendor_id,
+                    COALESCE(l.borough, 'Unknown') as pickup_borough,
+                    t.passenger_count,
+                    t.trip_duration,
+                    m.distance_km,
+                    m.trip_speed_kmh,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY t.pickup_hour, t.vendor_id, COALESCE(l.borough, 'Unknown')
+                        ORDER BY sample_key(t.trip_rowid)
+                    ) as stratum_rank
+                FROM trips t
+                CROSS JOIN trip_metrics m ON m.trip_rowid = t.trip_rowid
+                LEFT JOIN locations l ON l.location_id = t.pickup_location_id
+                WHERE t.rowid > ? AND {SAMPLE_CONDITION}
+            )
+            WHERE stratum_rank <= ?
+        """, (after_rowid, SAMPLE_PER_STRATUM))
+        
+        if self.bulk is not None:
+            self.bulk['untrimmed_samples'] = True  # Trimmed once in finish_bulk_load()
+        else:
+            self._trim_samples(after_rowid)
+    
+    def _trim_samples(self, after_rowid=0):
+        """
+        Drop trip_samples rows past the first SAMPLE_PER_STRATUM of their stratum
+        Only strata holding a sampled trip with a rowid above after_rowid are
+        trimmed (after_rowid 0 trims every stratum). Each one reads its
+        cutoff key from idx_sample_stratum and deletes the keys above it.
+        """
+        self.cursor.execute("""
+            SELECT pickup_hour, vendor_id, pickup_borough
+            FROM trip_samples WHERE trip_rowid > ?
+            GROUP BY 1, 2, 3
+        """, (after_rowid,))
+        for stratum in self.cursor.fetchall():
+            self.cursor.execute("""
+                DELETE FROM trip_samples
+                WHERE pickup_hour = ?1 AND vendor_id = ?2 AND pickup_borough = ?3 AND sample_key > (
+                    SELECT sample_key FROM trip_samples
+                    WHERE pickup_hour = ?1 AND vendor_id = ?2 AND pickup_borough = ?3
+                    ORDER BY sample_key LIMIT 1 OFFSET ?4
+                )
+            """, stratum + (SAMPLE_PER_STRATUM - 1,))
+    
+    def _bump_data_version(self):
+        """
+        Record that the data changed, in the same transaction as the change
+        app.py compares data_version with the version its cached responses
+        were built from and uses data_updated_at as their Last-Modified time
+        """
+        self.cursor.execute("""
+            INSERT INTO settings (key, value) VALUES ('data_version', '1')
+            ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+        """)
+        self.cursor.execute("""
+            INSERT OR REPLACE INTO settings (key, value)
+            VALUES ('data_updated_at', strftime('%s', 'now'))
+        """)
+    
+    def _set_rollup_version(self):
+        """Record that the rollup tables are complete for ROLLUP_VERSION and ROLLUP_SETTINGS"""
+        self.cursor.executemany("""
+            INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)
+        """, [('rollup_version', str(ROLLUP_VERSION))] + list(ROLLUP_SETTINGS.items()))
+    
+    def rebuild_rollups(self):
+        """Recompute the rollup tables from every trip (for databases loaded before rollups existed)"""
+        
+        print("Rebuilding trip rollups...")
+        self.cursor.execute("DELETE FROM trip_rollups")
+        self.cursor.execute("DELETE FROM suspicious_flag_rollups")
+        self.cursor.execute("DELETE FROM suspicious_rollups")
+        self.cursor.execute("DELETE FROM quantile_sketches")
+        self.cursor.execute("DELETE FROM trip_samples")
+        self.cursor.execute("DELETE FROM sample_strata")
+        self._update_rollups(0)
+        self._set_rollup_version()
+        self._bump_data_version()
         self.connection.commit()
+        
+        self.cursor.execute("SELECT COUNT(*) FROM trip_rollups")
+        print(f"   Built {self.cursor.fetchone()[0]:,} rollup rows")
     
     def close(self):
         """Close database connection"""
@@ -241,24 +866,51 @@ class DataLoader:
 
 # Run this file directly to load data
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load train_clean.csv into the database')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Defer indexes, relax durability and use large transactions (fresh loads)')
+    parser.add_argument('--suspicious-rules',
+                        help='The same rules file given to data_processor.py --suspicious-rules')
+    parser.add_argument('--locations',
+                        help=f"Location scheme for a new database: grid:<meters>, geohash:<chars> "
+                             f"or raw (default: the database's own, else {DEFAULT_SCHEME})")
+    parser.add_argument('--keep-raw-coordinates', action='store_true',
+                        help='Also store exact pickup/dropoff coordinates on each trip')
+    parser.add_argument('--rebuild-rollups', action='store_true',
+                        help='Only recompute the trip_rollups table from the loaded trips')
+    args = parser.parse_args()
+    
     print("\n" + "="*60)
     print("LOADING DATA INTO DATABASE")
     print("="*60 + "\n")
     
+    if args.rebuild_rollups:
+        loader = DataLoader('database/nyc_taxi.db')
+        loader.rebuild_rollups()
+        loader.close()
+        sys.exit(0)
+    
     # Check if cleaned data exists
     if not os.path.exists('data/train_clean.csv'):
         print(" Error: Clean data not found!")
         print("   Please run data_processor.py first")
         sys.exit(1)
     
+    rules = load_rules(args.suspicious_rules) if args.suspicious_rules else None
+    
     # Initialize loader
-    loader = DataLoader('database/nyc_taxi.db')
+    loader = DataLoader('database/nyc_taxi.db', location_scheme=args.locations,
+                        keep_raw_coordinates=args.keep_raw_coordinates)
+    if args.bulk:
+        loader.start_bulk_load()
     
     # Load data in order (due to foreign keys)
     loader.load_vendors()
+    loader.load_suspicious_rules(rules)
     loader.load_locations('data/train_clean.csv')
-    loader.load_trips('data/train_clean.csv')
+    loader.load_trips('data/train_clean.csv', batch_size=10000 if args.bulk else 1000)
     
+    loader.finish_bulk_load()
     loader.close()
     
     print("\n" + "="*60)
@@ -6,31 +6,109 @@ by using only Python's built-in CSV library
 import csv  # for reading/writing CSV files (train.csv in this case)
 import logging  # For logging messages ( storing logs in our case)
 import json  # Built-in library to save reports in json format to be specific
-from datetime import datetime  # Built-in library for dates
+import math
 from statistics import median  # Built-in library for math operations
-from geopy.distance import geodesic  #  External library (for GPS distance)
+from collections import Counter  # Built-in library for tallying values
+from array import array  # Built-in compact typed arrays
+from deduplicator import DigestDeduplicator, PartitionedDeduplicator, row_digest
+from distance_engine import (
+    DISTANCE_METHODS, DeviationTracker, distances_km, geodesic_km, haversine_km, speeds_kmh
+)
+from timestamps import MISSING_EPOCH, day_of_month, hour_of, parse_timestamp_column, weekday_of
+from trip_batch import MISSING_INT, TripBatch, valid_ints
+from boroughs import BoundaryIndex, classify_boroughs
+from suspicious_rules import SuspiciousRuleEngine, load_rules, near_duplicate_keys
+from concurrent.futures import ProcessPoolExecutor  # Built-in process pool
+import argparse
+import contextlib
+import io
+import itertools
 import os
+import shutil
+import tempfile
 
 class DataProcessor:
     """Cleans and enriches raw taxi trip data"""
     
-    def __init__(self, csv_path='data/train.csv'):
+    # Critical columns that must have values
+    CRITICAL_COLUMNS = [
+        'pickup_datetime', 
+        'dropoff_datetime',
+        'pickup_longitude', 
+        'pickup_latitude',
+        'dropoff_longitude', 
+        'dropoff_latitude'
+    ]
+    
+    # Cleaning steps in pipeline order, with the wording used in reports
+    CLEANING_STEPS = [
+        ('missing_values', 'Missing values', 'rows with missing critical values'),
+        ('duplicates', 'Duplicates', 'duplicate records'),
+        ('invalid_records', 'Invalid records', 'invalid records'),
+        ('outliers', 'Outliers', 'outlier records')
+    ]
+    
+    # Validation rules in the order they are checked, with the cleaning step
+    # each one rolls up into. A rejected row counts under the first rule it fails.
+    VALIDATION_RULES = [
+        ('missing_critical_value', 'missing_values'),
+        ('duplicate', 'duplicates'),
+        ('pickup_outside_nyc', 'invalid_records'),
+        ('dropoff_outside_nyc', 'invalid_records'),
+        ('invalid_integer', 'invalid_records'),
+        ('passenger_count_out_of_range', 'invalid_records'),
+        ('non_positive_duration', 'invalid_records'),
+        ('duration_under_1_minute', 'outliers'),
+        ('duration_over_3_hours', 'outliers')
+    ]
+    
+    def __init__(self, csv_path='data/train.csv', distance_method='haversine',
+                 validate_distances=False, dedup_partitions=0, suspicious_rules=None,
+                 byte_range=None, zones=None, zone_property='zone'):
         """
         Initialize processor with data path
         Args:
             csv_path: Path to raw CSV file
+            distance_method: 'haversine' (fast, batched) or 'geodesic' (exact)
+            validate_distances: Also compute geodesic distances and report
+                how far haversine deviates from them
+            dedup_partitions: 0 keeps one digest per row in memory; N > 0
+                spills rows to N partition files for inputs too big for RAM
+            suspicious_rules: Rule definitions for flagging (defaults to
+                suspicious_rules.SUSPICIOUS_RULES)
+            byte_range: Optional (start, end) byte offsets; only the lines
+                starting inside it are processed (used for incremental ingest)
+            zones: Optional GeoJSON of taxi zones (or other areas); adds
+                pickup_zone and dropoff_zone columns
+            zone_property: Feature property holding a zone's name
         """
+        if distance_method not in DISTANCE_METHODS:
+            raise ValueError(f"Unknown distance method: {distance_method}")
+        
         self.csv_path = csv_path
-        self.data = []  # List to hold all rows as dictionaries
-        self.clean_data = []  # List to hold cleaned rows
+        self.distance_method = distance_method
+        self.dedup_partitions = dedup_partitions
+        self.deviation_tracker = DeviationTracker() if validate_distances else None
+        self.suspicious_rules = suspicious_rules
+        self.byte_range = byte_range
+        self.zones = zones
+        self.zone_property = zone_property
+        self.zone_index = BoundaryIndex(zones, name_property=zone_property) if zones else None
+        self.suspicious_engine = SuspiciousRuleEngine(suspicious_rules)
+        self.data = TripBatch.empty([])  # Every raw row, one typed array per column
+        self.clean_data = self.data  # Rows still in the dataset after each stage
         
         # Track what we remove for transparency
         self.exclusion_log = {
             'original_count': 0,
             'steps': [],
+            'rules': [],
             'suspicious_records': []
         }
         
+        # Filled in by process_stream(), which never holds all rows in memory
+        self.stream_result = None
+        
         # Setup logging to file
         os.makedirs('logs', exist_ok=True)
         logging.basicConfig(
@@ -38,375 +116,763 @@ class DataProcessor:
             level=logging.INFO,
             format='%(asctime)s - %(message)s'
         )
-        
+    
     def load_data(self):
-        """Load CSV file into memory using Python's csv library"""
+        """Load CSV file into memory as a columnar TripBatch"""
         
         print("Loading CSV data...")
         logging.info("Loading data from CSV")
         
-        # Open CSV file and read all rows
-        with open(self.csv_path, 'r', encoding='utf-8') as file:
-            # DictReader reads CSV and converts each row to a dictionary
-            # Example: {'id': '123', 'vendor_id': '2', 'pickup_datetime': '2016-01-01 00:00:00'}
-            reader = csv.DictReader(file)
-            
-            # Store all rows in memory
-            self.data = list(reader)
-            self.clean_data = self.data.copy()  # Make a working copy
+        # Parse a chunk at a time so the text rows never all exist at once
+        for batch in self._read_batches():
+            if not self.data.columns:
+                self.data = batch
+            else:
+                self.data.extend(batch)
         
+        # Stages build new batches, so the raw data is never modified
+        self.clean_data = self.data
         self.exclusion_log['original_count'] = len(self.data)
         
         print(f"Loaded {len(self.data)} records")
-        print(f"   Columns: {list(self.data[0].keys())}")
+        print(f"   Columns: {self.data.columns}")
         
         logging.info(f"Loaded {len(self.data)} records")
         return self
     
-    def handle_missing_values(self):
-        """Remove or fill missing data"""
+    def validate_records(self):
+        """
+        Remove rows with missing critical values, duplicates, invalid
+        records and outliers in a single pass over the data
+        """
         
-        print("\nHandling missing values...")
-        before = len(self.clean_data)
+        print("\nValidating records...")
         
-        # Critical columns that must have values
-        critical_cols = [
-            'pickup_datetime', 
-            'dropoff_datetime',
-            'pickup_longitude', 
-            'pickup_latitude',
-            'dropoff_longitude', 
-            'dropoff_latitude'
-        ]
+        # Fill missing passenger_count with median of the complete rows
+        passenger_counts = Counter()
+        self._tally_passenger_counts(self.clean_data, passenger_counts)
         
-        # Filter out rows with missing critical values
-        temp_data = []
-        for row in self.clean_data:
-            # Check if all critical columns have values (not empty string)
-            has_all_critical = all(
-                row.get(col, '').strip() != '' 
-                for col in critical_cols
-            )
-            
-            if has_all_critical:
-                temp_data.append(row)
-        
-        self.clean_data = temp_data
-        
-        # Fill missing passenger_count with median
-        # First, collect all non-empty passenger counts
-        passenger_counts = []
-        for row in self.clean_data:
-            pc = row.get('passenger_count', '').strip()
-            if pc and pc.replace('.', '').isdigit():
-                passenger_counts.append(float(pc))
-        
-        # Calculate median (middle value)
-        if passenger_counts:
-            median_passengers = median(passenger_counts)
-            
-            # Fill missing values
-            for row in self.clean_data:
-                if not row.get('passenger_count', '').strip():
-                    row['passenger_count'] = str(int(median_passengers))
+        median_passengers = self._median_from_counts(passenger_counts)
+        if median_passengers is not None:
+            self._fill_passenger_count(self.clean_data, median_passengers)
         
-        after = len(self.clean_data)
-        removed = before - after
+        is_first_occurrence, dedup = self._duplicate_checker([self.clean_data])
         
-        self.exclusion_log['steps'].append({
-            'step': 'missing_values',
-            'removed': removed
-        })
+        rule_counts = Counter()
+        outcomes = self._validate_batch(self.clean_data, is_first_occurrence)
+        rule_counts.update(filter(None, outcomes))
+        self.clean_data = self.clean_data.select(
+            bytearray(outcome is None for outcome in outcomes)
+        )
         
-        print(f"   Removed {removed} rows with missing critical values")
-        logging.info(f"Missing values: removed {removed} rows")
+        self._record_rules(rule_counts)
+        self._report_dedup(dedup.report())
         return self
     
-    def handle_duplicates(self):
-        """Remove duplicate trip records"""
+    def normalize_timestamps(self):
+        """Parse pickup/dropoff timestamps once into epoch seconds and time parts"""
         
-        print("Checking for duplicates...")
-        before = len(self.clean_data)
+        print("Normalizing timestamps...")
         
-        # Use set to track unique rows
-        # Convert each row dict to a frozenset (immutable set) for comparison
-        seen = set()
-        unique_data = []
+        self._add_time_features(self.clean_data)
         
-        for row in self.clean_data:
-            # Create a unique identifier from all values
-            row_tuple = tuple(sorted(row.items()))
-            
-            if row_tuple not in seen:
-                seen.add(row_tuple)
-                unique_data.append(row)
+        print("   Timestamps normalized")
+        logging.info("Timestamps normalized")
+        return self
+    
+    def create_derived_features(self):
+        """
+        Create new features from existing data
+        These help understand trip patterns better
+        """
         
-        self.clean_data = unique_data
+        print("\nCreating derived features...")
+        print(f"   Calculating distances ({self.distance_method}), speeds and fare efficiency...")
         
-        after = len(self.clean_data)
-        removed = before - after
+        self._add_derived_features(self.clean_data)
+        self._report_distance_validation()
         
-        self.exclusion_log['steps'].append({
-            'step': 'duplicates',
-            'removed': removed
-        })
+        print("   Derived features created")
+        logging.info("Created derived features: distance_km, trip_speed_kmh, fare_per_km, "
+                     "pickup/dropoff borough")
+        return self
+    
+    def flag_suspicious_records(self):
+        """Identify but don't remove unusual trips"""
+        
+        print("Flagging suspicious records...")
+        
+        suspicious_count = self._flag_suspicious(self.clean_data)
         
-        print(f"   Removed {removed} duplicate records")
-        logging.info(f"Duplicates: removed {removed} rows")
+        print(f"   Flagged {suspicious_count} suspicious records (kept in dataset)")
+        logging.info(f"Flagged {suspicious_count} suspicious records")
+        self._report_suspicious()
         return self
     
-    def handle_invalid_records(self):
-        """Remove logically impossible data"""
+    def process_stream(self, output_path='data/train_clean.csv', chunk_size=10000, sinks=()):
+        """
+        Run the whole cleaning pipeline as a generator chain
+        Batches of chunk_size rows are read, filtered, enriched and written
+        one at a time, so memory stays flat no matter how big the input is.
+        The input is read twice: the first pass only tallies passenger
+        counts so the median fill matches the in-memory pipeline. With
+        partitioned dedup there is one more pass to spill rows to disk.
+        Args:
+            output_path: Where to write the cleaned CSV (None for no CSV)
+            chunk_size: Rows per batch
+            sinks: Functions called with every cleaned TripBatch, e.g.
+                DataLoader.load_trip_batch to load straight into the database
+        """
+        
+        print("Streaming CSV data (pass 1: passenger count median)...")
+        logging.info("Streaming data from CSV")
+        
+        # Pass 1: original count and passenger median, without keeping rows
+        original_count = 0
+        passenger_counts = Counter()
+        for batch in self._read_batches(chunk_size, columns=['passenger_count']):
+            original_count += len(batch)
+            self._tally_passenger_counts(batch, passenger_counts)
+        
+        median_passengers = self._median_from_counts(passenger_counts)
+        self.exclusion_log['original_count'] = original_count
+        print(f"   Read {original_count} records")
+        
+        if self.dedup_partitions:
+            # Extra pass: spill complete rows and find duplicate positions
+            print("Streaming CSV data (partitioned dedup pass)...")
+        is_first_occurrence, dedup = self._duplicate_checker(
+            self._fill_stage(self._read_batches(chunk_size), median_passengers)
+        )
         
-        print("Removing invalid records...")
-        before = len(self.clean_data)
+        # Main pass: chain every stage as a lazy generator
+        print("Streaming CSV data (clean, enrich, write)...")
+        rule_counts = Counter()
         
-        temp_data = []
+        batches = self._fill_stage(self._read_batches(chunk_size), median_passengers)
+        batches = self._validate_stage(batches, is_first_occurrence, rule_counts)
+        batches = self._map_stage(batches, self._add_time_features)
+        batches = self._map_stage(batches, self._add_derived_features)
+        batches = self._map_stage(batches, self._flag_suspicious)
         
-        for row in self.clean_data:
-            try:
-                # Parse coordinates
-                pickup_lat = float(row['pickup_latitude'])
-                pickup_lon = float(row['pickup_longitude'])
-                dropoff_lat = float(row['dropoff_latitude'])
-                dropoff_lon = float(row['dropoff_longitude'])
-                
-                # Check NYC boundaries
-                valid_pickup = (40.5 <= pickup_lat <= 41.0 and 
-                              -74.3 <= pickup_lon <= -73.7)
-                valid_dropoff = (40.5 <= dropoff_lat <= 41.0 and 
-                               -74.3 <= dropoff_lon <= -73.7)
-                
-                # Check passenger count
-                passenger_count = int(float(row.get('passenger_count', 1)))
-                valid_passengers = 1 <= passenger_count <= 6
+        final_count = 0
+        suspicious_count = 0
+        with contextlib.ExitStack() as stack:
+            writer = None
+            if output_path is not None:
+                file = stack.enter_context(open(output_path, 'w', newline='', encoding='utf-8'))
+                writer = csv.writer(file)
+            
+            for batch in batches:
+                if writer is not None:
+                    # Column names are only known once the first batch is enriched
+                    if final_count == 0:
+                        writer.writerow(batch.columns)
+                    writer.writerows(batch.iter_records())
                 
-                # Check trip duration
-                trip_duration = int(float(row['trip_duration']))
-                valid_duration = trip_duration > 0
+                for sink in sinks:
+                    sink(batch)
                 
-                # Keep only if all validations pass
-                if valid_pickup and valid_dropoff and valid_passengers and valid_duration:
-                    temp_data.append(row)
-                    
-            except (ValueError, KeyError):
-                # Skip rows with parsing errors
-                continue
-        
-        self.clean_data = temp_data
+                final_count += len(batch)
+                suspicious_count += sum(batch['is_suspicious'])
         
-        after = len(self.clean_data)
-        removed = before - after
+        self._record_rules(rule_counts)
+        self._report_dedup(dedup.report())
+        self._report_distance_validation()
         
-        self.exclusion_log['steps'].append({
-            'step': 'invalid_records',
-            'removed': removed
-        })
+        self.stream_result = {
+            'final_count': final_count,
+            'suspicious_count': suspicious_count
+        }
         
-        print(f"   Removed {removed} invalid records")
-        logging.info(f"Invalid records: removed {removed} rows")
+        print(f"   Flagged {suspicious_count} suspicious records (kept in dataset)")
+        self._report_suspicious()
+        if output_path is not None:
+            print(f"   Clean data saved to {output_path}")
+        logging.info(f"Streamed {final_count} clean records to {output_path or 'sinks only'}")
         return self
     
-    def handle_outliers(self):
-        """Remove extreme values that distort analysis"""
+    def process_parallel(self, workers, output_path='data/train_clean.csv', chunk_size=10000):
+        """
+        Run the cleaning pipeline over byte-range chunks in a process pool
+        Validation, timestamps, derived features and flagging are done by
+        the workers. Duplicates and the passenger median need the whole
+        file, so they are resolved in the parent:
+          1. Workers tally passenger counts -> parent computes the median
+          2. Workers validate and clean their chunk with that median,
+             writing kept rows to a part file and returning
+             (row digest, first failed rule) per complete row
+          3. Parent replays the outcomes in file order to drop duplicates,
+             so every step count matches the single-process pipeline,
+             and resolves the near-duplicate suspicious rule the same way
+        Args:
+            workers: Number of worker processes
+            output_path: Where to write the cleaned CSV
+            chunk_size: Rows per batch inside each worker
+        """
         
-        print("Removing outliers...")
-        before = len(self.clean_data)
+        fieldnames, ranges = self._byte_ranges(workers * 4)
+        print(f"Processing {len(ranges)} chunks with {workers} workers...")
+        logging.info(f"Parallel processing with {workers} workers, {len(ranges)} chunks")
         
-        temp_data = []
+        part_dir = tempfile.mkdtemp(prefix='clean_parts_', dir=os.path.dirname(output_path) or '.')
+        settings = (self.csv_path, self.distance_method, self.deviation_tracker is not None,
+                    self.suspicious_rules, self.zones, self.zone_property)
         
-        for row in self.clean_data:
-            try:
-                trip_duration = int(float(row['trip_duration']))
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                # Pass 1: original count and passenger median
+                original_count = 0
+                passenger_counts = Counter()
+                tally_tasks = [(settings, fieldnames, start, end, chunk_size) for start, end in ranges]
+                for count, counts in pool.map(_tally_chunk, tally_tasks):
+                    original_count += count
+                    passenger_counts.update(counts)
+                
+                median_passengers = self._median_from_counts(passenger_counts)
+                self.exclusion_log['original_count'] = original_count
+                print(f"   Read {original_count} records")
                 
-                # Keep trips between 1 minute and 3 hours
-                if 60 <= trip_duration <= 10800:
-                    temp_data.append(row)
+                # Pass 2: clean each chunk into its own part file
+                part_paths = [os.path.join(part_dir, f'part_{i:05d}.csv') for i in range(len(ranges))]
+                clean_tasks = [
+                    (settings, fieldnames, start, end, median_passengers, part_path, chunk_size)
+                    for (start, end), part_path in zip(ranges, part_paths)
+                ]
+                results = list(pool.map(_clean_chunk, clean_tasks))
+            
+            # Global dedup: replay row outcomes in file order
+            rule_counts = Counter()
+            dedup = DigestDeduplicator()
+            engine = self.suspicious_engine
+            near_duplicate_bit = engine.bits.get('duplicate_like', 0)
+            duplicate_positions = []  # Per chunk, kept-row positions that are duplicates
+            patched_flags = []  # Per chunk, kept-row position -> flags the worker couldn't know
+            suspicious_count = 0
+            
+            for result in results:
+                rule_counts['missing_critical_value'] += result['missing']
+                duplicates = set()
+                kept_position = 0
+                
+                for digest, outcome in result['outcomes']:
+                    if not dedup.is_new_digest(digest):
+                        rule_counts['duplicate'] += 1
+                        if outcome is None:
+                            duplicates.add(kept_position)
+                    elif outcome is not None:
+                        rule_counts[outcome] += 1
                     
-            except (ValueError, KeyError):
-                continue
+                    if outcome is None:
+                        kept_position += 1
+                
+                duplicate_positions.append(duplicates)
+                
+                # Near-duplicates are also judged against earlier chunks
+                patched = {}
+                for position, flags in enumerate(result['flags']):
+                    if position in duplicates:
+                        continue
+                    if near_duplicate_bit and not engine.near_duplicates.is_new_digest(result['near_keys'][position]):
+                        flags |= near_duplicate_bit
+                        patched[position] = flags
+                    if flags:
+                        engine.tally((flags,))
+                        suspicious_count += 1
+                patched_flags.append(patched)
+                
+                if self.deviation_tracker is not None:
+                    self.deviation_tracker.merge(result['deviation'])
+            
+            # Stitch the part files together line by line, skipping duplicates
+            final_count = 0
+            with open(output_path, 'wb') as file:
+                header_written = False
+                for part_path, duplicates, patched in zip(part_paths, duplicate_positions, patched_flags):
+                    if not os.path.exists(part_path):
+                        continue  # No rows survived in this chunk
+                    
+                    with open(part_path, 'rb') as part:
+                        header = part.readline()
+                        if not header_written:
+                            file.write(header)
+                            header_written = True
+                        columns = next(csv.reader([header.decode('utf-8')]))
+                        
+                        for position, line in enumerate(part):
+                            if position in duplicates:
+                                continue
+                            if position in patched:
+                                line = self._patch_flags(line, columns, patched[position])
+                            file.write(line)
+                            final_count += 1
+        finally:
+            shutil.rmtree(part_dir, ignore_errors=True)
+        
+        self._record_rules(rule_counts)
+        self._report_dedup(dedup.report())
+        self._report_distance_validation()
+        
+        self.stream_result = {
+            'final_count': final_count,
+            'suspicious_count': suspicious_count
+        }
+        
+        print(f"   Flagged {suspicious_count} suspicious records (kept in dataset)")
+        self._report_suspicious()
+        print(f"   Clean data saved to {output_path}")
+        logging.info(f"Parallel run wrote {final_count} clean records to {output_path}")
+        return self
+    
+    def _patch_flags(self, line, columns, flags):
+        """Rewrite the suspicious columns of one CSV line from a part file"""
+        row = next(csv.reader([line.decode('utf-8')]))
+        row[columns.index('is_suspicious')] = '1' if flags else '0'
+        row[columns.index('suspicious_reason')] = self.suspicious_engine.reason(flags)
+        row[columns.index('suspicious_flags')] = str(flags)
+        
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(row)
+        return buffer.getvalue().encode('utf-8')
+    
+    def _byte_ranges(self, chunks):
+        """
+        Split the CSV body into roughly equal byte ranges on line boundaries
+        Assumes no quoted field contains a newline, which holds for the
+        NYC taxi exports.
+        Returns:
+            (header fieldnames, list of (start, end) byte offsets)
+        """
+        size = os.path.getsize(self.csv_path)
+        
+        with open(self.csv_path, 'rb') as file:
+            header = file.readline().decode('utf-8')
+            data_start = file.tell()
+            
+            step = max(1, (size - data_start) // chunks)
+            bounds = [data_start]
+            for i in range(1, chunks):
+                # Move forward to the start of the next full line
+                file.seek(data_start + i * step)
+                file.readline()
+                position = file.tell()
+                if bounds[-1] < position < size:
+                    bounds.append(position)
+            bounds.append(size)
+        
+        fieldnames = next(csv.reader([header]))
+        return fieldnames, list(zip(bounds, bounds[1:]))
+    
+    def _read_byte_range(self, start, end, fieldnames, chunk_size, columns=None):
+        """Yield TripBatches for the lines starting inside [start, end)"""
+        
+        def lines():
+            with open(self.csv_path, 'rb') as file:
+                file.seek(start)
+                position = start
+                while position < end:
+                    line = file.readline()
+                    if not line:
+                        break
+                    position += len(line)
+                    yield line.decode('utf-8')
+        
+        yield from self._batches(fieldnames, csv.reader(lines()), chunk_size, columns)
+    
+    def _tally_byte_range(self, start, end, fieldnames, chunk_size):
+        """Worker pass 1: row count and passenger tally for one chunk"""
+        count = 0
+        passenger_counts = Counter()
+        for batch in self._read_byte_range(start, end, fieldnames, chunk_size, columns=['passenger_count']):
+            count += len(batch)
+            self._tally_passenger_counts(batch, passenger_counts)
+        return count, passenger_counts
+    
+    def _clean_byte_range(self, start, end, fieldnames, median_passengers, part_path, chunk_size):
+        """
+        Worker pass 2: clean and enrich one chunk
+        Kept rows are written to part_path, one line per row, so the parent
+        can copy them without re-parsing. Every row that passes the
+        missing-value check is reported as (row digest, outcome), where
+        outcome is the first failed rule or None if the row was kept.
+        Duplicates can only be judged across the whole file, so that rule
+        is left to the parent, as is the near-duplicate suspicious rule:
+        kept rows come back with their suspicious bitmask and the key
+        that rule compares.
+        """
+        missing = 0
+        outcomes = []
+        flags = array('i')  # Suspicious bitmask per row of the part file
+        near_keys = []
+        kept_count = 0
+        
+        batches = self._read_byte_range(start, end, fieldnames, chunk_size)
+        with open(part_path, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            
+            for batch in self._fill_stage(batches, median_passengers):
+                batch_outcomes = self._validate_batch(batch)
+                
+                for canonical, complete, outcome in zip(batch.canonical_rows(), batch.complete, batch_outcomes):
+                    if complete:
+                        outcomes.append((row_digest(canonical), outcome))
+                    else:
+                        missing += 1
+                
+                batch = batch.select(bytearray(outcome is None for outcome in batch_outcomes))
+                self._add_time_features(batch)
+                self._add_derived_features(batch)
+                self._flag_suspicious(batch)
+                flags.extend(batch['suspicious_flags'])
+                if 'duplicate_like' in self.suspicious_engine.bits:
+                    near_keys.extend(row_digest(key) for key in near_duplicate_keys(batch))
+                
+                if kept_count == 0 and len(batch):
+                    writer.writerow(batch.columns)
+                
+                writer.writerows(batch.iter_records())
+                kept_count += len(batch)
+        
+        if kept_count == 0:
+            os.remove(part_path)
+        
+        return {
+            'missing': missing,
+            'outcomes': outcomes,
+            'flags': flags,
+            'near_keys': near_keys,
+            'deviation': self.deviation_tracker
+        }
+    
+    def _read_batches(self, chunk_size=10000, columns=None):
+        """
+        Yield the raw CSV as TripBatches of at most chunk_size rows
+        Args:
+            columns: Only parse these columns (default: all)
+        """
+        if self.byte_range is not None:
+            # Header from the top of the file, rows from the requested range only
+            fieldnames, [(data_start, _)] = self._byte_ranges(1)
+            start, end = self.byte_range
+            yield from self._read_byte_range(max(start, data_start), end, fieldnames, chunk_size, columns)
+            return
+        
+        with open(self.csv_path, 'r', newline='', encoding='utf-8') as file:
+            reader = csv.reader(file)
+            fieldnames = next(reader, None)
+            if fieldnames is not None:
+                yield from self._batches(fieldnames, reader, chunk_size, columns)
+    
+    def _batches(self, fieldnames, records, chunk_size, columns=None):
+        """Group csv.reader records into TripBatches"""
+        chunk = []
+        for record in records:
+            if not record:
+                continue  # Blank line
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield TripBatch.from_records(fieldnames, chunk, self.CRITICAL_COLUMNS, columns)
+                chunk = []
+        
+        if chunk:
+            yield TripBatch.from_records(fieldnames, chunk, self.CRITICAL_COLUMNS, columns)
+    
+    def _validate_stage(self, batches, is_first_occurrence, rule_counts):
+        """Lazily keep the rows that pass every rule, counting the rest in rule_counts"""
+        for batch in batches:
+            outcomes = self._validate_batch(batch, is_first_occurrence)
+            rule_counts.update(filter(None, outcomes))
+            yield batch.select(bytearray(outcome is None for outcome in outcomes))
+    
+    def _map_stage(self, batches, enrich):
+        """Lazily apply an in-place enrichment function to every batch"""
+        for batch in batches:
+            enrich(batch)
+            yield batch
+    
+    def _fill_stage(self, batches, median_passengers):
+        """Lazily fill missing passenger_count values with the median"""
+        if median_passengers is None:
+            return batches
+        return self._map_stage(batches, lambda batch: self._fill_passenger_count(batch, median_passengers))
+    
+    def _duplicate_checker(self, batches):
+        """
+        Set up duplicate detection for the validation pass
+        Args:
+            batches: The batches that will be validated, passenger_count
+                already filled (only read for partitioned dedup)
+        Returns:
+            (function telling whether a canonical row is a first occurrence,
+             deduplicator whose report() goes in the exclusion log)
+        """
+        if not self.dedup_partitions:
+            # Keep a fixed-size digest per unique row instead of a full copy
+            dedup = DigestDeduplicator()
+            return dedup.is_first_occurrence, dedup
+        
+        # Spill complete rows to disk and find duplicates one partition at a time
+        with PartitionedDeduplicator(self.dedup_partitions) as dedup:
+            for batch in batches:
+                for canonical in batch.select(batch.complete).canonical_rows():
+                    dedup.add(canonical)
+            duplicates = dedup.duplicate_sequences()
+        
+        # Complete rows reach the dedup rule in the same order they were spilled
+        sequence = itertools.count()
+        return (lambda canonical: next(sequence) not in duplicates), dedup
+    
+    def _record_rules(self, rule_counts):
+        """Add per-rule rejections to the exclusion log and roll them up into steps"""
         
-        self.clean_data = temp_data
+        self.exclusion_log['rules'] = [
+            {'rule': rule, 'step': step, 'removed': rule_counts.get(rule, 0)}
+            for rule, step in self.VALIDATION_RULES
+        ]
+        logging.info(f"Validation rules: {self.exclusion_log['rules']}")
+        
+        for step, _, _ in self.CLEANING_STEPS:
+            self._record_step(step, sum(
+                entry['removed'] for entry in self.exclusion_log['rules']
+                if entry['step'] == step
+            ))
+    
+    def _record_step(self, step, removed):
+        """Add a cleaning step to the exclusion log and report it"""
         
-        after = len(self.clean_data)
-        removed = before - after
+        label, description = next(
+            (label, description)
+            for name, label, description in self.CLEANING_STEPS
+            if name == step
+        )
         
         self.exclusion_log['steps'].append({
-            'step': 'outliers',
+            'step': step,
             'removed': removed
         })
         
-        print(f"   Removed {removed} outlier records")
-        logging.info(f"Outliers: removed {removed} rows")
-        return self
+        print(f"   Removed {removed} {description}")
+        logging.info(f"{label}: removed {removed} rows")
     
-    def normalize_timestamps(self):
-        """Convert string dates to proper datetime format"""
-        
-        print("Normalizing timestamps...")
-        
-        for row in self.clean_data:
-            try:
-                # Parse datetime strings
-                # Example: "2016-03-14 17:24:55" -> datetime object
-                pickup_dt = datetime.strptime(
-                    row['pickup_datetime'], 
-                    '%Y-%m-%d %H:%M:%S'
-                )
-                dropoff_dt = datetime.strptime(
-                    row['dropoff_datetime'], 
-                    '%Y-%m-%d %H:%M:%S'
-                )
-                
-                # Extract useful time components
-                row['pickup_hour'] = str(pickup_dt.hour)
-                row['pickup_day'] = str(pickup_dt.day)
-                row['pickup_weekday'] = str(pickup_dt.weekday())  # 0=Monday
-                
-            except (ValueError, KeyError):
-                # If parsing fails, set defaults
-                row['pickup_hour'] = '0'
-                row['pickup_day'] = '1'
-                row['pickup_weekday'] = '0'
-        
-        print("   Timestamps normalized")
-        logging.info("Timestamps normalized")
-        return self
+    def _tally_passenger_counts(self, batch, counts):
+        """Count every usable (non-negative) passenger_count in the complete rows of a batch"""
+        for passenger_count in itertools.compress(batch['passenger_count'], batch.complete):
+            if passenger_count >= 0:
+                counts[float(passenger_count)] += 1
     
-    def create_derived_features(self):
+    def _median_from_counts(self, counts):
         """
-        Create new features from existing data
-        These help understand trip patterns better
+        Median (middle value) of a tally of values
+        Gives the same result as statistics.median on the expanded list,
+        but only needs one entry per distinct value
         """
+        total = sum(counts.values())
+        if total == 0:
+            return None
+        
+        # Walk the sorted values until both middle positions are found
+        middle = [(total - 1) // 2, total // 2]
+        found = []
+        position = 0
+        for value in sorted(counts):
+            position += counts[value]
+            while middle and middle[0] < position:
+                middle.pop(0)
+                found.append(value)
+        
+        return median(found)
+    
+    def _fill_passenger_count(self, batch, median_passengers):
+        """Fill missing passenger_count values with the median"""
+        fill_value = int(median_passengers)
+        passenger_counts = batch['passenger_count']
+        for i, passenger_count in enumerate(passenger_counts):
+            if passenger_count == MISSING_INT:
+                passenger_counts[i] = fill_value
+    
+    def _validate_batch(self, batch, is_first_occurrence=None):
+        """
+        Check every validation rule for every row of a batch in one pass
+        Args:
+            batch: TripBatch with passenger_count already filled
+            is_first_occurrence: Dedup check called with the canonical bytes
+                of each complete row, in order; None skips the duplicate rule
+        Returns:
+            List with the first failed rule per row, None where the row passes
+        """
+        outcomes = []
+        append = outcomes.append
+        
+        # Unparseable coordinates are NaN, so they fail the boundary checks
+        for complete, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, vendor_id, passenger_count, trip_duration, canonical in zip(
+            batch.complete,
+            batch['pickup_latitude'], batch['pickup_longitude'],
+            batch['dropoff_latitude'], batch['dropoff_longitude'],
+            batch['vendor_id'], batch['passenger_count'], batch['trip_duration'],
+            batch.canonical_rows()
+        ):
+            if not complete:
+                append('missing_critical_value')
+            elif is_first_occurrence is not None and not is_first_occurrence(canonical):
+                append('duplicate')
+            # Check NYC boundaries
+            elif not (40.5 <= pickup_lat <= 41.0 and -74.3 <= pickup_lon <= -73.7):
+                append('pickup_outside_nyc')
+            elif not (40.5 <= dropoff_lat <= 41.0 and -74.3 <= dropoff_lon <= -73.7):
+                append('dropoff_outside_nyc')
+            # Integers that were empty or not numbers (passenger_count is already filled)
+            elif not valid_ints(vendor_id, passenger_count, trip_duration):
+                append('invalid_integer')
+            # Check passenger count and trip duration
+            elif not 1 <= passenger_count <= 6:
+                append('passenger_count_out_of_range')
+            elif trip_duration <= 0:
+                append('non_positive_duration')
+            # Keep trips between 1 minute and 3 hours
+            elif trip_duration < 60:
+                append('duration_under_1_minute')
+            elif trip_duration > 10800:
+                append('duration_over_3_hours')
+            else:
+                append(None)
+        
+        return outcomes
+    
+    def _add_time_features(self, batch):
+        """Add epoch seconds plus pickup hour, day and weekday to a batch"""
+        # Example: "2016-03-14 17:24:55" -> 1457976295
+        pickup_epochs = parse_timestamp_column(batch['pickup_datetime'])
+        dropoff_epochs = parse_timestamp_column(batch['dropoff_datetime'])
+        hours, days, weekdays = array('b'), array('b'), array('b')
+        
+        for pickup, dropoff in zip(pickup_epochs, dropoff_epochs):
+            if pickup == MISSING_EPOCH or dropoff == MISSING_EPOCH:
+                # If parsing fails, set defaults
+                hours.append(0)
+                days.append(1)
+                weekdays.append(0)
+                continue
+            
+            # Extract useful time components
+            hours.append(hour_of(pickup))
+            days.append(day_of_month(pickup))
+            weekdays.append(weekday_of(pickup))  # 0=Monday
+        
+        batch.add_column('pickup_hour', hours)
+        batch.add_column('pickup_day', days)
+        batch.add_column('pickup_weekday', weekdays)
+        batch.add_column('pickup_epoch', pickup_epochs)
+        batch.add_column('dropoff_epoch', dropoff_epochs)
+    
+    def _add_derived_features(self, batch):
+        """Add distance, speed, fare and borough features to a batch"""
         
-        print("\nCreating derived features...")
-        
-        # FEATURE 1: Trip Distance (in kilometers)
-        print("   Calculating distances...")
-        for row in self.clean_data:
-            row['distance_km'] = str(self._calculate_distance(row))
+        # FEATURE 1: Trip Distance (in kilometers), rounded to meters
+        distances = array('d', (
+            0.0 if math.isnan(distance) else round(distance, 3)
+            for distance in self._calculate_distances(batch)
+        ))
+        batch.add_column('distance_km', distances)
         
         # FEATURE 2: Trip Speed (km/h)
-        print("   Calculating speeds...")
-        for row in self.clean_data:
-            try:
-                distance = float(row['distance_km'])
-                duration_hours = float(row['trip_duration']) / 3600
-                
-                if duration_hours > 0:
-                    speed = distance / duration_hours
-                    row['trip_speed_kmh'] = str(round(speed, 2))
-                else:
-                    row['trip_speed_kmh'] = '0'
-                    
-            except (ValueError, ZeroDivisionError):
-                row['trip_speed_kmh'] = '0'
+        durations = batch['trip_duration']
+        speeds = speeds_kmh(distances, durations)
+        batch.add_column('trip_speed_kmh', array('d', (
+            round(speed, 2) if duration > 0 else 0.0
+            for speed, duration in zip(speeds, durations)
+        )))
         
         # FEATURE 3: Fare per Kilometer (if fare data exists)
-        print("   Calculating fare efficiency...")
-        for row in self.clean_data:
-            try:
-                # Check if fare_amount column exists
-                if 'fare_amount' in row and row['fare_amount'].strip():
-                    fare = float(row['fare_amount'])
-                    distance = float(row['distance_km'])
-                    
-                    if distance > 0:
-                        fare_per_km = fare / distance
-                        row['fare_per_km'] = str(round(fare_per_km, 2))
-                    else:
-                        row['fare_per_km'] = ''
-                else:
-                    row['fare_per_km'] = ''
-                    
-            except (ValueError, ZeroDivisionError):
-                row['fare_per_km'] = ''
+        fares_per_km = array('d', [math.nan]) * len(batch)
+        if 'fare_amount' in batch:
+            for i, (fare, distance) in enumerate(zip(batch['fare_amount'], distances)):
+                if distance > 0 and not math.isnan(fare):
+                    fares_per_km[i] = round(fare / distance, 2)
+        batch.add_column('fare_per_km', fares_per_km)
+        
+        # FEATURE 4: Pickup/dropoff borough (and zone), for filtering and aggregating
+        for end in ('pickup', 'dropoff'):
+            lats, lons = batch[f'{end}_latitude'], batch[f'{end}_longitude']
+            batch.add_column(f'{end}_borough', classify_boroughs(lats, lons))
+            if self.zone_index is not None:
+                batch.add_column(f'{end}_zone', self.zone_index.classify_many(lats, lons))
+    
+    def _flag_suspicious(self, batch):
+        """Add suspicious flags to a batch, returning how many were flagged"""
+        flags = self.suspicious_engine.flag(batch)
+        return len(flags) - flags.count(0)
+    
+    def _calculate_distances(self, batch):
+        """
+        Calculate distance between pickup and dropoff points for a batch
+        The coordinate columns are already float arrays, so they go to the
+        distance engine as-is
+        Returns:
+            array of distances in km
+        """
+        columns = (
+            batch['pickup_latitude'], batch['pickup_longitude'],
+            batch['dropoff_latitude'], batch['dropoff_longitude']
+        )
+        distances = distances_km(*columns, method=self.distance_method)
         
-        print("   Derived features created")
-        logging.info("Created derived features: distance_km, trip_speed_kmh, fare_per_km")
-        return self
+        # Optionally measure the haversine error against exact geodesic
+        if self.deviation_tracker is not None:
+            if self.distance_method == 'haversine':
+                self.deviation_tracker.update(distances, geodesic_km(*columns))
+            else:
+                self.deviation_tracker.update(haversine_km(*columns), distances)
+        
+        return distances
     
-    def flag_suspicious_records(self):
-        """Identify but don't remove unusual trips"""
+    def _report_dedup(self, report):
+        """Record how duplicates were detected"""
         
-        print("Flagging suspicious records...")
+        self.exclusion_log['deduplication'] = report
         
-        suspicious_count = 0
+        if report['method'] == 'partitioned':
+            print(f"   Verified {report['collisions_checked']} digest matches across "
+                  f"{report['partitions']} partitions ({report['hash_collisions']} hash collisions)")
+        logging.info(f"Deduplication: {report}")
+    
+    def _report_distance_validation(self):
+        """Record how far haversine strays from geodesic, if validating"""
         
-        for row in self.clean_data:
-            try:
-                speed = float(row['trip_speed_kmh'])
-                distance = float(row['distance_km'])
-                
-                # Check for suspicious patterns
-                is_suspicious = False
-                reason = ''
-                
-                if speed > 80:
-                    is_suspicious = True
-                    reason = 'Speed too high'
-                elif speed < 5:
-                    is_suspicious = True
-                    reason = 'Speed too low'
-                elif distance < 0.1:
-                    is_suspicious = True
-                    reason = 'Distance too short'
-                
-                # Add flags to row
-                row['is_suspicious'] = '1' if is_suspicious else '0'
-                row['suspicious_reason'] = reason
-                
-                if is_suspicious:
-                    suspicious_count += 1
-                    
-            except ValueError:
-                row['is_suspicious'] = '0'
-                row['suspicious_reason'] = ''
+        if self.deviation_tracker is None:
+            return
         
-        print(f"   Flagged {suspicious_count} suspicious records (kept in dataset)")
-        logging.info(f"Flagged {suspicious_count} suspicious records")
-        return self
+        report = self.deviation_tracker.report()
+        self.exclusion_log['distance_validation'] = report
+        
+        print(f"   Haversine vs geodesic: max deviation {report['max_abs_deviation_km']} km "
+              f"({report['max_rel_deviation_pct']}%) over {report['rows_compared']} trips")
+        logging.info(f"Distance validation: {report}")
     
-    def _calculate_distance(self, row):
-        """
-        Calculate distance between pickup and dropoff points
-        Uses Haversine formula (accounts for Earth's curvature)
-        """
-        try:
-            pickup = (
-                float(row['pickup_latitude']), 
-                float(row['pickup_longitude'])
-            )
-            dropoff = (
-                float(row['dropoff_latitude']), 
-                float(row['dropoff_longitude'])
-            )
-            
-            # geodesic calculates the distance between two GPS points
-            distance = geodesic(pickup, dropoff).kilometers
-            return round(distance, 3)
-            
-        except (ValueError, KeyError):
-            return 0
+    def _report_suspicious(self):
+        """Record how many trips each suspicious rule flagged"""
+        
+        report = self.suspicious_engine.report()
+        self.exclusion_log['suspicious_reasons'] = report
+        
+        for entry in report:
+            print(f"      {entry['label']}: {entry['flagged']}")
+        logging.info(f"Suspicious reasons: {report}")
     
     def save_clean_data(self, output_path='data/train_clean.csv'):
         """Save processed data to new CSV file"""
         
         print(f"\nSaving cleaned data to {output_path}...")
         
-        # Get all column names (including new ones we created)
-        if self.clean_data:
-            fieldnames = list(self.clean_data[0].keys())
-            
+        if len(self.clean_data):
             # Write to CSV file
             with open(output_path, 'w', newline='', encoding='utf-8') as file:
-                writer = csv.DictWriter(file, fieldnames=fieldnames)
+                writer = csv.writer(file)
                 
-                # Write header row
-                writer.writeheader()
+                # Write header row (including new columns we created)
+                writer.writerow(self.clean_data.columns)
                 
-                # Write all data rows
-                writer.writerows(self.clean_data)
+                # Typed values are turned back into text only here
+                writer.writerows(self.clean_data.iter_records())
         
         print("   Clean data saved")
         logging.info(f"Saved clean data to {output_path}")
@@ -418,9 +884,9 @@ class DataProcessor:
         print(f"Saving exclusion report to {output_path}...")
         
         # Add summary
-        self.exclusion_log['final_count'] = len(self.clean_data)
+        self.exclusion_log['final_count'] = self._final_count()
         self.exclusion_log['total_removed'] = (
-            self.exclusion_log['original_count'] - 
+            self.exclusion_log['original_count'] -
             self.exclusion_log['final_count']
         )
         
@@ -436,38 +902,107 @@ class DataProcessor:
         """Display processing summary"""
         
         # Count suspicious records
-        suspicious_count = sum(
-            1 for row in self.clean_data 
-            if row.get('is_suspicious') == '1'
-        )
+        if self.stream_result is not None:
+            suspicious_count = self.stream_result['suspicious_count']
+        elif 'is_suspicious' in self.clean_data:
+            suspicious_count = sum(self.clean_data['is_suspicious'])
+        else:
+            suspicious_count = 0
         
         print("\n" + "="*60)
         print("DATA PROCESSING SUMMARY")
         print("="*60)
         print(f"Original records:  {self.exclusion_log['original_count']:,}")
-        print(f"Final records:     {len(self.clean_data):,}")
+        print(f"Final records:     {self._final_count():,}")
         print(f"Total removed:     {self.exclusion_log['total_removed']:,}")
         print(f"Suspicious flags:  {suspicious_count:,}")
         print("="*60)
         
         return self
+    
+    def _final_count(self):
+        """Number of rows that made it through cleaning"""
+        if self.stream_result is not None:
+            return self.stream_result['final_count']
+        return len(self.clean_data)
+
+
+def _worker_processor(settings):
+    """Rebuild a processor inside a worker process"""
+    csv_path, distance_method, validate_distances, suspicious_rules, zones, zone_property = settings
+    processor = DataProcessor(csv_path, distance_method, validate_distances,
+                              suspicious_rules=suspicious_rules, zones=zones, zone_property=zone_property)
+    
+    # A worker only sees its own chunk, so near-duplicates are left to the parent
+    processor.suspicious_engine = SuspiciousRuleEngine(suspicious_rules, track_near_duplicates=False)
+    return processor
+
+
+def _tally_chunk(task):
+    """Process pool entry point for pass 1 of process_parallel()"""
+    settings, fieldnames, start, end, chunk_size = task
+    return _worker_processor(settings)._tally_byte_range(start, end, fieldnames, chunk_size)
+
+
+def _clean_chunk(task):
+    """Process pool entry point for pass 2 of process_parallel()"""
+    settings, fieldnames, start, end, median_passengers, part_path, chunk_size = task
+    return _worker_processor(settings)._clean_byte_range(
+        start, end, fieldnames, median_passengers, part_path, chunk_size
+    )
 
 
 # Run this file directly to process data
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Clean and enrich raw taxi trip data')
+    parser.add_argument('--stream', action='store_true',
+                        help='Process in bounded batches with constant memory instead of loading the whole file')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Clean byte-range chunks of the file in this many processes')
+    parser.add_argument('--dedup-partitions', type=int, default=0,
+                        help='Deduplicate via N on-disk partitions instead of in-memory digests')
+    parser.add_argument('--distance', choices=DISTANCE_METHODS, default='haversine',
+                        help='Distance formula (haversine is batched and much faster)')
+    parser.add_argument('--validate-distances', action='store_true',
+                        help='Also compute exact geodesic distances and report the maximum deviation')
+    parser.add_argument('--suspicious-rules',
+                        help='JSON file of suspicious-trip rules to use instead of the defaults')
+    parser.add_argument('--zones',
+                        help='GeoJSON of taxi zones; adds pickup_zone/dropoff_zone columns')
+    parser.add_argument('--zone-property', default='zone',
+                        help='Feature property holding the zone name (default: zone)')
+    args = parser.parse_args()
+    
+    if args.workers > 1 and args.dedup_partitions:
+        parser.error('--dedup-partitions is not supported together with --workers')
+    
     # Create processor and run full pipeline
-    processor = DataProcessor('data/train.csv')
-    
-    processor.load_data() \
-             .handle_missing_values() \
-             .handle_duplicates() \
-             .handle_invalid_records() \
-             .handle_outliers() \
-             .normalize_timestamps() \
-             .create_derived_features() \
-             .flag_suspicious_records() \
-             .save_clean_data() \
-             .save_exclusion_report() \
-             .print_summary()
-    
-    print("\n Data processing complete!")
\ No newline at end of file
+    processor = DataProcessor(
+        'data/train.csv',
+        distance_method=args.distance,
+        validate_distances=args.validate_distances,
+        dedup_partitions=args.dedup_partitions,
+        suspicious_rules=load_rules(args.suspicious_rules) if args.suspicious_rules else None,
+        zones=args.zones,
+        zone_property=args.zone_property
+    )
+    
+    if args.workers > 1:
+        processor.process_parallel(args.workers) \
+                 .save_exclusion_report() \
+                 .print_summary()
+    elif args.stream:
+        processor.process_stream() \
+                 .save_exclusion_report() \
+                 .print_summary()
+    else:
+        processor.load_data() \
+                 .validate_records() \
+                 .normalize_timestamps() \
+                 .create_derived_features() \
+                 .flag_suspicious_records() \
+                 .save_clean_data() \
+                 .save_exclusion_report() \
+                 .print_summary()
+    
+    print("\n Data processing complete!")
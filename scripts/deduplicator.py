@@ -0,0 +1,180 @@
+"""
+Row Deduplication
+Detects duplicate trip rows using fixed-size digests instead of full copies
+"""
+
+import hashlib  # Built-in hashing (blake2b)
+import os
+import shutil
+import struct  # Built-in binary record packing
+import tempfile
+
+# 16 bytes keeps accidental collisions vanishingly unlikely (~1e-27 for 1.4M rows)
+DIGEST_SIZE = 16
+
+# Spill record header: sequence number, canonical row length, digest
+RECORD_HEADER = struct.Struct(f'<QI{DIGEST_SIZE}s')
+
+
+def row_digest(canonical):
+    """
+    Fixed-size fingerprint of a row
+    Args:
+        canonical: Byte string that is equal for equal rows
+            (see TripBatch.canonical_rows)
+    """
+    return hashlib.blake2b(canonical, digest_size=DIGEST_SIZE).digest()
+
+
+class DigestDeduplicator:
+    """
+    In-memory duplicate detection keeping only a digest per unique row
+    Digest matches are trusted rather than re-checked, since the rows
+    themselves are not kept
+    """
+
+    def __init__(self):
+        self.seen = set()
+
+    def is_first_occurrence(self, canonical):
+        """Check a row against the rows seen so far and remember it"""
+        return self.is_new_digest(row_digest(canonical))
+
+    def is_new_digest(self, digest):
+        """Same as is_first_occurrence(), for a digest computed elsewhere"""
+        if digest in self.seen:
+            return False
+        self.seen.add(digest)
+        return True
+
+    def report(self):
+        """Summary suitable for the exclusion report"""
+        return {
+            'method': 'digest',
+            'digest_bytes': DIGEST_SIZE,
+            'unique_rows': len(self.seen),
+            'collisions_checked': 0,
+            'hash_collisions': 0
+        }
+
+
+class PartitionedDeduplicator:
+    """
+    External duplicate detection for inputs that don't fit in RAM
+    Rows are spilled to partition files by digest, each partition is
+    deduplicated on its own, and every digest match is verified against
+    the full canonical row before it is counted as a duplicate.
+    Usage:
+        with PartitionedDeduplicator() as dedup:
+            for canonical in batch.canonical_rows():
+                dedup.add(canonical)
+            duplicates = dedup.duplicate_sequences()
+    """
+
+    def __init__(self, partitions=64, tmp_dir=None):
+        """
+        Args:
+            partitions: Number of spill files (more = less RAM per partition)
+            tmp_dir: Where to put spill files (defaults to the system temp dir)
+        """
+        self.partitions = partitions
+        self.spill_dir = tempfile.mkdtemp(prefix='dedup_', dir=tmp_dir)
+        self.files = [
+            open(os.path.join(self.spill_dir, f'partition_{i:04d}.bin'), 'w+b')
+            for i in range(partitions)
+        ]
+        self.sequence = 0
+        self.unique_rows = 0
+        self.collisions_checked = 0
+        self.hash_collisions = 0
+
+    def add(self, canonical):
+        """
+        Spill a row's canonical bytes and return its sequence number
+        Sequence numbers count up from 0 in the order rows are added
+        """
+        digest = row_digest(canonical)
+
+        partition = self.files[digest[0] % self.partitions]
+        partition.write(RECORD_HEADER.pack(self.sequence, len(canonical), digest))
+        partition.write(canonical)
+
+        self.sequence += 1
+        return self.sequence - 1
+
+    def duplicate_sequences(self):
+        """
+        Find every row that repeats an earlier one
+        Returns:
+            Set of sequence numbers of the duplicates (first occurrences
+            are never included)
+        """
+        duplicates = set()
+        self.unique_rows = 0
+        self.collisions_checked = 0
+        self.hash_collisions = 0
+
+        for partition in self.files:
+            partition.flush()
+            partition.seek(0)
+
+            # digest -> file offsets of distinct rows sharing that digest
+            first_seen = {}
+            offset = 0
+
+            while True:
+                header = partition.read(RECORD_HEADER.size)
+                if not header:
+                    break
+                sequence, length, digest = RECORD_HEADER.unpack(header)
+                canonical = partition.read(length)
+                record_offset = offset
+                offset += RECORD_HEADER.size + length
+
+                if digest not in first_seen:
+                    first_seen[digest] = [record_offset]
+                    self.unique_rows += 1
+                    continue
+
+                # Same digest: confirm against the full rows before dropping
+                self.collisions_checked += 1
+                if any(self._canonical_at(partition, earlier) == canonical
+                       for earlier in first_seen[digest]):
+                    duplicates.add(sequence)
+                else:
+                    self.hash_collisions += 1
+                    first_seen[digest].append(record_offset)
+                    self.unique_rows += 1
+
+                partition.seek(offset)
+
+        return duplicates
+
+    def _canonical_at(self, partition, offset):
+        """Read back the canonical row stored at a partition offset"""
+        partition.seek(offset)
+        _, length, _ = RECORD_HEADER.unpack(partition.read(RECORD_HEADER.size))
+        return partition.read(length)
+
+    def report(self):
+        """Summary suitable for the exclusion report"""
+        return {
+            'method': 'partitioned',
+            'digest_bytes': DIGEST_SIZE,
+            'partitions': self.partitions,
+            'unique_rows': self.unique_rows,
+            'collisions_checked': self.collisions_checked,
+            'hash_collisions': self.hash_collisions
+        }
+
+    def close(self):
+        """Delete the spill files"""
+        for partition in self.files:
+            partition.close()
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
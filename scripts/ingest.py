@@ -0,0 +1,183 @@
+"""
+Incremental Ingest
+Cleans raw files straight into the database in one streaming pass,
+loading only the rows of each source file that haven't been loaded yet
+(byte-offset watermarks are recorded in the ingest_log table)
+"""
+
+import argparse
+import os
+import sys
+
+# Make the project root importable for database.schema
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.schema import DatabaseSchema
+from data_processor import DataProcessor
+from data_loader import DataLoader
+
+
+def complete_lines_end(path, block_size=65536):
+    """
+    Byte offset just past the last newline in a file
+    A file that is still being appended to may end in a partial line;
+    that line is left for the next ingest.
+    """
+    with open(path, 'rb') as file:
+        end = file.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - block_size)
+            file.seek(start)
+            block = file.read(end - start)
+            newline = block.rfind(b'\n')
+            if newline != -1:
+                return start + newline + 1
+            end = start
+    return 0
+
+
+class IncrementalIngest:
+    """Processes and loads new rows of source files, remembering how far each got"""
+
+    def __init__(self, db_path='database/nyc_taxi.db', bulk=False,
+                 location_scheme=None, keep_raw_coordinates=False):
+        """
+        Args:
+            db_path: Path to SQLite database (created if missing)
+            bulk: Use DataLoader's bulk-load fast path (worth it when a load
+                is large compared to what is already in the database)
+            location_scheme: Passed on to DataLoader (only a new database
+                can choose; later loads must match)
+            keep_raw_coordinates: Passed on to DataLoader
+        """
+        # Tables and indexes are created idempotently, so a fresh database works too
+        schema = DatabaseSchema(db_path)
+        schema.create_tables()
+        schema.create_indexes()
+        schema.close()
+
+        self.bulk = bulk
+        self.loader = DataLoader(db_path, location_scheme=location_scheme,
+                                 keep_raw_coordinates=keep_raw_coordinates)
+        self.connection = self.loader.connection
+        self.cursor = self.connection.cursor()
+
+    def watermark(self, source_path):
+        """Byte offset up to which a source file has been loaded (0 if never)"""
+        self.cursor.execute("""
+            SELECT MAX(end_offset) FROM ingest_log WHERE source_path = ?
+        """, (source_path,))
+        return self.cursor.fetchone()[0] or 0
+
+    def ingest(self, source_path, csv_output=None, **processor_options):
+        """
+        Process and load the rows appended to a source file since its last ingest
+        Rows are cleaned by DataProcessor in streaming mode and each cleaned
+        batch goes straight to DataLoader.load_trip_batch, so nothing is
+        written to or re-parsed from CSV and a new monthly file costs only
+        its own size. If a load is interrupted the watermark is not
+        advanced; re-running is safe because trips already in the database
+        are ignored.
+        Args:
+            source_path: Raw CSV file (same columns as train.csv)
+            csv_output: Also write the cleaned rows to this CSV (optional)
+            processor_options: Passed on to DataProcessor
+        Returns:
+            The ingest_log entry as a dict, or None if there was nothing new
+        """
+        source_path = os.path.abspath(source_path)
+        start = self.watermark(source_path)
+        end = complete_lines_end(source_path)
+
+        print(f"\nIngesting {source_path} (bytes {start:,} to {end:,})...")
+
+        if end < start:
+            raise ValueError(
+                f"{source_path} is shorter than when it was last loaded; "
+                "files must only be appended to"
+            )
+        if end == start:
+            print("   Nothing new to load")
+            return None
+
+        processor = DataProcessor(source_path, byte_range=(start, end), **processor_options)
+
+        self.cursor.execute("SELECT COALESCE(MAX(rowid), 0) FROM trips")
+        rowid_before = self.cursor.fetchone()[0]
+
+        try:
+            if self.bulk:
+                self.loader.start_bulk_load()
+            self.loader.load_vendors()
+            self.loader.load_suspicious_rules(processor.suspicious_rules)
+
+            print("Cleaning and loading trips...")
+            self.loader.reset_load_stats()
+            processor.process_stream(csv_output, sinks=[self.loader.load_trip_batch]) \
+                     .save_exclusion_report() \
+                     .print_summary()
+        finally:
+            self.loader.finish_bulk_load()
+
+        self.cursor.execute("SELECT COALESCE(MAX(rowid), 0) FROM trips")
+        rowid_after = self.cursor.fetchone()[0]
+
+        entry = {
+            'source_path': source_path,
+            'start_offset': start,
+            'end_offset': end,
+            'rows_read': processor.exclusion_log['original_count'],
+            'rows_loaded': self.loader.load_stats['rows_inserted'],
+            'max_pickup_datetime': self.loader.load_stats['max_pickup_datetime'],
+            # New trips got rowids above the previous maximum
+            'first_trip_rowid': rowid_before + 1 if rowid_after > rowid_before else None,
+            'last_trip_rowid': rowid_after if rowid_after > rowid_before else None
+        }
+        self.cursor.execute("""
+            INSERT INTO ingest_log
+            (source_path, start_offset, end_offset, rows_read, rows_loaded,
+             max_pickup_datetime, first_trip_rowid, last_trip_rowid)
+            VALUES (:source_path, :start_offset, :end_offset, :rows_read, :rows_loaded,
+                    :max_pickup_datetime, :first_trip_rowid, :last_trip_rowid)
+        """, entry)
+        self.connection.commit()
+
+        stats = self.loader.load_stats
+        print(f"   Loaded {entry['rows_loaded']:,} new trips from {entry['rows_read']:,} rows "
+              f"in {stats['seconds']:.1f}s ({entry['rows_read'] / max(stats['seconds'], 1e-9):,.0f} raw rows/sec)")
+        return entry
+
+    def close(self):
+        """Close database connection"""
+        self.loader.close()
+
+
+# Run this file directly to load new data
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load only the new rows of raw taxi trip files')
+    parser.add_argument('sources', nargs='+',
+                        help='Raw CSV files; files seen before resume where the last load stopped')
+    parser.add_argument('--db', default='database/nyc_taxi.db',
+                        help='SQLite database to load into')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Defer indexes and use large transactions (for big first loads)')
+    parser.add_argument('--locations',
+                        help='Location scheme for a new database: grid:<meters>, geohash:<chars> or raw')
+    parser.add_argument('--keep-raw-coordinates', action='store_true',
+                        help='Also store exact pickup/dropoff coordinates on each trip')
+    parser.add_argument('--csv',
+                        help='Also write the cleaned rows to this CSV (one source file only)')
+    args = parser.parse_args()
+
+    if args.csv and len(args.sources) > 1:
+        parser.error('--csv can only be used with a single source file')
+
+    ingest = IncrementalIngest(args.db, bulk=args.bulk, location_scheme=args.locations,
+                               keep_raw_coordinates=args.keep_raw_coordinates)
+    try:
+        for source in args.sources:
+            ingest.ingest(source, csv_output=args.csv)
+    finally:
+        ingest.close()
+
+    print("\n Ingest complete!")
@@ -0,0 +1,137 @@
+"""
+API Load Test
+Sends a mix of cheap requests (stats answered from the response cache or
+the rollups) and slow ones (passenger filters that scan trips, each made
+unique so it misses the cache) to a running API at several concurrency
+levels, and reports requests per second and latency percentiles
+Start the server first, e.g. gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+import argparse
+import itertools
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+
+# Answered from the rollups, then from the response cache
+CHEAP_PATHS = [
+    '/api/stats/summary',
+    '/api/stats/hourly',
+    '/api/stats/vendors',
+    '/api/boroughs',
+    '/api/stats/rush-hour',
+    '/api/stats/quantiles?borough=Manhattan',
+    '/api/stats/efficiency',
+    '/api/stats/summary?start_date=2016-03-01&end_date=2016-03-31',
+]
+
+# Passenger filters rule out the rollups, so these scan trips
+SLOW_PATHS = [
+    '/api/stats/summary?vendor_id={vendor}&min_passengers={passengers}',
+    '/api/stats/top-locations?vendor_id={vendor}&max_passengers={passengers}',
+    '/api/stats/daily-patterns?borough=Manhattan&min_passengers={passengers}',
+]
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, round(fraction * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def run_level(base_url, concurrency, duration, slow_share, unique):
+    """
+    Run concurrency client threads for duration seconds
+    Args:
+        base_url: API address, e.g. http://127.0.0.1:5000
+        concurrency: Client threads, each sending one request at a time
+        duration: Seconds to run
+        slow_share: Fraction of requests that are slow
+        unique: Iterator of numbers that make slow requests miss the cache
+    Returns:
+        list of (kind, seconds, HTTP status) per request
+    """
+    results = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(seed):
+        chooser = random.Random(seed)
+        local = []
+        while time.perf_counter() < deadline:
+            if chooser.random() < slow_share:
+                kind = 'slow'
+                path = chooser.choice(SLOW_PATHS).format(
+                    vendor=chooser.choice((1, 2)), passengers=chooser.randint(1, 6)
+                )
+                path += ('&' if '?' in path else '?') + f'run={next(unique)}'
+            else:
+                kind = 'cheap'
+                path = chooser.choice(CHEAP_PATHS)
+
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(base_url + path, timeout=120) as response:
+                    response.read()
+                    status = response.status
+            except urllib.error.HTTPError as error:
+                status = error.code
+            except OSError:
+                status = 0  # Connection refused or reset
+            local.append((kind, time.perf_counter() - start, status))
+        with lock:
+            results.extend(local)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def report(concurrency, duration, results):
+    """One table row: throughput, then p50/p99 in ms overall and per kind"""
+    ok = [seconds for _, seconds, status in results if status == 200]
+    row = [str(concurrency), f"{len(ok) / duration:.1f}"]
+    for kind in (None, 'cheap', 'slow'):
+        latencies = sorted(
+            seconds * 1000 for request_kind, seconds, status in results
+            if status == 200 and kind in (None, request_kind)
+        )
+        for fraction in (0.5, 0.99):
+            value = percentile(latencies, fraction)
+            row.append('-' if value is None else f"{value:.0f}")
+    row.append(str(sum(1 for _, _, status in results if status == 503)))
+    row.append(str(sum(1 for _, _, status in results if status not in (200, 503))))
+    print(''.join(cell.rjust(width) for cell, width in zip(row, COLUMN_WIDTHS)))
+
+
+COLUMNS = ['clients', 'req/s', 'p50', 'p99', 'cheap p50', 'cheap p99', 'slow p50', 'slow p99', '503s', 'errors']
+COLUMN_WIDTHS = [8, 9, 7, 7, 11, 11, 10, 10, 7, 8]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure API throughput and latency under concurrent load')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='Running API server')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 32],
+                        help='Client thread counts to test, one run each')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds per run')
+    parser.add_argument('--slow-share', type=float, default=0.1,
+                        help='Fraction of requests that scan trips (0-1)')
+    args = parser.parse_args()
+    
+    # Warm the cheap requests so every level sees them cached
+    for path in CHEAP_PATHS:
+        urllib.request.urlopen(args.url + path, timeout=120).read()
+    
+    print(f"\n{args.url}: {args.duration:g}s per level, {args.slow_share:.0%} slow requests, latencies in ms\n")
+    print(''.join(name.rjust(width) for name, width in zip(COLUMNS, COLUMN_WIDTHS)))
+    unique = itertools.count(int(time.time()))
+    for concurrency in args.concurrency:
+        results = run_level(args.url, concurrency, args.duration, args.slow_share, unique)
+        report(concurrency, args.duration, results)
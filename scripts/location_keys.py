@@ -0,0 +1,132 @@
+"""
+Location Keys
+Snaps coordinates to integer cell ids so nearby GPS points share one location
+Schemes are written as text so they can be stored in the database:
+    'grid:100'   square cells of about 100 m
+    'geohash:7'  geohash cells of 7 characters (about 150 m x 150 m)
+    'raw'        every distinct coordinate pair is its own location
+"""
+
+import math
+
+DEFAULT_SCHEME = 'grid:100'
+
+METERS_PER_DEGREE_LAT = 111320.0
+
+
+class GridScheme:
+    """Fixed-size cells on a global lat/lon grid, square at a reference latitude"""
+
+    def __init__(self, cell_meters=100, reference_lat=40.7):
+        """
+        Args:
+            cell_meters: Cell edge length in meters
+            reference_lat: Latitude where cells are square (default: NYC)
+        """
+        if cell_meters <= 0:
+            raise ValueError("Grid cell size must be positive")
+        self.cell_meters = cell_meters
+        self.lat_step = cell_meters / METERS_PER_DEGREE_LAT
+        self.lon_step = self.lat_step / math.cos(math.radians(reference_lat))
+        self.columns = math.ceil(360 / self.lon_step)
+
+    def spec(self):
+        return f'grid:{self.cell_meters:g}'
+
+    def key(self, lat, lon):
+        """Integer id of the cell containing a point"""
+        row = int((lat + 90) // self.lat_step)
+        column = int((lon + 180) // self.lon_step)
+        return row * self.columns + column
+
+    def center(self, key):
+        """(lat, lon) of the middle of a cell"""
+        row, column = divmod(key, self.columns)
+        return (
+            (row + 0.5) * self.lat_step - 90,
+            (column + 0.5) * self.lon_step - 180
+        )
+
+
+def _spread_bits(value):
+    """Move the low 32 bits of value to the even bit positions of a 64-bit int"""
+    value &= 0xFFFFFFFF
+    value = (value | (value << 16)) & 0x0000FFFF0000FFFF
+    value = (value | (value << 8)) & 0x00FF00FF00FF00FF
+    value = (value | (value << 4)) & 0x0F0F0F0F0F0F0F0F
+    value = (value | (value << 2)) & 0x3333333333333333
+    value = (value | (value << 1)) & 0x5555555555555555
+    return value
+
+
+def _gather_bits(value):
+    """Inverse of _spread_bits: collect the even bit positions into one int"""
+    value &= 0x5555555555555555
+    value = (value | (value >> 1)) & 0x3333333333333333
+    value = (value | (value >> 2)) & 0x0F0F0F0F0F0F0F0F
+    value = (value | (value >> 4)) & 0x00FF00FF00FF00FF
+    value = (value | (value >> 8)) & 0x0000FFFF0000FFFF
+    value = (value | (value >> 16)) & 0x00000000FFFFFFFF
+    return value
+
+
+class GeohashScheme:
+    """
+    Geohash cells as integers (the geohash bits, not the base-32 text)
+    Longitude and latitude bits are interleaved lon-first as in geohash,
+    so a cell's key shares its leading bits with the cells around it
+    """
+
+    def __init__(self, precision=7):
+        """
+        Args:
+            precision: Geohash length in characters (5 bits each, 1-12)
+        """
+        if not 1 <= precision <= 12:
+            raise ValueError("Geohash precision must be between 1 and 12")
+        self.precision = precision
+        bits = 5 * precision
+        self.lon_bits = (bits + 1) // 2
+        self.lat_bits = bits // 2
+        # With an odd bit count longitude gets the extra (top) bit
+        self.lon_shift = 0 if bits % 2 else 1
+        self.lat_shift = 1 - self.lon_shift
+
+    def spec(self):
+        return f'geohash:{self.precision}'
+
+    def key(self, lat, lon):
+        """Integer geohash of the cell containing a point"""
+        lat_cells = 1 << self.lat_bits
+        lon_cells = 1 << self.lon_bits
+        lat_index = min(int((lat + 90) / 180 * lat_cells), lat_cells - 1)
+        lon_index = min(int((lon + 180) / 360 * lon_cells), lon_cells - 1)
+        return (_spread_bits(lon_index) << self.lon_shift) | (_spread_bits(lat_index) << self.lat_shift)
+
+    def center(self, key):
+        """(lat, lon) of the middle of a cell"""
+        lat_index = _gather_bits(key >> self.lat_shift)
+        lon_index = _gather_bits(key >> self.lon_shift)
+        return (
+            (lat_index + 0.5) / (1 << self.lat_bits) * 180 - 90,
+            (lon_index + 0.5) / (1 << self.lon_bits) * 360 - 180
+        )
+
+
+def make_scheme(spec):
+    """
+    Build a location scheme from its text form
+    Returns:
+        GridScheme or GeohashScheme, or None for 'raw' (no snapping)
+    """
+    kind, _, argument = spec.partition(':')
+    if kind == 'raw':
+        return None
+    try:
+        if kind == 'grid':
+            return GridScheme(float(argument) if argument else 100)
+        if kind == 'geohash':
+            return GeohashScheme(int(argument) if argument else 7)
+    except ValueError as error:
+        raise ValueError(f"Bad location scheme '{spec}': {error}")
+    raise ValueError(f"Unknown location scheme '{spec}' (use grid:<meters>, geohash:<chars> or raw)")
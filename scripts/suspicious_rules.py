@@ -0,0 +1,184 @@
+"""
+Suspicious Trip Rules
+Suspicious-trip checks declared as data and evaluated column by column
+"""
+
+import json
+import operator
+from array import array  # Built-in compact typed arrays
+from itertools import repeat
+from boroughs import UNKNOWN_BOROUGH, classify_boroughs
+from deduplicator import DigestDeduplicator
+
+# Rules in priority order; a rule's bit is 1 << its position in this list,
+# and suspicious_reason names the first rule that fired.
+# A rule either compares a column to a value ('column', 'op', 'value')
+# or runs one of the named CHECKS ('check').
+SUSPICIOUS_RULES = [
+    {'name': 'speed_too_high', 'label': 'Speed too high',
+     'column': 'trip_speed_kmh', 'op': '>', 'value': 80},
+    {'name': 'speed_too_low', 'label': 'Speed too low',
+     'column': 'trip_speed_kmh', 'op': '<', 'value': 5},
+    {'name': 'distance_too_short', 'label': 'Distance too short',
+     'column': 'distance_km', 'op': '<', 'value': 0.1},
+    {'name': 'duration_too_long', 'label': 'Duration over 2 hours',
+     'column': 'trip_duration', 'op': '>', 'value': 7200},
+    {'name': 'zero_displacement', 'label': 'Pickup equals dropoff',
+     'check': 'zero_displacement'},
+    {'name': 'outside_boroughs', 'label': 'Outside the five boroughs',
+     'check': 'outside_boroughs'},
+    {'name': 'duplicate_like', 'label': 'Near-duplicate trip',
+     'check': 'duplicate_like'}
+]
+
+OPERATORS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne
+}
+
+# Decimal places coordinates are rounded to when comparing near-duplicates (~11 m)
+NEAR_DUPLICATE_PRECISION = 4
+
+
+def load_rules(path):
+    """Read a list of rule definitions (same shape as SUSPICIOUS_RULES) from JSON"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _zero_displacement(batch, engine):
+    """Pickup and dropoff at exactly the same coordinates"""
+    return bytearray(map(
+        operator.and_,
+        map(operator.eq, batch['pickup_latitude'], batch['dropoff_latitude']),
+        map(operator.eq, batch['pickup_longitude'], batch['dropoff_longitude'])
+    ))
+
+
+def _outside_boroughs(batch, engine):
+    """Pickup or dropoff outside every borough"""
+    boroughs = []
+    for end in ('pickup', 'dropoff'):
+        column = f'{end}_borough'
+        # Reuse the columns added by the processor's derived features
+        boroughs.append(batch[column] if column in batch else
+                        classify_boroughs(batch[f'{end}_latitude'], batch[f'{end}_longitude']))
+    return bytearray(
+        pickup == UNKNOWN_BOROUGH or dropoff == UNKNOWN_BOROUGH
+        for pickup, dropoff in zip(*boroughs)
+    )
+
+
+def _duplicate_like(batch, engine):
+    """
+    Same vendor, pickup second and (rounded) route as an earlier trip
+    Exact duplicates are already removed, so these are re-sent or
+    double-booked trips with a different id or small differences
+    """
+    if engine.near_duplicates is None:
+        return bytearray(len(batch))  # Resolved by the caller (see near_duplicate_keys)
+    is_first = engine.near_duplicates.is_first_occurrence
+    return bytearray(not is_first(key) for key in near_duplicate_keys(batch))
+
+
+CHECKS = {
+    'zero_displacement': _zero_displacement,
+    'outside_boroughs': _outside_boroughs,
+    'duplicate_like': _duplicate_like
+}
+
+
+def near_duplicate_keys(batch):
+    """Yield the byte key compared by the duplicate_like rule for each row"""
+    digits = NEAR_DUPLICATE_PRECISION
+    for values in zip(
+        batch['vendor_id'], batch['pickup_epoch'],
+        batch['pickup_latitude'], batch['pickup_longitude'],
+        batch['dropoff_latitude'], batch['dropoff_longitude']
+    ):
+        vendor_id, pickup_epoch = values[:2]
+        coordinates = ','.join(f'{value:.{digits}f}' for value in values[2:])
+        yield f'{vendor_id}|{pickup_epoch}|{coordinates}'.encode('utf-8')
+
+
+class SuspiciousRuleEngine:
+    """
+    Compiles rule definitions into column masks and combines them into a
+    bitmask per trip, so every rule that fires is kept, not just the first
+    """
+
+    def __init__(self, rules=None, track_near_duplicates=True):
+        """
+        Args:
+            rules: Rule definitions (defaults to SUSPICIOUS_RULES)
+            track_near_duplicates: Remember trips across batches for the
+                duplicate_like rule. Worker processes only see part of the
+                file, so they turn this off and leave the rule to the parent.
+        """
+        self.rules = SUSPICIOUS_RULES if rules is None else rules
+        if len(self.rules) > 31:
+            raise ValueError("At most 31 suspicious rules fit in the bitmask")
+
+        self.compiled = [(1 << i, self._compile(rule)) for i, rule in enumerate(self.rules)]
+        self.bits = {rule['name']: bit for (bit, _), rule in zip(self.compiled, self.rules)}
+        self.near_duplicates = DigestDeduplicator() if track_near_duplicates else None
+        self.flag_counts = [0] * len(self.rules)  # Trips flagged per rule
+        self._first_labels = {0: ''}  # Bitmask -> label of its lowest rule
+
+    def _compile(self, rule):
+        """Turn one rule definition into a function batch -> 0/1 per row"""
+        if 'check' in rule:
+            if rule['check'] not in CHECKS:
+                raise ValueError(f"Unknown suspicious check: {rule['check']}")
+            check = CHECKS[rule['check']]
+            return lambda batch: check(batch, self)
+
+        if rule.get('op') not in OPERATORS:
+            raise ValueError(f"Unknown operator in rule {rule['name']}: {rule.get('op')}")
+        compare = OPERATORS[rule['op']]
+        column, value = rule['column'], rule['value']
+        return lambda batch: bytearray(map(compare, batch[column], repeat(value)))
+
+    def flag(self, batch):
+        """
+        Evaluate every rule over a batch and add the result columns
+        (is_suspicious, suspicious_reason, suspicious_flags)
+        Returns:
+            array of bitmasks, one per row
+        """
+        weighted = [map(operator.mul, mask(batch), repeat(bit)) for bit, mask in self.compiled]
+        flags = array('i', map(sum, zip(*weighted))) if weighted else array('i', bytes(4 * len(batch)))
+
+        batch.add_column('is_suspicious', array('b', (flag != 0 for flag in flags)))
+        batch.add_column('suspicious_reason', [self.reason(flag) for flag in flags])
+        batch.add_column('suspicious_flags', flags)
+        self.tally(flags)
+        return flags
+
+    def reason(self, flags):
+        """Label of the highest-priority rule in a bitmask ('' if none)"""
+        try:
+            return self._first_labels[flags]
+        except KeyError:
+            lowest = (flags & -flags).bit_length() - 1
+            label = self._first_labels[flags] = self.rules[lowest]['label']
+            return label
+
+    def tally(self, flags):
+        """Add a batch of bitmasks to the per-rule counts"""
+        for flag in flags:
+            while flag:
+                lowest = flag & -flag
+                self.flag_counts[lowest.bit_length() - 1] += 1
+                flag ^= lowest
+
+    def report(self):
+        """Per-rule summary suitable for the exclusion report"""
+        return [
+            {'rule': rule['name'], 'label': rule['label'], 'bit': bit, 'flagged': count}
+            for rule, (bit, _), count in zip(self.rules, self.compiled, self.flag_counts)
+        ]
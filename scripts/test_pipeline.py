@@ -0,0 +1,577 @@
+"""
+Test Data Pipeline
+Checks the cleaning and loading stages on small synthetic inputs
+Run with python scripts/test_pipeline.py (or pytest scripts/test_pipeline.py)
+"""
+
+import contextlib
+import csv
+import io
+import json
+import math
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+# The pipeline modules import each other by name from scripts/, and
+# database.schema from the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from distance_engine import DeviationTracker, geodesic_km, haversine_km, speeds_kmh
+from data_processor import DataProcessor
+from boroughs import UNKNOWN_BOROUGH, BoundaryIndex, classify_boroughs, default_index
+from data_loader import DataLoader
+from deduplicator import DigestDeduplicator, PartitionedDeduplicator
+from ingest import IncrementalIngest
+from suspicious_rules import SUSPICIOUS_RULES, SuspiciousRuleEngine, load_rules
+from database.schema import DatabaseSchema
+from trip_batch import TripBatch
+
+RAW_COLUMNS = ['id', 'vendor_id', 'pickup_datetime', 'dropoff_datetime', 'passenger_count',
+               'pickup_longitude', 'pickup_latitude', 'dropoff_longitude', 'dropoff_latitude',
+               'store_and_fwd_flag', 'trip_duration']
+
+NAN = float('nan')
+INF = float('inf')
+
+# Times Square to the Empire State Building, about 1.1 km apart
+TIMES_SQUARE = (40.7580, -73.9855)
+EMPIRE_STATE = (40.7484, -73.9857)
+
+# Places with a known borough, including piers, islands and the shoreline
+LANDMARKS = [
+    ('Times Square', 40.7580, -73.9855, 'Manhattan'),
+    ('Whitehall ferry terminal', 40.7013, -74.0131, 'Manhattan'),
+    ('Pier 11 Wall St', 40.7033, -74.0058, 'Manhattan'),
+    ('Chelsea Piers', 40.7465, -74.0085, 'Manhattan'),
+    ('Roosevelt Island', 40.7616, -73.9493, 'Manhattan'),
+    ('Governors Island', 40.6895, -74.0168, 'Manhattan'),
+    ('Marble Hill', 40.8762, -73.9104, 'Manhattan'),
+    ('JFK Terminal 4', 40.6441, -73.7823, 'Queens'),
+    ('LaGuardia Terminal B', 40.7740, -73.8716, 'Queens'),
+    ('Far Rockaway', 40.6050, -73.7550, 'Queens'),
+    ('Long Island City', 40.7460, -73.9580, 'Queens'),
+    ('DUMBO', 40.7033, -73.9881, 'Brooklyn'),
+    ('Red Hook', 40.6720, -74.0110, 'Brooklyn'),
+    ('Coney Island', 40.5730, -73.9790, 'Brooklyn'),
+    ('Yankee Stadium', 40.8296, -73.9262, 'Bronx'),
+    ('City Island', 40.8470, -73.7870, 'Bronx'),
+    ('St George ferry terminal', 40.6437, -74.0736, 'Staten Island'),
+    ('Tottenville', 40.5120, -74.2460, 'Staten Island'),
+]
+
+# Inside the processor's NYC bounding box, but in no borough
+OUTSIDE_CITY = [
+    ('Hoboken', 40.7440, -74.0320),
+    ('Newark Airport', 40.6895, -74.1745),
+    ('Yonkers', 40.9310, -73.8990),
+    ('Valley Stream', 40.6640, -73.7080),
+    ('Hudson River', 40.7600, -74.0150),
+    ('Upper Bay', 40.6600, -74.0500),
+    ('Jamaica Bay', 40.6150, -73.8600),
+]
+
+# Enriched trips for the suspicious rules: what each one should trip, then its columns
+FLAGGED_COLUMNS = ['vendor_id', 'pickup_epoch', 'pickup_latitude', 'pickup_longitude',
+                   'dropoff_latitude', 'dropoff_longitude', 'distance_km', 'trip_speed_kmh',
+                   'trip_duration', 'pickup_borough', 'dropoff_borough']
+FLAGGED_TRIPS = [
+    ([], ['1', '1456819200', '40.758', '-73.9855', '40.7484', '-73.9857', '1.1', '20', '600',
+          'Manhattan', 'Manhattan']),
+    (['speed_too_high', 'distance_too_short', 'duration_too_long'],
+     ['2', '1456819260', '40.75', '-73.99', '40.7504', '-73.99', '0.05', '100', '7300',
+      'Manhattan', 'Manhattan']),
+    (['speed_too_low', 'distance_too_short', 'zero_displacement'],
+     ['1', '1456819320', '40.76', '-73.98', '40.76', '-73.98', '0', '0', '900',
+      'Manhattan', 'Manhattan']),
+    (['outside_boroughs'],
+     ['2', '1456819380', '40.64', '-73.78', '40.7484', '-73.9857', '20', '40', '1800',
+      'Unknown', 'Manhattan']),
+    (['duplicate_like'],  # Same vendor, pickup second and route as the first trip
+     ['1', '1456819200', '40.75801', '-73.98549', '40.7484', '-73.9857', '1.1', '20', '600',
+      'Manhattan', 'Manhattan']),
+]
+
+
+def test_haversine_non_finite():
+    """NaN or infinite coordinates give a NaN distance and speed, not half the globe"""
+    bad_values = [NAN, INF, -INF]
+    pickup_lats = [TIMES_SQUARE[0]] + bad_values + [TIMES_SQUARE[0]] * 3
+    pickup_lons = [TIMES_SQUARE[1]] * 4 + bad_values
+    dropoff_lats = [EMPIRE_STATE[0]] * 7
+    dropoff_lons = [EMPIRE_STATE[1]] * 7
+
+    for distances in (haversine_km(pickup_lats, pickup_lons, dropoff_lats, dropoff_lons),
+                      geodesic_km(pickup_lats, pickup_lons, dropoff_lats, dropoff_lons)):
+        assert 1.0 < distances[0] < 1.2
+        assert all(math.isnan(distance) for distance in distances[1:])
+
+    speeds = speeds_kmh(haversine_km(pickup_lats, pickup_lons, dropoff_lats, dropoff_lons), [600] * 7)
+    assert 6 < speeds[0] < 7
+    assert all(math.isnan(speed) for speed in speeds[1:])
+
+    # Trips without a distance are left out of the deviation report
+    tracker = DeviationTracker()
+    tracker.update(haversine_km(pickup_lats, pickup_lons, dropoff_lats, dropoff_lons),
+                   geodesic_km(pickup_lats, pickup_lons, dropoff_lats, dropoff_lons))
+    report = tracker.report()
+    assert report['rows_compared'] == 1
+    assert report['max_abs_deviation_km'] < 0.01
+
+
+def write_raw_trips(path, vendor_ids):
+    """Write a raw train.csv with one 10-minute Midtown trip per vendor_id cell"""
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(RAW_COLUMNS)
+        for i, vendor_id in enumerate(vendor_ids):
+            writer.writerow([
+                f'id{i}', vendor_id, f'2016-03-01 08:{i:02d}:00', f'2016-03-01 08:{i + 10:02d}:00', 1,
+                TIMES_SQUARE[1] + i / 1000, TIMES_SQUARE[0], EMPIRE_STATE[1], EMPIRE_STATE[0] + i / 1000,
+                'N', 600
+            ])
+
+
+def write_mixed_trips(path, count=300, seed=7):
+    """
+    Write a raw train.csv that trips every cleaning rule
+    Besides ordinary Manhattan trips there are blank passenger counts,
+    missing and out-of-range values, and exact and near-duplicate copies
+    of the first rows appended at the end, so a copy and its original
+    are always far apart in the file
+    """
+    chooser = random.Random(seed)
+    start = datetime(2016, 3, 1)
+    rows = []
+    for i in range(count):
+        pickup = start + timedelta(seconds=i * 613)
+        duration = chooser.choice([chooser.randint(60, 3600)] * 8 + [30, 12000])
+        rows.append([
+            f'id{i}', chooser.choice([1, 2]), pickup.strftime('%Y-%m-%d %H:%M:%S'),
+            (pickup + timedelta(seconds=duration)).strftime('%Y-%m-%d %H:%M:%S'),
+            chooser.choice([1, 1, 1, 2, 2, 3, 5, 6, 0, 7, '']),
+            round(chooser.uniform(-74.01, -73.93), 6), round(chooser.uniform(40.70, 40.80), 6),
+            round(chooser.uniform(-74.01, -73.93), 6), round(chooser.uniform(40.70, 40.80), 6),
+            'N', duration
+        ])
+        if i % 40 == 5:
+            rows[-1][chooser.choice([2, 5, 8])] = ''  # Missing critical value
+        elif i % 40 == 15:
+            rows[-1][6] = 42.0  # Pickup far outside NYC
+
+    # Exact repeats, then re-sent trips that only differ in id and flag
+    rows += [list(row) for row in rows[:20:2]]
+    rows += [[f'resent{i}'] + row[1:-2] + ['Y', row[-1]] for i, row in enumerate(rows[1:20:2])]
+
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(RAW_COLUMNS)
+        writer.writerows(rows)
+
+
+def clean_in_memory(raw_path, clean_path, **options):
+    """Run the in-memory pipeline from raw_path to clean_path and return the processor"""
+    processor = DataProcessor(raw_path, **options)
+    processor.load_data() \
+             .validate_records() \
+             .normalize_timestamps() \
+             .create_derived_features() \
+             .flag_suspicious_records() \
+             .save_clean_data(clean_path)
+    return processor
+
+
+def read_bytes(path):
+    """Whole file as bytes"""
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+@contextlib.contextmanager
+def working_folder():
+    """Run inside a temporary folder with print output silenced"""
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder, contextlib.redirect_stdout(io.StringIO()):
+        os.chdir(folder)  # DataProcessor writes its logs under logs/
+        try:
+            yield folder
+        finally:
+            os.chdir(previous)
+
+
+def create_database(path):
+    """New database with every table and index"""
+    schema = DatabaseSchema(path)
+    schema.create_tables()
+    schema.create_indexes()
+    schema.close()
+
+
+def loaded_vendor_ids(path):
+    """vendor_id of every trip in a database"""
+    connection = sqlite3.connect(path)
+    vendor_ids = [row[0] for row in connection.execute("SELECT vendor_id FROM trips")]
+    connection.close()
+    return vendor_ids
+
+
+def test_loaders_skip_invalid_integers():
+    """load_trips and load_trip_batch skip the same rows with a non-numeric vendor_id"""
+    with tempfile.TemporaryDirectory() as folder, contextlib.redirect_stdout(io.StringIO()):
+        clean_path = os.path.join(folder, 'train_clean.csv')
+        write_raw_trips(clean_path, [1, 2, 'abc', 1, '', 2])
+
+        # The cleaned columns the loader reads, as the processor would add them
+        with open(clean_path, newline='', encoding='utf-8') as file:
+            records = list(csv.reader(file))
+        fieldnames = records.pop(0) + ['pickup_epoch', 'dropoff_epoch', 'distance_km', 'trip_speed_kmh',
+                                        'fare_per_km', 'is_suspicious', 'suspicious_reason', 'suspicious_flags']
+        records = [record + [str(1456819200 + 28800 + i * 60), str(1456819200 + 29400 + i * 60),
+                             '1.1', '6.6', '', '0', '', '0'] for i, record in enumerate(records)]
+        with open(clean_path, 'w', newline='', encoding='utf-8') as file:
+            csv.writer(file).writerows([fieldnames] + records)
+
+        csv_db, batch_db = os.path.join(folder, 'csv.db'), os.path.join(folder, 'batch.db')
+        for path in (csv_db, batch_db):
+            create_database(path)
+            loader = DataLoader(path)
+            loader.load_vendors()
+            loader.load_suspicious_rules()
+            if path == csv_db:
+                loader.load_locations(clean_path)
+                loader.load_trips(clean_path)
+            else:
+                loader.reset_load_stats()
+                loader.load_trip_batch(TripBatch.from_records(fieldnames, records))
+            loader.close()
+
+        csv_vendors, batch_vendors = loaded_vendor_ids(csv_db), loaded_vendor_ids(batch_db)
+        assert sorted(csv_vendors) == sorted(batch_vendors) == [1, 1, 2, 2]
+
+
+def test_ingest_matches_csv_route():
+    """A raw file with non-numeric vendor_ids loads the same trips through ingest.py and the CSV route"""
+    vendor_ids = [1, 2, 'abc', 1, 'x7', 2, '', 1, 2, 1]
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder, contextlib.redirect_stdout(io.StringIO()):
+        os.chdir(folder)  # DataProcessor writes its logs under logs/
+        try:
+            raw_path = os.path.join(folder, 'train.csv')
+            clean_path = os.path.join(folder, 'train_clean.csv')
+            write_raw_trips(raw_path, vendor_ids)
+
+            DataProcessor(raw_path).load_data() \
+                                   .validate_records() \
+                                   .normalize_timestamps() \
+                                   .create_derived_features() \
+                                   .flag_suspicious_records() \
+                                   .save_clean_data(clean_path)
+            csv_db = os.path.join(folder, 'csv.db')
+            create_database(csv_db)
+            loader = DataLoader(csv_db)
+            loader.load_vendors()
+            loader.load_suspicious_rules()
+            loader.load_locations(clean_path)
+            loader.load_trips(clean_path)
+            loader.close()
+
+            ingest_db = os.path.join(folder, 'ingest.db')
+            ingest = IncrementalIngest(ingest_db)
+            ingest.ingest(raw_path)
+            ingest.close()
+        finally:
+            os.chdir(previous)
+
+        csv_vendors, ingest_vendors = loaded_vendor_ids(csv_db), loaded_vendor_ids(ingest_db)
+        assert len(csv_vendors) == len(ingest_vendors) == 7
+        assert min(csv_vendors + ingest_vendors) == 1
+
+
+def test_loaders_keep_unreadable_dropoff_times():
+    """A trip whose dropoff time can't be parsed is still loaded by both routes; one with a bad pickup time isn't"""
+    with working_folder() as folder:
+        write_raw_trips('train.csv', [1] * 5)
+        with open('train.csv', newline='', encoding='utf-8') as file:
+            records = list(csv.reader(file))
+        records[2][3] = '2016-03-01 8:11'  # Dropoff time in the wrong format
+        records[4][2] = 'yesterday'  # Pickup time that can't be read
+        with open('train.csv', 'w', newline='', encoding='utf-8') as file:
+            csv.writer(file).writerows(records)
+
+        csv_db, batch_db = os.path.join(folder, 'csv.db'), os.path.join(folder, 'batch.db')
+        for path in (csv_db, batch_db):
+            create_database(path)
+
+        clean_in_memory('train.csv', 'train_clean.csv')
+        loader = DataLoader(csv_db)
+        loader.load_vendors()
+        loader.load_suspicious_rules()
+        loader.load_locations('train_clean.csv')
+        loader.load_trips('train_clean.csv')
+        loader.close()
+
+        loader = DataLoader(batch_db)
+        loader.load_vendors()
+        loader.load_suspicious_rules()
+        loader.reset_load_stats()
+        DataProcessor('train.csv').process_stream(None, chunk_size=2, sinks=[loader.load_trip_batch])
+        loader.close()
+
+        for path in (csv_db, batch_db):
+            connection = sqlite3.connect(path)
+            trips = dict(connection.execute("SELECT trip_id, dropoff_datetime FROM trips"))
+            connection.close()
+            assert sorted(trips) == ['id0', 'id1', 'id2', 'id4']
+            assert trips['id1'] == '2016-03-01 8:11'
+
+
+def test_stream_matches_in_memory():
+    """process_stream writes the same bytes and rule counts as the in-memory pipeline"""
+    with working_folder():
+        write_mixed_trips('train.csv')
+        in_memory = clean_in_memory('train.csv', 'memory.csv')
+        stream = DataProcessor('train.csv').process_stream('stream.csv', chunk_size=17)
+
+        assert read_bytes('stream.csv') == read_bytes('memory.csv')
+        assert stream.exclusion_log['rules'] == in_memory.exclusion_log['rules']
+        assert stream.stream_result['final_count'] == len(in_memory.clean_data)
+
+        # Every rule had something to reject
+        removed = {entry['rule']: entry['removed'] for entry in in_memory.exclusion_log['rules']}
+        for rule in ('missing_critical_value', 'duplicate', 'pickup_outside_nyc',
+                     'passenger_count_out_of_range', 'duration_under_1_minute', 'duration_over_3_hours'):
+            assert removed[rule] > 0, rule
+
+
+def test_passenger_median_fill():
+    """Blank passenger counts get the median of the complete rows, in memory and streamed"""
+    with working_folder():
+        # Median of the complete rows is 4 (the mean is 3.4, the mode 1);
+        # the incomplete rows' 6s must not count
+        write_raw_trips('train.csv', [1] * 11)
+        with open('train.csv', newline='', encoding='utf-8') as file:
+            records = list(csv.reader(file))
+        for record, passengers in zip(records[1:], [1, 1, 1, 4, 5, 6, 6, '', '', 6, 6]):
+            record[4] = passengers
+        records[10][2] = records[11][2] = ''  # No pickup time
+        with open('train.csv', 'w', newline='', encoding='utf-8') as file:
+            csv.writer(file).writerows(records)
+
+        clean_in_memory('train.csv', 'memory.csv')
+        DataProcessor('train.csv').process_stream('stream.csv', chunk_size=3)
+
+        for path in ('memory.csv', 'stream.csv'):
+            with open(path, newline='', encoding='utf-8') as file:
+                passengers = {row['id']: row['passenger_count'] for row in csv.DictReader(file)}
+            assert passengers == {'id0': '1', 'id1': '1', 'id2': '1', 'id3': '4', 'id4': '5',
+                                  'id5': '6', 'id6': '6', 'id7': '4', 'id8': '4'}
+
+
+def test_parallel_matches_in_memory():
+    """process_parallel writes the same bytes and rule counts as the in-memory pipeline"""
+    with working_folder():
+        write_mixed_trips('train.csv')
+        in_memory = clean_in_memory('train.csv', 'memory.csv')
+        parallel = DataProcessor('train.csv').process_parallel(3, 'parallel.csv', chunk_size=11)
+
+        assert read_bytes('parallel.csv') == read_bytes('memory.csv')
+        assert parallel.exclusion_log['rules'] == in_memory.exclusion_log['rules']
+        assert parallel.stream_result['suspicious_count'] == sum(in_memory.clean_data['is_suspicious'])
+
+
+def test_parallel_near_duplicates_across_chunks():
+    """A re-sent trip in a later byte-range chunk than its original is still flagged"""
+    with working_folder():
+        write_raw_trips('train.csv', [1] * 40)
+        with open('train.csv', newline='', encoding='utf-8') as file:
+            records = list(csv.reader(file))
+        records.append(['resent'] + records[1][1:])  # Same trip as id0 under a new id
+        records.append(list(records[2]))  # Exact copy of id1
+        with open('train.csv', 'w', newline='', encoding='utf-8') as file:
+            csv.writer(file).writerows(records)
+
+        # The copies are in the last chunk, their originals in the first
+        processor = DataProcessor('train.csv')
+        _, ranges = processor._byte_ranges(2 * 4)
+        assert len(ranges) == 8
+        with open('train.csv', 'rb') as file:
+            lines = file.readlines()
+        first_end, last_start = ranges[0][1], ranges[-1][0]
+        assert len(lines[0]) + len(lines[1]) + len(lines[2]) <= first_end
+        assert sum(map(len, lines[:-2])) >= last_start
+
+        in_memory = clean_in_memory('train.csv', 'memory.csv')
+        processor.process_parallel(2, 'parallel.csv', chunk_size=4)
+        assert read_bytes('parallel.csv') == read_bytes('memory.csv')
+
+        with open('parallel.csv', newline='', encoding='utf-8') as file:
+            rows = {row['id']: row for row in csv.DictReader(file)}
+        near_duplicate_bit = processor.suspicious_engine.bits['duplicate_like']
+        assert len(rows) == 41
+        assert int(rows['resent']['suspicious_flags']) & near_duplicate_bit
+        assert not int(rows['id0']['suspicious_flags']) & near_duplicate_bit
+        assert processor.exclusion_log['rules'] == in_memory.exclusion_log['rules']
+
+
+def test_partitioned_dedup_matches_digest():
+    """PartitionedDeduplicator finds exactly the rows DigestDeduplicator calls repeats"""
+    chooser = random.Random(3)
+    rows = [f'trip,{chooser.randint(0, 150)}'.encode('utf-8') for _ in range(500)]
+
+    digest = DigestDeduplicator()
+    expected = {sequence for sequence, row in enumerate(rows) if not digest.is_first_occurrence(row)}
+    with PartitionedDeduplicator(partitions=4) as partitioned:
+        for row in rows:
+            partitioned.add(row)
+        assert partitioned.duplicate_sequences() == expected
+        assert partitioned.report()['unique_rows'] == digest.report()['unique_rows'] == len(set(rows))
+
+    # Through the processor, both methods keep the same rows
+    with working_folder():
+        write_mixed_trips('train.csv')
+        in_memory = clean_in_memory('train.csv', 'digest.csv')
+        partitioned = clean_in_memory('train.csv', 'partitioned.csv', dedup_partitions=4)
+        DataProcessor('train.csv', dedup_partitions=4).process_stream('stream.csv', chunk_size=17)
+
+        assert read_bytes('partitioned.csv') == read_bytes('stream.csv') == read_bytes('digest.csv')
+        assert partitioned.exclusion_log['rules'] == in_memory.exclusion_log['rules']
+
+
+def test_suspicious_bitmask_and_reason():
+    """Every rule that fires sets its bit; the reason names the first one in rule order"""
+    bits = {rule['name']: 1 << i for i, rule in enumerate(SUSPICIOUS_RULES)}
+    labels = {rule['name']: rule['label'] for rule in SUSPICIOUS_RULES}
+    expected_flags = [sum(bits[name] for name in names) for names, _ in FLAGGED_TRIPS]
+
+    engine = SuspiciousRuleEngine()
+    assert engine.bits == bits
+
+    # Split over two batches, so the near-duplicate is found across batches
+    records = [record for _, record in FLAGGED_TRIPS]
+    first = TripBatch.from_records(FLAGGED_COLUMNS, records[:2])
+    second = TripBatch.from_records(FLAGGED_COLUMNS, records[2:])
+    flags = list(engine.flag(first)) + list(engine.flag(second))
+    assert flags == expected_flags
+
+    reasons = first['suspicious_reason'] + second['suspicious_reason']
+    assert reasons == [labels[names[0]] if names else '' for names, _ in FLAGGED_TRIPS]
+    assert list(first['is_suspicious']) + list(second['is_suspicious']) == [0, 1, 1, 1, 1]
+
+    # Each rule is counted once per trip that fired it, not just the first
+    counts = {entry['rule']: entry['flagged'] for entry in engine.report()}
+    assert counts == {'speed_too_high': 1, 'speed_too_low': 1, 'distance_too_short': 2,
+                      'duration_too_long': 1, 'zero_displacement': 1, 'outside_boroughs': 1,
+                      'duplicate_like': 1}
+
+
+def test_load_rules():
+    """A rules file replaces the defaults, and its order decides the bits and the reason"""
+    rules = [
+        {'name': 'long_trip', 'label': 'Long trip', 'column': 'trip_duration', 'op': '>=', 'value': 7300},
+        {'name': 'fast_trip', 'label': 'Fast trip', 'column': 'trip_speed_kmh', 'op': '>', 'value': 30},
+        {'name': 'same_spot', 'label': 'Same spot', 'check': 'zero_displacement'}
+    ]
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'rules.json')
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(rules, file)
+        loaded = load_rules(path)
+    assert loaded == rules
+
+    engine = SuspiciousRuleEngine(loaded)
+    batch = TripBatch.from_records(FLAGGED_COLUMNS, [record for _, record in FLAGGED_TRIPS])
+    assert list(engine.flag(batch)) == [0, 1 | 2, 4, 2, 0]
+    assert batch['suspicious_reason'] == ['', 'Long trip', 'Same spot', 'Fast trip', '']
+
+    # Mistakes in a rules file are reported before any trip is flagged
+    for broken in ({'name': 'bad', 'label': 'Bad', 'column': 'trip_duration', 'op': '=>', 'value': 1},
+                   {'name': 'bad', 'label': 'Bad', 'check': 'no_such_check'}):
+        try:
+            SuspiciousRuleEngine([broken])
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"accepted {broken}")
+
+
+def test_borough_landmarks():
+    """Known places get their borough, and places outside the city are Unknown"""
+    for name, lat, lon, borough in LANDMARKS:
+        assert default_index().classify(lat, lon) == borough, name
+    for name, lat, lon in OUTSIDE_CITY:
+        assert default_index().classify(lat, lon) == UNKNOWN_BOROUGH, name
+
+    lats = [lat for _, lat, _, _ in LANDMARKS] + [lat for _, lat, _ in OUTSIDE_CITY] + [NAN, 0.0]
+    lons = [lon for _, _, lon, _ in LANDMARKS] + [lon for _, _, lon in OUTSIDE_CITY] + [-73.98, 0.0]
+    expected = [borough for _, _, _, borough in LANDMARKS] + [UNKNOWN_BOROUGH] * (len(OUTSIDE_CITY) + 2)
+    assert classify_boroughs(lats, lons) == expected
+
+
+def ray_cast(index, lat, lon):
+    """Reference answer: test the point against every edge of every area"""
+    for name, edges in index.areas:
+        inside = False
+        for x1, y1, x2, y2 in edges:
+            if (y1 > lat) != (y2 > lat) and lon < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+        if inside:
+            return name
+    return UNKNOWN_BOROUGH
+
+
+def test_boundary_index_cell_borders():
+    """Points on grid cell borders get the same answer as testing every edge"""
+    # Two unit squares side by side, the left one with a hole; with quarter
+    # degree cells the squares' sides run along cell borders
+    def square(left, bottom, size):
+        return [[left, bottom], [left + size, bottom], [left + size, bottom + size],
+                [left, bottom + size], [left, bottom]]
+
+    zones = {'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'properties': {'zone': 'West'},
+         'geometry': {'type': 'Polygon', 'coordinates': [square(0, 0, 1), square(0.3, 0.3, 0.2)]}},
+        {'type': 'Feature', 'properties': {'zone': 'East'},
+         'geometry': {'type': 'Polygon', 'coordinates': [square(1, 0, 1)]}}
+    ]}
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'zones.geojson')
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(zones, file)
+        index = BoundaryIndex(path, name_property='zone', cell_degrees=0.25, snap_degrees=0)
+        snapping = BoundaryIndex(path, name_property='zone', cell_degrees=0.25, snap_degrees=0.1)
+
+    grid = [i / 8 for i in range(-2, 18)]  # Cell borders and cell centers
+    points = [(y, x) for y in grid[:12] for x in grid if 0 < y < 1 and x not in (0, 1, 2)]
+    assert [index.classify(lat, lon) for lat, lon in points] == [ray_cast(index, lat, lon) for lat, lon in points]
+    assert index.classify(0.5, 0.25) == 'West'
+    assert index.classify(0.4, 0.4) == UNKNOWN_BOROUGH  # In the hole
+    assert index.classify(0.5, 1.75) == 'East'
+
+    # Within snap distance of a border counts as the nearest area, further out doesn't
+    assert snapping.classify(0.5, 2.05) == 'East'
+    assert snapping.classify(1.05, 0.2) == 'West'
+    assert snapping.classify(0.5, 2.15) == UNKNOWN_BOROUGH
+    assert snapping.classify(0.4, 0.42) == 'West'  # 0.08 from the hole's east side
+
+    # The shipped boroughs, on the borders of their grid cells
+    boroughs = default_index()
+    step = boroughs.cell_degrees
+    points = [
+        (boroughs.bottom + row * step, boroughs.left + column * step + offset)
+        for row in range(0, boroughs.rows, 7) for column in range(0, boroughs.columns, 3)
+        for offset in (0, step / 2)
+    ]
+    snapped = BoundaryIndex(snap_degrees=0)
+    assert [snapped.classify(lat, lon) for lat, lon in points] == [ray_cast(snapped, lat, lon) for lat, lon in points]
+
+
+if __name__ == '__main__':
+    tests = [(name, test) for name, test in list(globals().items()) if name.startswith('test_')]
+    for name, test in tests:
+        test()
+        print(f"   {name}: passed")
+    print(f"\n All {len(tests)} pipeline tests passed")
@@ -3,7 +3,54 @@ Test Database Queries
 Verifies database works correctly and efficiently
 """
 
+import contextlib
+import math
 import sqlite3
+import subprocess
+import sys
+import os
+
+# app.py lives in the project root
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+# Tables that grow with every trip; the rollup and lookup tables stay small
+TRIP_TABLES = ('trips', 'trip_metrics')
+
+# Query strings for endpoints whose filters take other query paths
+ENDPOINT_ARGS = {
+    '/api/trips': ['', '?vendor_id=2', '?start_date=2016-03-01', '?vendor_id=1&start_date=2016-03-01',
+                   '?cursor=1456790988-1', '?vendor_id=2&end_date=2016-03-31&cursor=1456790988-1'],
+    '/api/trips/export': ['?start_date=2016-03-01&end_date=2016-03-07', '?vendor_id=1&format=json&end_date=2016-01-02'],
+    '/api/suspicious': ['', '?reason=speed_too_high'],
+}
+
+# Filters the quantile sketches are kept by, with the same filter as SQL
+# over trips t, trip_metrics m and the pickup location l
+SKETCH_FILTERS = [
+    ('', '1=1', []),
+    ('?borough=Manhattan', "COALESCE(l.borough, 'Unknown') = ?", ['Manhattan']),
+    ('?vendor_id=2&start_hour=7&end_hour=9', 't.vendor_id = ? AND t.pickup_hour BETWEEN ? AND ?', [2, 7, 9]),
+]
+
+# Stored column of each sketched metric
+SKETCH_COLUMNS = {'duration': 't.trip_duration', 'distance': 'm.distance_km', 'speed': 'm.trip_speed_kmh'}
+
+# Every stat /api/batch serves, unfiltered and with each kind of filter
+BATCH_STATS = ('summary,vendors,hourly,daily-patterns,monthly-trends,rush-hour,boroughs,top-locations,'
+               'duration-distribution,distance-distribution,speed-distribution,passenger-distribution,'
+               'suspicious,efficiency')
+
+# Filters tried on every stats endpoint: rollup-only filters, and ones that
+# need the trips (passenger counts) so the planner picks the indexed scan
+STATS_FILTER_ARGS = [
+    '?start_date=2016-03-01&end_date=2016-03-31&borough=Manhattan&start_hour=7&end_hour=9',
+    '?start_date=2016-03-01&end_date=2016-03-07&min_passengers=2',
+    '?vendor_id=1&max_passengers=1',
+    '?borough=Queens&min_passengers=3',
+]
+
+ENDPOINT_ARGS['/api/batch'] = [f'?stats={BATCH_STATS}'] + [f'{args}&stats={BATCH_STATS}' for args in STATS_FILTER_ARGS]
 
 def run_test_queries():
     """Run sample queries to test database"""
@@ -36,7 +83,7 @@ def run_test_queries():
             ROUND(AVG(m.trip_speed_kmh), 2) as avg_speed_kmh
         FROM trips t
         JOIN vendors v ON t.vendor_id = v.vendor_id
-        JOIN trip_metrics m ON t.trip_id = m.trip_id
+        JOIN trip_metrics m ON t.trip_rowid = m.trip_rowid
         GROUP BY v.vendor_name
     """)
     
@@ -52,7 +99,7 @@ def run_test_queries():
     print("-" * 40)
     cursor.execute("""
         SELECT 
-            CAST(strftime('%H', pickup_datetime) AS INTEGER) as hour,
+            pickup_hour as hour,
             COUNT(*) as trip_count
         FROM trips
         GROUP BY hour
@@ -110,7 +157,8 @@ def run_test_queries():
     cursor.execute("""
         EXPLAIN QUERY PLAN
         SELECT * FROM trips
-        WHERE pickup_datetime BETWEEN '2016-01-01' AND '2016-01-31'
+        WHERE pickup_epoch BETWEEN CAST(strftime('%s', '2016-01-01') AS INTEGER)
+                               AND CAST(strftime('%s', '2016-01-31') AS INTEGER)
         AND vendor_id = 2
     """)
     
@@ -120,11 +168,345 @@ def run_test_queries():
     
     conn.close()
     
+    # Test 7: Every endpoint query uses an index on the trip tables
+    print("\nTest 7: Endpoint Query Plans")
+    print("-" * 40)
+    check_endpoint_plans()
+    
+    # Test 8: Conditional requests and cache invalidation
+    print("\nTest 8: Response Cache")
+    print("-" * 40)
+    check_response_cache()
+    
+    # Test 9: Paging through /api/trips with next_cursor
+    print("\nTest 9: Cursor Pagination")
+    print("-" * 40)
+    check_cursor_pagination()
+    
+    # Test 10: Sketched quantiles against exact ones
+    print("\nTest 10: Quantile Sketch Accuracy")
+    print("-" * 40)
+    check_sketch_quantiles()
+    
+    # Test 11: Seeded efficiency samples
+    print("\nTest 11: Efficiency Sample Seeds")
+    print("-" * 40)
+    check_efficiency_seeds()
+    
     print("\n" + "="*60)
     print(" ALL TESTS COMPLETED")
     print("="*60)
 
 
+def full_scans(cursor, sql):
+    """
+    Steps of a query plan that read a whole trip table row by row
+    Args:
+        cursor: Cursor on the database the query runs against
+        sql: The query with its parameters filled in
+    Returns:
+        list of plan step descriptions such as 'SCAN t'
+    """
+    # Plans name tables by alias, so map aliases back to tables
+    aliases = {table: table for table in TRIP_TABLES}
+    words = sql.replace(',', ' ').split()
+    for i, word in enumerate(words[:-1]):
+        if word.upper() in ('FROM', 'JOIN') and words[i + 1] in TRIP_TABLES:
+            following = words[i + 2] if i + 2 < len(words) else ''
+            if following.upper() == 'AS' and i + 3 < len(words):
+                following = words[i + 3]
+            if following.isidentifier():
+                aliases[following] = words[i + 1]
+    
+    cursor.execute("EXPLAIN QUERY PLAN " + sql)
+    scans = []
+    for row in cursor.fetchall():
+        detail = row[3]
+        parts = detail.split()
+        # 'SCAN t USING COVERING INDEX ...' reads an index, not the table
+        if parts[:1] == ['SCAN'] and len(parts) > 1 and parts[1] in aliases and 'INDEX' not in parts:
+            scans.append(detail)
+    return scans
+
+
+@contextlib.contextmanager
+def api_client(db_path='database/nyc_taxi.db'):
+    """
+    Flask test client for app.py on db_path that records the SQL each
+    request sends, parameters included
+    Yields:
+        (app module, test client, list the statements are appended to)
+    """
+    import app as api
+    
+    statements = []
+    traced = []
+    open_db = api.get_db
+    
+    def traced_db():
+        conn = open_db()
+        conn.set_trace_callback(statements.append)
+        traced.append(conn)
+        return conn
+    
+    api.DATABASE = db_path
+    api.get_db = traced_db
+    try:
+        yield api, api.app.test_client(), statements
+    finally:
+        # Pooled connections outlive the check
+        for traced_conn in traced:
+            traced_conn.set_trace_callback(None)
+        api.get_db = open_db
+
+
+def check_endpoint_plans(db_path='database/nyc_taxi.db'):
+    """
+    Call every GET endpoint of the API, EXPLAIN each SELECT it runs and
+    fail if any of them scans trips or trip_metrics without an index
+    Args:
+        db_path: Database the endpoints are run against
+    """
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    failures = []
+    checked = 0
+    with api_client(db_path) as (api, client, statements):
+        routes = sorted(
+            rule.rule for rule in api.app.url_map.iter_rules()
+            if rule.rule.startswith('/api/') and 'GET' in rule.methods and '<' not in rule.rule
+        )
+        
+        for route in routes:
+            default_args = [''] + STATS_FILTER_ARGS if route.startswith(('/api/stats/', '/api/boroughs')) else ['']
+            for args in ENDPOINT_ARGS.get(route, default_args):
+                url = route + args
+                statements.clear()
+                response = client.get(url)
+                response.get_data()  # Runs streamed responses to the end
+                response.close()
+                if response.status_code != 200:
+                    failures.append(f"{url}: HTTP {response.status_code}")
+                    continue
+                for sql in statements:
+                    sql = sql.lstrip()
+                    if sql.upper().startswith('CREATE TEMP TABLE'):
+                        sql = sql[sql.upper().index(' AS') + 3:]  # Check the query filling it
+                    elif 'temp.' in sql:
+                        continue  # Reads a temporary table the request has dropped
+                    if not sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+                        continue
+                    checked += 1
+                    for scan in full_scans(cursor, sql):
+                        failures.append(f"{url}: {scan}")
+    conn.close()
+    
+    print(f"Checked {checked} queries from {len(routes)} endpoints")
+    if failures:
+        for failure in failures:
+            print(f"  Full table scan: {failure}")
+        raise AssertionError(f"{len(failures)} endpoint queries scan a whole trip table")
+    print("  No endpoint query scans a whole trip table")
+
+
+def reads_data(statements):
+    """Whether a request ran any query besides the data version lookup every cached request makes"""
+    return any('FROM settings' not in sql for sql in statements)
+
+
+def check_response_cache(db_path='database/nyc_taxi.db', url='/api/stats/summary'):
+    """
+    A repeated request is answered from the response cache, a matching
+    If-None-Match gets a 304 without a body, and bumping data_version
+    (as every load does) makes the next request rebuild the response
+    Args:
+        db_path: Database the endpoint is run against; its data_version is bumped
+        url: Cached endpoint to request
+    """
+    with api_client(db_path) as (api, client, statements):
+        first = client.get(url)
+        assert first.status_code == 200, f"{url}: HTTP {first.status_code}"
+        etag = first.headers['ETag']
+        
+        statements.clear()
+        repeat = client.get(url)
+        assert repeat.get_data() == first.get_data() and repeat.headers['ETag'] == etag
+        assert not reads_data(statements), "A repeated request was not served from the cache"
+        
+        statements.clear()
+        revalidated = client.get(url, headers={'If-None-Match': etag})
+        assert revalidated.status_code == 304, f"Matching ETag gave HTTP {revalidated.status_code}"
+        assert revalidated.get_data() == b''
+        assert not reads_data(statements), "A 304 rebuilt the response"
+        
+        stale = client.get(url, headers={'If-None-Match': '"not-the-etag"'})
+        assert stale.status_code == 200 and stale.get_data() == first.get_data()
+        print(f"  {url}: cache hit, 304 for ETag {etag}")
+        
+        # Same statement as DataLoader._bump_data_version
+        conn = sqlite3.connect(db_path)
+        conn.execute("""
+            INSERT INTO settings (key, value) VALUES ('data_version', '1')
+            ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+        """)
+        conn.commit()
+        version = conn.execute("SELECT value FROM settings WHERE key = 'data_version'").fetchone()[0]
+        conn.close()
+        
+        statements.clear()
+        rebuilt = client.get(url)
+        assert rebuilt.status_code == 200 and reads_data(statements), "data_version bump didn't clear the cache"
+        assert api.response_cache.version == version and len(api.response_cache.entries) == 1
+        # The data itself didn't change, so neither does the body or its ETag
+        assert rebuilt.get_data() == first.get_data() and rebuilt.headers['ETag'] == etag
+        print(f"  data_version {version}: cache cleared and {url} rebuilt")
+
+
+def check_cursor_pagination(db_path='database/nyc_taxi.db', limit=7):
+    """
+    Follow next_cursor through every page of /api/trips for one day and
+    check each trip comes back exactly once, in (pickup_epoch, trip_rowid)
+    order. The day is one where several trips share a pickup second, and
+    small pages make some page boundaries fall between those trips.
+    Args:
+        db_path: Database the endpoint is run against
+        limit: Page size
+    """
+    conn = sqlite3.connect(db_path)
+    tied = conn.execute("""
+        SELECT pickup_epoch, COUNT(*) FROM trips
+        GROUP BY pickup_epoch
+        ORDER BY COUNT(*) DESC
+        LIMIT 1
+    """).fetchone()
+    if tied is None:
+        print("  No trips to page through")
+        conn.close()
+        return
+    day = conn.execute("SELECT date(?, 'unixepoch')", (tied[0],)).fetchone()[0]
+    
+    with api_client(db_path) as (api, client, statements):
+        for vendor_id in (None, 1):
+            args = f'start_date={day}&end_date={day}' + (f'&vendor_id={vendor_id}' if vendor_id else '')
+            expected = [row[0] for row in conn.execute("""
+                SELECT trip_rowid FROM trips
+                WHERE pickup_epoch >= CAST(strftime('%s', ?) AS INTEGER)
+                AND pickup_epoch < CAST(strftime('%s', ?, '+1 day') AS INTEGER)
+                AND (? IS NULL OR vendor_id = ?)
+                ORDER BY pickup_epoch, trip_rowid
+            """, (day, day, vendor_id, vendor_id))]
+            
+            seen = []
+            pages = 0
+            page_cursor = None
+            while True:
+                url = f'/api/trips?{args}&limit={limit}' + (f'&cursor={page_cursor}' if page_cursor else '')
+                response = client.get(url)
+                assert response.status_code == 200, f"{url}: HTTP {response.status_code}"
+                page = response.get_json()
+                seen.extend(trip['trip_rowid'] for trip in page['trips'])
+                pages += 1
+                page_cursor = page['next_cursor']
+                if page_cursor is None:
+                    break
+                assert page['count'] == limit, f"{url}: short page before the last one"
+            
+            assert len(seen) == len(set(seen)), f"?{args}: {len(seen) - len(set(seen))} trips on two pages"
+            assert seen == expected, f"?{args}: {len(set(expected) - set(seen))} trips missed or out of order"
+            print(f"  ?{args}: {len(seen):,} trips in {pages} pages, each once "
+                  f"({tied[1]} trips share pickup second {tied[0]})")
+    conn.close()
+
+
+def check_sketch_quantiles(db_path='database/nyc_taxi.db'):
+    """
+    Compare /api/stats/quantiles, answered from the merged sketches, with
+    the exact nearest-rank quantiles of the same trips. Each value must be
+    within relative_accuracy of the exact one, allowing for the sketches
+    counting values under SKETCH_MIN_VALUE as that value and for the
+    response rounding to two decimals.
+    Args:
+        db_path: Database the endpoint is run against
+    """
+    from data_loader import SKETCH_MIN_VALUE
+    
+    conn = sqlite3.connect(db_path)
+    with api_client(db_path) as (api, client, statements):
+        for args, where, params in SKETCH_FILTERS:
+            url = '/api/stats/quantiles' + args
+            response = client.get(url)
+            assert response.status_code == 200, f"{url}: HTTP {response.status_code}"
+            assert response.headers.get('X-Query-Plan') == 'sketch', f"{url}: not answered from the sketches"
+            result = response.get_json()
+            accuracy = result['relative_accuracy']
+            assert accuracy > 0
+            
+            worst = 0.0
+            for metric, (key, factor) in api.QUANTILE_METRICS.items():
+                column = SKETCH_COLUMNS[metric]
+                values = [row[0] for row in conn.execute(f"""
+                    SELECT {column} FROM trips t
+                    LEFT JOIN trip_metrics m ON m.trip_rowid = t.trip_rowid
+                    LEFT JOIN locations l ON l.location_id = t.pickup_location_id
+                    WHERE {column} IS NOT NULL AND {where}
+                    ORDER BY {column}
+                """, params)]
+                
+                for name, fraction in api.QUANTILES.items():
+                    exact = values[max(1, math.ceil(fraction * len(values))) - 1] if values else None
+                    sketched = result[key][name]
+                    if exact is None:
+                        assert sketched is None, f"{url}: {key} {name} from no trips"
+                        continue
+                    allowed = accuracy * max(exact, SKETCH_MIN_VALUE)
+                    if exact < SKETCH_MIN_VALUE:
+                        allowed += SKETCH_MIN_VALUE
+                    error = abs(sketched - exact * factor)
+                    assert error <= allowed * factor + 0.005, (
+                        f"{url}: {key} {name} is {sketched}, exact {exact * factor:.4f}")
+                    if exact >= SKETCH_MIN_VALUE:
+                        worst = max(worst, error / (exact * factor))
+            
+            print(f"  {url}: within {worst:.2%} of exact (allowed {accuracy:.0%})")
+    conn.close()
+
+
+def check_efficiency_seeds(db_path='database/nyc_taxi.db', n=500):
+    """
+    The same seed and filters give the same efficiency sample every time
+    it is drawn, here and in a new process (with its own hash seed), and
+    another seed gives a different one
+    Args:
+        db_path: Database the endpoint is run against
+        n: Sample size to ask for
+    """
+    with api_client(db_path) as (api, client, statements):
+        for args in ('', '&borough=Manhattan&start_hour=7&end_hour=9'):
+            url = f'/api/stats/efficiency?n={n}&seed=7{args}'
+            first = client.get(url)
+            assert first.status_code == 200, f"{url}: HTTP {first.status_code}"
+            assert first.headers.get('X-Query-Plan') == 'sample', f"{url}: not drawn from trip_samples"
+            
+            # Draw again rather than reading the cached response
+            api.response_cache.entries.clear()
+            statements.clear()
+            again = client.get(url)
+            assert reads_data(statements), f"{url}: served from the cache"
+            assert again.get_data() == first.get_data(), f"{url}: same seed, different sample"
+            
+            other = client.get(url.replace('seed=7', 'seed=8'))
+            assert other.get_data() != first.get_data(), f"{url}: seed 8 drew the same sample as seed 7"
+            
+            script = (f"import sys; sys.path.insert(0, {PROJECT_ROOT!r}); import app; "
+                      f"app.DATABASE = {os.path.abspath(db_path)!r}; "
+                      f"sys.stdout.buffer.write(app.app.test_client().get({url!r}).get_data())")
+            process = subprocess.run([sys.executable, '-c', script], capture_output=True, check=True,
+                                     env=dict(os.environ, PYTHONHASHSEED='random'))
+            assert process.stdout == first.get_data(), f"{url}: another process drew a different sample"
+            
+            print(f"  {url}: {len(first.get_json())} trips, identical on every draw")
+
+
 if __name__ == '__main__':
     run_test_queries()
 
@@ -0,0 +1,204 @@
+"""
+Columnar Trip Batch
+Holds trips as one typed array per column instead of a dict of strings per row
+"""
+
+from array import array  # Built-in compact typed arrays
+from itertools import compress
+from timestamps import MISSING_EPOCH
+
+# Known columns and their array typecodes
+# ('d' = float64, 'q' = int64, 'i' = int32, 'b' = int8)
+# Anything not listed here (ids, timestamps, flags) is kept as a list of strings
+COLUMN_TYPES = {
+    'vendor_id': 'i',
+    'passenger_count': 'i',
+    'pickup_longitude': 'd',
+    'pickup_latitude': 'd',
+    'dropoff_longitude': 'd',
+    'dropoff_latitude': 'd',
+    'trip_duration': 'i',
+    'fare_amount': 'd',
+    'pickup_epoch': 'q',
+    'dropoff_epoch': 'q',
+    'pickup_hour': 'b',
+    'pickup_day': 'b',
+    'pickup_weekday': 'b',
+    'distance_km': 'd',
+    'trip_speed_kmh': 'd',
+    'fare_per_km': 'd',
+    'is_suspicious': 'b',
+    'suspicious_flags': 'i'
+}
+
+# Integer sentinels: an empty cell (can be filled) vs. text that isn't a number
+MISSING_INT = -2 ** 31
+INVALID_INT = -2 ** 31 + 1
+
+NAN = float('nan')
+
+
+def valid_ints(*values):
+    """True if no value is a sentinel (an empty cell or text that isn't a number)"""
+    return min(values) > INVALID_INT
+
+
+def parse_float(value):
+    """Parse a CSV cell as float, NaN if empty or not a number"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return NAN
+
+
+def parse_int(value):
+    """Parse a CSV cell like int(float(value)), with sentinels for bad cells"""
+    if value is None or not value.strip():
+        return MISSING_INT
+    try:
+        number = int(float(value))
+    except (ValueError, OverflowError):
+        return INVALID_INT
+    return number if INVALID_INT < number < 2 ** 31 else INVALID_INT
+
+
+def format_column(values):
+    """Turn a slice of a column back into the CSV text it came from"""
+    if not isinstance(values, array):
+        return values
+    if values.typecode == 'd':
+        # NaN is the only value not equal to itself
+        return [repr(value) if value == value else '' for value in values]
+    floor = MISSING_EPOCH if values.typecode == 'q' else INVALID_INT
+    return [str(value) if value > floor else '' for value in values]
+
+
+class TripBatch:
+    """
+    A batch of trips stored column by column
+    Values are parsed once when the batch is built. Stages filter with
+    select() and add results with add_column(); strings are only produced
+    again by iter_records() when writing CSV.
+    """
+
+    def __init__(self, columns, data, complete=None):
+        """
+        Args:
+            columns: Ordered column names
+            data: Dict of column name -> array (typed) or list (text)
+            complete: Optional bytearray, 1 where every required column had
+                a non-empty value in the source CSV
+        """
+        self.columns = list(columns)
+        self.data = data
+        self.complete = complete
+
+    @classmethod
+    def from_records(cls, fieldnames, records, required=(), columns=None):
+        """
+        Build a batch from raw csv.reader records
+        Args:
+            fieldnames: Header of the CSV
+            records: List of lists of strings
+            required: Columns that must be non-empty for a row to count
+                as complete (see self.complete)
+            columns: Only build these columns (default: all of fieldnames)
+        """
+        width = len(fieldnames)
+        records = [
+            record if len(record) == width else (record + [''] * width)[:width]
+            for record in records
+        ]
+        raw_columns = list(zip(*records)) if records else [()] * width
+
+        wanted = fieldnames if columns is None else [name for name in fieldnames if name in columns]
+
+        data = {}
+        for name, raw in zip(fieldnames, raw_columns):
+            if name not in wanted:
+                continue
+            typecode = COLUMN_TYPES.get(name)
+            if typecode == 'd':
+                data[name] = array('d', map(parse_float, raw))
+            elif typecode is not None:
+                data[name] = array(typecode, map(parse_int, raw))
+            else:
+                data[name] = list(raw)
+
+        # Checked on the raw text so unparseable numbers still count as present
+        positions = [fieldnames.index(name) for name in required]
+        complete = bytearray(
+            all(raw_columns[p][i].strip() for p in positions)
+            for i in range(len(records))
+        )
+
+        return cls(wanted, data, complete)
+
+    @classmethod
+    def empty(cls, columns):
+        """A batch with the given columns and no rows"""
+        return cls(columns, {name: cls._new_column(name) for name in columns}, bytearray())
+
+    def __len__(self):
+        return len(self.data[self.columns[0]]) if self.columns else 0
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def __contains__(self, name):
+        return name in self.data
+
+    def add_column(self, name, values):
+        """Add (or replace) a column; values must have one entry per row"""
+        if name not in self.data:
+            self.columns.append(name)
+        self.data[name] = values
+
+    def select(self, mask):
+        """
+        New batch with only the rows where mask is truthy
+        Args:
+            mask: Sequence with one flag per row (list or bytearray)
+        """
+        data = {}
+        for name in self.columns:
+            column = self.data[name]
+            if isinstance(column, array):
+                data[name] = array(column.typecode, compress(column, mask))
+            else:
+                data[name] = list(compress(column, mask))
+
+        complete = None
+        if self.complete is not None:
+            complete = bytearray(compress(self.complete, mask))
+
+        return TripBatch(self.columns, data, complete)
+
+    def extend(self, other):
+        """Append all rows of another batch with the same columns"""
+        for name in self.columns:
+            self.data[name].extend(other.data[name])
+        if self.complete is not None and other.complete is not None:
+            self.complete.extend(other.complete)
+
+    def canonical_rows(self):
+        """Yield one byte string per row; equal rows give equal bytes"""
+        columns = [self.data[name] for name in self.columns]
+        for values in zip(*columns):
+            yield '\x1f'.join(map(str, values)).encode('utf-8')
+
+    def iter_records(self, window=10000):
+        """
+        Yield rows as lists of CSV strings, formatting a window at a time
+        so the text form of the whole batch never exists at once
+        """
+        for start in range(0, len(self), window):
+            stop = start + window
+            formatted = [format_column(self.data[name][start:stop]) for name in self.columns]
+            yield from zip(*formatted)
+
+    @staticmethod
+    def _new_column(name):
+        """Empty array or list suitable for a column"""
+        typecode = COLUMN_TYPES.get(name)
+        return array(typecode) if typecode else []
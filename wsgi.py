@@ -0,0 +1,31 @@
+"""
+Production entry point for the API
+app.py's own server is Flask's development server (one process, debugger on).
+Serve users with a multi-threaded WSGI server instead, with either command:
+    gunicorn -c gunicorn.conf.py wsgi:app    (Linux/macOS: API_WORKERS processes x API_THREADS threads)
+    python wsgi.py                           (any OS: waitress, one process with API_THREADS threads)
+Settings come from the environment:
+    API_HOST, API_PORT: Address to listen on (default 127.0.0.1:5000)
+    API_WORKERS: Worker processes under gunicorn (default 2)
+    API_THREADS: Request threads per process (default 8)
+    API_SCAN_SLOTS: Requests per process that may scan trips at once (default 4)
+    API_SCAN_WAIT: Seconds a request waits for a scan slot before a 503 (default 10)
+"""
+
+import os
+
+from app import app, DATABASE
+
+HOST = os.environ.get('API_HOST', '127.0.0.1')
+PORT = int(os.environ.get('API_PORT', 5000))
+THREADS = int(os.environ.get('API_THREADS', 8))
+
+
+if __name__ == '__main__':
+    if not os.path.exists(DATABASE):
+        print("Error: Database not found! Run the setup scripts first (see README)")
+    else:
+        from waitress import serve
+        
+        print(f"Serving the API at http://{HOST}:{PORT}/ with {THREADS} threads")
+        serve(app, host=HOST, port=PORT, threads=THREADS)